@@ -4,30 +4,53 @@ import asyncio
 import base64
 import io
 from datetime import datetime, UTC
+from typing import Optional
 from telegram import ForceReply, Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.request import BaseRequest
 from dotenv import load_dotenv
 from database import db_manager
+from logging_setup import configure_logging, add_sampling
+from metrics import build_request, start_metrics_server, stop_metrics_server
+from monitoring import register_update_instrumentation, process_slow_queries
+from flood_control import register_flood_control
+from update_recorder import register_update_recorder
+from deadlines import deadline_error_handler, uninterrupted, PURCHASE
+from maintenance import run_notification_archiver
+from notification_queue import fetch_notification_batch, observe_delivery
+from broadcast import process_broadcasts
 from telegram.error import BadRequest
+from render_cache import render_cache, message_key, fingerprint, answer_unchanged
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Shown when a catalog screen has neither a snapshot nor a reachable database
+CATALOG_UNAVAILABLE_TEXT = "⚠️ القائمة غير متاحة مؤقتاً، يرجى المحاولة بعد قليل."
+
 
 async def safe_edit_message(query, text, reply_markup=None, fallback_answer="تم التحديث ✅"):
-    """Safely edit a message, handling BadRequest errors for identical content"""
+    """Safely edit a message, skipping the API call when it already shows this content"""
+    key = message_key(query)
+    render = fingerprint(text, reply_markup)
+    if render_cache.is_unchanged(key, render):
+        # Same text and keyboard as the last render, just answer the callback
+        await answer_unchanged(query, fallback_answer)
+        return
     try:
         await query.edit_message_text(text=text, reply_markup=reply_markup)
+        render_cache.remember(key, render)
     except BadRequest as e:
         if "message is not modified" in str(e).lower():
             # Message content is identical, just answer the callback
-            await query.answer(fallback_answer)
+            render_cache.remember(key, render)
+            await answer_unchanged(query, fallback_answer)
         else:
             # Re-raise other BadRequest errors
+            render_cache.forget(key)
             raise e
     except Exception as e:
-        logging.error(f"Unexpected error editing message: {e}")
+        render_cache.forget(key)
+        logging.error("Unexpected error editing message: %s", e)
         await query.answer("حدث خطأ، يرجى المحاولة مرة أخرى")
 
 
@@ -40,8 +63,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.message.reply_text('عذراً، لقد تم حظرك من استخدام هذا البوت.')
         return
     
-    # Create user if doesn't exist
-    await db_manager.create_user(
+    # Create the user or refresh a changed username/name
+    await db_manager.register_user(
         user_id=user.id,
         username=user.username,
         first_name=user.first_name,
@@ -134,9 +157,16 @@ Itunes gift card (بطاقة إيتونس)
         
     elif query.data == 'cardlist':
         # Show available countries
-        countries = await db_manager.get_available_countries()
+        countries = await db_manager.get_catalog_countries()
         
-        if countries:
+        if countries is None:
+            keyboard = [
+                [InlineKeyboardButton("🔄 إعادة المحاولة", callback_data='cardlist')],
+                [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, CATALOG_UNAVAILABLE_TEXT, reply_markup)
+        elif countries:
             keyboard = []
             for country in countries:
                 keyboard.append([InlineKeyboardButton(
@@ -146,16 +176,18 @@ Itunes gift card (بطاقة إيتونس)
             keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
-            await query.edit_message_text(
-                text="🌍 اختر الدولة التي تريد شراء بطاقات لها:",
-                reply_markup=reply_markup
+            await safe_edit_message(
+                query,
+                "🌍 اختر الدولة التي تريد شراء بطاقات لها:",
+                reply_markup
             )
         else:
             keyboard = [[InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                text="😔 لا توجد دول متاحة حالياً",
-                reply_markup=reply_markup
+            await safe_edit_message(
+                query,
+                "😔 لا توجد دول متاحة حالياً",
+                reply_markup
             )
         
     elif query.data == 'howtouse':
@@ -175,7 +207,7 @@ Itunes gift card (بطاقة إيتونس)
 • تأكد من صحة البيانات قبل الشراء
 • احتفظ بتفاصيل البطاقة في مكان آمن
 • تواصل مع الدعم في حالة وجود مشاكل @FastCardChat"""
-        await query.edit_message_text(text=help_text, reply_markup=reply_markup)
+        await safe_edit_message(query, help_text, reply_markup)
         
     elif query.data == 'cardreplaceinstructions':
         keyboard = [[InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]]
@@ -195,13 +227,20 @@ Itunes gift card (بطاقة إيتونس)
 4️⃣ انتظر المراجعة والموافقة
 
 ⏰ مدة المعالجة: 24-48 ساعة"""
-        await query.edit_message_text(text=replace_text, reply_markup=reply_markup)
+        await safe_edit_message(query, replace_text, reply_markup)
         
     elif query.data == 'blacklist':
         # Show available black websites for purchase
-        websites = await db_manager.get_available_black_websites()
+        websites = await db_manager.get_catalog_black_websites()
         
-        if websites:
+        if websites is None:
+            keyboard = [
+                [InlineKeyboardButton("🔄 إعادة المحاولة", callback_data='blacklist')],
+                [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, CATALOG_UNAVAILABLE_TEXT, reply_markup)
+        elif websites:
             keyboard = []
             for website in websites:
                 keyboard.append([InlineKeyboardButton(
@@ -222,9 +261,16 @@ Itunes gift card (بطاقة إيتونس)
     # Handle country selection
     elif query.data.startswith('country_'):
         country_code = query.data.split('_')[1]
-        cards = await db_manager.get_cards_by_country(country_code)
+        cards = await db_manager.get_catalog_cards(country_code)
         
-        if cards:
+        if cards is None:
+            keyboard = [
+                [InlineKeyboardButton("🔄 إعادة المحاولة", callback_data=f"country_{country_code}")],
+                [InlineKeyboardButton("🔙 العودة لقائمة الدول", callback_data='cardlist')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, CATALOG_UNAVAILABLE_TEXT, reply_markup)
+        elif cards:
             keyboard = []
             for card in cards:
                 # Format: "Visa 20.0 USDT (5)"
@@ -241,12 +287,13 @@ Itunes gift card (بطاقة إيتونس)
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             # Get country name for display
-            countries = await db_manager.get_available_countries()
+            countries = await db_manager.get_catalog_countries() or []
             country_name = next((c['name'] for c in countries if c['code'] == country_code), country_code)
             
-            await query.edit_message_text(
-                text=f"🏷️ البطاقات المتاحة في {country_name}:\n\nاختر البطاقة التي تريد شراءها:",
-                reply_markup=reply_markup
+            await safe_edit_message(
+                query,
+                f"🏷️ البطاقات المتاحة في {country_name}:\n\nاختر البطاقة التي تريد شراءها:",
+                reply_markup
             )
         else:
             keyboard = [
@@ -254,20 +301,21 @@ Itunes gift card (بطاقة إيتونس)
                 [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                text="😔 لا توجد بطاقات متاحة لهذه الدولة حالياً",
-                reply_markup=reply_markup
+            await safe_edit_message(
+                query,
+                "😔 لا توجد بطاقات متاحة لهذه الدولة حالياً",
+                reply_markup
             )
     
     
     # Handle card selection
     elif query.data.startswith('card_'):
-        logger.info(f"data: {query.data}")
+        logger.info("data: %s", query.data)
         # Remove 'card_' prefix to get the full card_id
         card_id = query.data[5:]  # Remove 'card_' (5 characters)
-        logger.info(f"card_id: {card_id}")
+        logger.info("card_id: %s", card_id)
         card = await db_manager.get_card(card_id)
-        logger.info(f"Card: {card}")
+        logger.info("Card: %s", card)
         if card and card.get('is_available', False):
             
 
@@ -292,7 +340,7 @@ Itunes gift card (بطاقة إيتونس)
 
 ❓ هل أنت متأكد من أنك تريد شراء هذه البطاقة؟"""
                 
-                await query.edit_message_text(text=confirmation_text, reply_markup=reply_markup)
+                await safe_edit_message(query, confirmation_text, reply_markup)
             else:
                 keyboard = [
                     [InlineKeyboardButton("💸 إيداع USDT", callback_data='depositusdt')],
@@ -309,129 +357,230 @@ Itunes gift card (بطاقة إيتونس)
 
 يرجى إيداع المبلغ المطلوب أولاً."""
                 
-                await query.edit_message_text(text=insufficient_text, reply_markup=reply_markup)
+                await safe_edit_message(query, insufficient_text, reply_markup)
         else:
             keyboard = [
                 [InlineKeyboardButton("🔙 العودة لقائمة الدول", callback_data='cardlist')],
                 [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]
             ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                text="😔 لا توجد بطاقات متاحة حالياً",
-                reply_markup=reply_markup
+            await safe_edit_message(
+                query,
+                "😔 لا توجد بطاقات متاحة حالياً",
+                reply_markup
             )
     
     # Handle website purchase confirmation (must come before general confirm_ handler)
     elif query.data.startswith('confirm_buy_website_'):
         website_id = query.data[20:]  # Remove 'confirm_buy_website_' prefix
+        text, reply_markup = await run_purchase(query, user, purchase_website, website_id)
+        await safe_edit_message(query, text, reply_markup)
+    
+    # Handle card order confirmation
+    elif query.data.startswith('confirm_'):
+        # Remove 'confirm_' prefix to get the full card_id
+        card_id = query.data[8:]  # Remove 'confirm_' (8 characters)
+        text, reply_markup = await run_purchase(query, user, purchase_card, card_id)
+        await safe_edit_message(query, text, reply_markup)
+    
+    # Handle black website purchase
+    elif query.data.startswith('buy_website_'):
+        website_id = query.data[12:]  # Remove 'buy_website_' prefix
         website = await db_manager.get_black_website(website_id)
         
         if website:
             user_balance = await db_manager.get_user_balance(user.id)
             
             if user_balance >= website['price']:
-                # Process the purchase
-                success = await db_manager.purchase_black_website(website_id, user.id)
+                # Show confirmation dialog
+                keyboard = [
+                    [InlineKeyboardButton("✅ نعم، أريد الشراء", callback_data=f"confirm_buy_website_{website_id}")],
+                    [InlineKeyboardButton("❌ إلغاء", callback_data='blacklist')]
+                ]
+                reply_markup = InlineKeyboardMarkup(keyboard)
                 
-                if success:
-                    # Deduct balance
-                    await db_manager.update_user_balance(user.id, -website['price'])
-                    
-                    # Create transaction record
-                    await db_manager.create_transaction(
-                        user_id=user.id,
-                        transaction_type='purchase',
-                        amount=-website['price'],
-                        description=f"شراء موقع: {website['name']}"
-                    )
-                    
-                    keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    description = website.get('description', '')
-                    description_text = f"\n📄 الوصف: {description}\n" if description else ""
-                    
-                    success_text = f"""
-✅ تم شراء الموقع بنجاح!
+                confirmation_text = f"""
+🌐 تأكيد شراء الموقع
 
-🌐 الموقع: {website['name']}
-🔗 الرابط: {website['url']}{description_text}
-💰 المبلغ المدفوع: ${website['price']}
-💳 رصيدك الجديد: ${user_balance - website['price']:.2f}
+📋 الموقع: {website['name']}
+💰 السعر: ${website['price']}
+💳 رصيدك الحالي: ${user_balance:.2f}
 
-⚠️ احتفظ بالرابط والوصف في مكان آمن
-                    """
-                    
-                    await safe_edit_message(query, success_text, reply_markup)
-                else:
-                    keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await safe_edit_message(
-                        query,
-                        "❌ حدث خطأ في إتمام الشراء. يرجى المحاولة مرة أخرى.",
-                        reply_markup
-                    )
+هل أنت متأكد من شراء هذا الموقع؟
+                """
+                await safe_edit_message(query, confirmation_text, reply_markup)
             else:
                 keyboard = [
                     [InlineKeyboardButton("💸 إيداع USDT", callback_data='depositusdt')],
-                    [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]
+                    [InlineKeyboardButton("🔙 العودة للمواقع", callback_data='blacklist')]
                 ]
                 reply_markup = InlineKeyboardMarkup(keyboard)
                 await safe_edit_message(
                     query,
-                    "⚠️ رصيدك غير كافي لإتمام هذا الشراء.",
+                    f"⚠️ رصيدك غير كافي لشراء هذا الموقع.\n\n💰 السعر: ${website['price']}\n💳 رصيدك: ${user_balance:.2f}",
                     reply_markup
                 )
         else:
-            keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+            keyboard = [[InlineKeyboardButton("🔙 العودة للمواقع", callback_data='blacklist')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await safe_edit_message(
-                query,
-                "😔 هذا الموقع لم يعد متاحاً.",
-                reply_markup
-            )
+            await safe_edit_message(query, "😔 هذا الموقع لم يعد متاحاً.", reply_markup)
     
-    # Handle card order confirmation
-    elif query.data.startswith('confirm_'):
-        # Remove 'confirm_' prefix to get the full card_id
-        card_id = query.data[8:]  # Remove 'confirm_' (8 characters)
-        card = await db_manager.get_card(card_id)
+
+PURCHASE_IN_PROGRESS_TEXT = "⏳ جاري معالجة طلبك، يرجى الانتظار..."
+
+
+def purchase_key(query, user) -> Optional[str]:
+    """Idempotency key of a confirm tap: the user, the button and the rendering of the screen it was tapped on"""
+    message = query.message
+    if message is None:
+        return None
+    rendered_at = message.edit_date or message.date
+    return f"{user.id}:{query.data}:{message.chat.id}:{message.message_id}:{int(rendered_at.timestamp())}"
+
+
+async def run_purchase(query, user, purchase, item_id: str):
+    """Run a purchase once per confirmation screen however often its button is tapped; returns the screen to show"""
+    # Updates are handled one at a time, so repeated taps arrive after the first
+    # purchase finished and are answered from its idempotency key
+    return await idempotent_purchase(purchase_key(query, user), user, purchase, item_id)
+
+
+async def idempotent_purchase(key: Optional[str], user, purchase, item_id: str):
+    """Run a purchase unless another replica or an earlier tap already ran it under the same key"""
+    if key is None:
+        text, reply_markup, _ = await purchase(user, item_id, None)
+        return text, reply_markup
+    
+    existing = await db_manager.claim_idempotency_key(key)
+    if existing is not None:
+        result = existing.get('result')
+        if existing.get('status') != 'completed' or not result:
+            keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+            return PURCHASE_IN_PROGRESS_TEXT, InlineKeyboardMarkup(keyboard)
+        logger.info("Repeated purchase %s answered from its first result", key)
+        return result['text'], InlineKeyboardMarkup.de_json(result['reply_markup'], None)
+    
+    try:
+        text, reply_markup, completed = await purchase(user, item_id, key)
+    except Exception:
+        # The user is asked to try again: give the key back unless the order was
+        # already placed, in which case a retry must not buy a second time
+        try:
+            with uninterrupted():
+                if not await db_manager.order_exists_for_key(key):
+                    await db_manager.release_idempotency_key(key)
+        except Exception as e:
+            logger.error("Error releasing idempotency key %s after a failed purchase: %s", key, e)
+        raise
+    if completed:
+        await db_manager.complete_idempotency_key(key, {"text": text, "reply_markup": reply_markup.to_dict()})
+    else:
+        await db_manager.release_idempotency_key(key)
+    return text, reply_markup
+
+
+async def purchase_website(user, website_id: str, idempotency_key: Optional[str]):
+    """Buy a black website with the user's balance; returns the screen to show and whether it was bought"""
+    website = await db_manager.get_black_website(website_id)
+    
+    if website:
+        user_balance = await db_manager.get_user_balance(user.id)
         
-        if card and card.get('is_available', False):
-            # Check balance again
-            user_balance = await db_manager.get_user_balance(user.id)
+        if user_balance >= website['price']:
+            # The purchase and its debit run to the end once started
+            with uninterrupted(PURCHASE):
+                success = await db_manager.purchase_black_website(website_id, user.id)
+                if success:
+                    # Deduct balance and record it in the ledger
+                    await db_manager.apply_balance_change(
+                        user.id,
+                        -website['price'],
+                        'purchase',
+                        description=f"شراء موقع: {website['name']}"
+                    )
             
-            if user_balance >= card['price']:
+            if success:
+                db_manager.catalog.invalidate("black_websites")
+                
+                keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                
+                description = website.get('description', '')
+                description_text = f"\n📄 الوصف: {description}\n" if description else ""
+                
+                success_text = f"""
+✅ تم شراء الموقع بنجاح!
+
+🌐 الموقع: {website['name']}
+🔗 الرابط: {website['url']}{description_text}
+💰 المبلغ المدفوع: ${website['price']}
+💳 رصيدك الجديد: ${user_balance - website['price']:.2f}
+
+⚠️ احتفظ بالرابط والوصف في مكان آمن
+                """
+                
+                return success_text, reply_markup, True
+            else:
+                keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                return "❌ حدث خطأ في إتمام الشراء. يرجى المحاولة مرة أخرى.", reply_markup, False
+        else:
+            keyboard = [
+                [InlineKeyboardButton("💸 إيداع USDT", callback_data='depositusdt')],
+                [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            return "⚠️ رصيدك غير كافي لإتمام هذا الشراء.", reply_markup, False
+    else:
+        keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        return "😔 هذا الموقع لم يعد متاحاً.", reply_markup, False
+
+
+async def purchase_card(user, card_id: str, idempotency_key: Optional[str]):
+    """Order a card with the user's balance; returns the screen to show and whether the order was placed"""
+    card = await db_manager.get_card(card_id)
+    
+    if card and card.get('is_available', False):
+        # Check balance again
+        user_balance = await db_manager.get_user_balance(user.id)
+        
+        if user_balance >= card['price']:
+            # Order, debit and reservation run to the end once started, so a
+            # deadline cannot leave an order that was never paid for
+            with uninterrupted(PURCHASE):
                 # Create order
                 order_id = await db_manager.create_order(
                     user_id=user.id,
                     card_id=card_id,
                     country_code=card['country_code'],
-                    amount=card['price']
+                    amount=card['price'],
+                    idempotency_key=idempotency_key
                 )
                 
                 if order_id:
-                    # Deduct balance
-                    await db_manager.update_user_balance(user.id, -card['price'])
+                    # Deduct balance and record it in the ledger
+                    await db_manager.apply_balance_change(
+                        user.id,
+                        -card['price'],
+                        'card_purchase',
+                        description=f"شراء بطاقة {card['card_type']}"
+                    )
                     
                     # Reserve the card
                     await db_manager.reserve_card(card_id, user.id)
                     
-                    # Create transaction record
-                    await db_manager.create_transaction(
-                        user_id=user.id,
-                        transaction_type='card_purchase',
-                        amount=card['price'],
-                        description=f"شراء بطاقة {card['card_type']}"
-                    )
-                    
                     # Create notification for order bot to process
                     await create_order_notification(user, card, order_id)
-                    
-                    keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    
-                    success_text = f"""✅ تم إنشاء الطلب بنجاح!
+            
+            if order_id:
+                # Stock changed, the next card list reloads it
+                db_manager.catalog.invalidate(f"cards:{card['country_code']}")
+                
+                keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+                reply_markup = InlineKeyboardMarkup(keyboard)
+                
+                success_text = f"""✅ تم إنشاء الطلب بنجاح!
 
 🆔 رقم الطلب: {order_id}
 🏷️ نوع البطاقة: {card['card_type']}
@@ -440,75 +589,24 @@ Itunes gift card (بطاقة إيتونس)
 📨 تم إرسال إشعار للإدارة وسيتم إرسال تفاصيل البطاقة قريباً.
 
 ⏰ وقت التسليم المتوقع: 5-30 دقيقة"""
-                    
-                    await query.edit_message_text(text=success_text, reply_markup=reply_markup)
-                else:
-                    keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    await query.edit_message_text(
-                        text="❌ حدث خطأ في إنشاء الطلب. يرجى المحاولة مرة أخرى.",
-                        reply_markup=reply_markup
-                    )
-            else:
-                keyboard = [
-                    [InlineKeyboardButton("💸 إيداع USDT", callback_data='depositusdt')],
-                    [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                await query.edit_message_text(
-                    text="⚠️ رصيدك غير كافي لإتمام هذا الطلب.",
-                    reply_markup=reply_markup
-                )
-        else:
-            keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(
-                text="😔 هذه البطاقة لم تعد متاحة.",
-                reply_markup=reply_markup
-            )
-    
-    # Handle black website purchase
-    elif query.data.startswith('buy_website_'):
-        website_id = query.data[12:]  # Remove 'buy_website_' prefix
-        website = await db_manager.get_black_website(website_id)
-        
-        if website:
-            user_balance = await db_manager.get_user_balance(user.id)
-            
-            if user_balance >= website['price']:
-                # Show confirmation dialog
-                keyboard = [
-                    [InlineKeyboardButton("✅ نعم، أريد الشراء", callback_data=f"confirm_buy_website_{website_id}")],
-                    [InlineKeyboardButton("❌ إلغاء", callback_data='blacklist')]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
                 
-                confirmation_text = f"""
-🌐 تأكيد شراء الموقع
-
-📋 الموقع: {website['name']}
-💰 السعر: ${website['price']}
-💳 رصيدك الحالي: ${user_balance:.2f}
-
-هل أنت متأكد من شراء هذا الموقع؟
-                """
-                await safe_edit_message(query, confirmation_text, reply_markup)
+                return success_text, reply_markup, True
             else:
-                keyboard = [
-                    [InlineKeyboardButton("💸 إيداع USDT", callback_data='depositusdt')],
-                    [InlineKeyboardButton("🔙 العودة للمواقع", callback_data='blacklist')]
-                ]
+                keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
                 reply_markup = InlineKeyboardMarkup(keyboard)
-                await safe_edit_message(
-                    query,
-                    f"⚠️ رصيدك غير كافي لشراء هذا الموقع.\n\n💰 السعر: ${website['price']}\n💳 رصيدك: ${user_balance:.2f}",
-                    reply_markup
-                )
+                return "❌ حدث خطأ في إنشاء الطلب. يرجى المحاولة مرة أخرى.", reply_markup, False
         else:
-            keyboard = [[InlineKeyboardButton("🔙 العودة للمواقع", callback_data='blacklist')]]
+            keyboard = [
+                [InlineKeyboardButton("💸 إيداع USDT", callback_data='depositusdt')],
+                [InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]
+            ]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await safe_edit_message(query, "😔 هذا الموقع لم يعد متاحاً.", reply_markup)
-    
+            return "⚠️ رصيدك غير كافي لإتمام هذا الطلب.", reply_markup, False
+    else:
+        keyboard = [[InlineKeyboardButton("🏠 القائمة الرئيسية", callback_data='start')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        return "😔 هذه البطاقة لم تعد متاحة.", reply_markup, False
+
 
 async def create_order_notification(user, card, order_id):
     """Create a notification for the order bot to process"""
@@ -530,28 +628,51 @@ async def create_order_notification(user, card, order_id):
         
         notification_id = await db_manager.create_notification("new_order", notification_data)
         if notification_id:
-            logging.info(f"Created notification {notification_id} for order {order_id}")
+            logging.info("Created notification %s for order %s", notification_id, order_id)
         else:
-            logging.error(f"Failed to create notification for order {order_id}")
+            logging.error("Failed to create notification for order %s", order_id)
             
     except Exception as e:
-        logging.error(f"Error creating order notification: {e}")
+        logging.error("Error creating order notification: %s", e)
+
+
+# Errors after which the user can never receive the message
+PERMANENT_SEND_ERRORS = ['blocked', 'not found', 'forbidden', 'chat not found']
+
+# Notification types delivered by this bot (new_order is handled by the order bot)
+CUSTOMER_NOTIFICATION_TYPES = [
+    'deliver_card', 'deliver_card_image', 'order_completed', 'order_cancelled',
+    'balance_updated', 'user_blocked', 'user_unblocked'
+]
+
+
+async def handle_notification_failure(notification, error):
+    """Retire notifications for unreachable users, otherwise schedule a retry with backoff"""
+    error_str = str(error).lower()
+    if any(phrase in error_str for phrase in PERMANENT_SEND_ERRORS):
+        user_id = notification.get('data', {}).get('user_id')
+        logger.warning("User %s appears to have blocked the bot or chat not found. Marking notification as processed.", user_id)
+        await db_manager.mark_notification_processed(notification['notification_id'])
+    else:
+        await db_manager.record_notification_failure(notification, str(error))
 
 
 async def process_card_delivery_notifications(application):
     """Background task to process card delivery notifications"""
+    poll_interval = float(os.getenv('NOTIFICATION_POLL_INTERVAL', '1'))
     while True:
         try:
-            # Get pending card delivery notifications
-            notifications = await db_manager.get_pending_notifications()
+            # Get due notifications, interleaved across priority lanes
+            notifications = await fetch_notification_batch(db_manager, CUSTOMER_NOTIFICATION_TYPES)
             
             if notifications:
-                logger.info(f"Found {len(notifications)} pending notifications to process")
+                logger.info("Found %s pending notifications to process", len(notifications))
             
             for notification in notifications:
                 notification_type = notification.get('type')
                 notification_id = notification.get('notification_id')
-                logger.info(f"Processing notification {notification_id} of type {notification_type}")
+                logger.info("Processing notification %s of type %s", notification_id, notification_type)
+                observe_delivery(notification)
                 
                 if notification_type == 'deliver_card':
                     await handle_card_delivery(application, notification)
@@ -568,15 +689,16 @@ async def process_card_delivery_notifications(application):
                 elif notification_type == 'user_unblocked':
                     await handle_block_notification(application, notification)
                 else:
-                    logger.warning(f"Unknown notification type: {notification_type} for notification {notification_id}")
+                    logger.warning("Unknown notification type: %s for notification %s", notification_type, notification_id)
                     # Mark unknown notification types as processed to avoid infinite loop
                     await db_manager.mark_notification_processed(notification_id)
                     
-            # Wait 5 seconds before checking again
-            await asyncio.sleep(5)
+            # Poll again right away while there is a backlog
+            if not notifications:
+                await asyncio.sleep(poll_interval)
             
         except Exception as e:
-            logger.error(f"Error in card delivery notification processing: {e}")
+            logger.error("Error in card delivery notification processing: %s", e)
             await asyncio.sleep(10)  # Wait longer on error
 
 
@@ -589,7 +711,7 @@ async def handle_card_delivery(application, notification):
         card_details = data.get('card_details', {})
         
         if not user_id or not card_details:
-            logger.error(f"Invalid card delivery notification data: {data}")
+            logger.error("Invalid card delivery notification data: %s", data)
             # Mark invalid notifications as processed to avoid infinite retry
             await db_manager.mark_notification_processed(notification['notification_id'])
             return
@@ -617,15 +739,11 @@ async def handle_card_delivery(application, notification):
         
         # Mark notification as processed
         await db_manager.mark_notification_processed(notification['notification_id'])
-        logger.info(f"Delivered card details for order {order_id} to user {user_id}")
+        logger.info("Delivered card details for order %s to user %s", order_id, user_id)
         
     except Exception as e:
-        logger.error(f"Error handling card delivery notification {notification.get('notification_id')}: {e}")
-        # For certain errors (like user blocked bot), mark as processed to avoid infinite retry
-        error_str = str(e).lower()
-        if any(phrase in error_str for phrase in ['blocked', 'not found', 'forbidden', 'chat not found']):
-            logger.warning(f"User {user_id} appears to have blocked the bot or chat not found. Marking notification as processed.")
-            await db_manager.mark_notification_processed(notification['notification_id'])
+        logger.error("Error handling card delivery notification %s: %s", notification.get('notification_id'), e)
+        await handle_notification_failure(notification, e)
 
 
 async def handle_card_image_delivery(application, notification):
@@ -637,7 +755,7 @@ async def handle_card_image_delivery(application, notification):
         image_data_base64 = data.get('image_data')
         
         if not user_id or not image_data_base64:
-            logger.error(f"Invalid card image delivery notification data: {data}")
+            logger.error("Invalid card image delivery notification data: %s", data)
             # Mark invalid notifications as processed to avoid infinite retry
             await db_manager.mark_notification_processed(notification['notification_id'])
             return
@@ -667,15 +785,11 @@ async def handle_card_image_delivery(application, notification):
         
         # Mark notification as processed
         await db_manager.mark_notification_processed(notification['notification_id'])
-        logger.info(f"Delivered card image for order {order_id} to user {user_id}")
+        logger.info("Delivered card image for order %s to user %s", order_id, user_id)
         
     except Exception as e:
-        logger.error(f"Error handling card image delivery notification {notification.get('notification_id')}: {e}")
-        # For certain errors (like user blocked bot), mark as processed to avoid infinite retry
-        error_str = str(e).lower()
-        if any(phrase in error_str for phrase in ['blocked', 'not found', 'forbidden', 'chat not found']):
-            logger.warning(f"User {user_id} appears to have blocked the bot or chat not found. Marking notification as processed.")
-            await db_manager.mark_notification_processed(notification['notification_id'])
+        logger.error("Error handling card image delivery notification %s: %s", notification.get('notification_id'), e)
+        await handle_notification_failure(notification, e)
 
 
 
@@ -712,8 +826,20 @@ async def startup_database(application):
         asyncio.create_task(process_card_delivery_notifications(application))
         logging.info("Started card delivery notification processor")
         
+        # Send admin broadcasts queued by the order bot
+        asyncio.create_task(process_broadcasts(application, db_manager))
+        
+        # Archive processed notifications before the TTL index expires them
+        asyncio.create_task(run_notification_archiver(db_manager))
+        
+        # Log slow MongoDB queries with their plan summary
+        asyncio.create_task(process_slow_queries(db_manager))
+        
+        # Expose Prometheus metrics on a local port
+        await start_metrics_server(int(os.getenv('METRICS_PORT', '9101') or 0), db_manager)
+        
     except Exception as e:
-        logging.error(f"Failed to connect to database: {e}")
+        logging.error("Failed to connect to database: %s", e)
         raise
 
 
@@ -725,7 +851,7 @@ async def handle_order_status_notification(application, notification):
         message = data.get('message')
         
         if not user_id or not message:
-            logger.error(f"Invalid order status notification data: {data}")
+            logger.error("Invalid order status notification data: %s", data)
             await db_manager.mark_notification_processed(notification['notification_id'])
             return
         
@@ -737,10 +863,11 @@ async def handle_order_status_notification(application, notification):
         
         # Mark notification as processed
         await db_manager.mark_notification_processed(notification['notification_id'])
-        logger.info(f"Order status notification sent to user {user_id}")
+        logger.info("Order status notification sent to user %s", user_id)
         
     except Exception as e:
-        logger.error(f"Error handling order status notification {notification['notification_id']}: {e}")
+        logger.error("Error handling order status notification %s: %s", notification['notification_id'], e)
+        await handle_notification_failure(notification, e)
 
 
 async def handle_balance_notification(application, notification):
@@ -750,10 +877,10 @@ async def handle_balance_notification(application, notification):
         user_id = data.get('user_id')
         message = data.get('message')
         
-        logger.info(f"Processing balance notification for user {user_id}: {notification.get('notification_id')}")
+        logger.info("Processing balance notification for user %s: %s", user_id, notification.get('notification_id'))
         
         if not user_id or not message:
-            logger.error(f"Invalid balance notification data: {data}")
+            logger.error("Invalid balance notification data: %s", data)
             await db_manager.mark_notification_processed(notification['notification_id'])
             return
         
@@ -765,15 +892,11 @@ async def handle_balance_notification(application, notification):
         
         # Mark notification as processed
         await db_manager.mark_notification_processed(notification['notification_id'])
-        logger.info(f"Balance notification sent successfully to user {user_id}")
+        logger.info("Balance notification sent successfully to user %s", user_id)
         
     except Exception as e:
-        logger.error(f"Error handling balance notification {notification.get('notification_id')}: {e}")
-        # For certain errors (like user blocked bot), mark as processed to avoid infinite retry
-        error_str = str(e).lower()
-        if any(phrase in error_str for phrase in ['blocked', 'not found', 'forbidden', 'chat not found']):
-            logger.warning(f"User {user_id} appears to have blocked the bot or chat not found. Marking notification as processed.")
-            await db_manager.mark_notification_processed(notification['notification_id'])
+        logger.error("Error handling balance notification %s: %s", notification.get('notification_id'), e)
+        await handle_notification_failure(notification, e)
 
 
 async def handle_block_notification(application, notification):
@@ -784,7 +907,7 @@ async def handle_block_notification(application, notification):
         message = data.get('message')
         
         if not user_id or not message:
-            logger.error(f"Invalid block notification data: {data}")
+            logger.error("Invalid block notification data: %s", data)
             await db_manager.mark_notification_processed(notification['notification_id'])
             return
         
@@ -796,46 +919,66 @@ async def handle_block_notification(application, notification):
         
         # Mark notification as processed
         await db_manager.mark_notification_processed(notification['notification_id'])
-        logger.info(f"Block notification sent to user {user_id}")
+        logger.info("Block notification sent to user %s", user_id)
         
     except Exception as e:
-        logger.error(f"Error handling block notification {notification['notification_id']}: {e}")
+        logger.error("Error handling block notification %s: %s", notification['notification_id'], e)
+        await handle_notification_failure(notification, e)
 
 
 async def shutdown_database(application):
-    """Close database connection"""
+    """Stop the metrics endpoint and close database connection"""
+    await stop_metrics_server()
     await db_manager.disconnect()
     logging.info("Database disconnected")
 
-def main() -> None:
-    """Main function to start the bot"""
-    # Load environment variables
-    load_dotenv()
+def build_application(token: str, request: Optional[BaseRequest] = None) -> Application:
+    """Create the bot application with all its handlers (replay.py passes a stubbed request)"""
+    # Bot API calls are timed for the metrics endpoint
+    application = Application.builder().token(token).request(request or build_request()).build()
     
-    # Configure logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    # Add startup and shutdown handlers
+    application.post_init = startup_database
+    application.post_shutdown = shutdown_database
     
-    # Reduce httpx logging noise
-    logging.getLogger("httpx").setLevel(logging.WARNING)
+    # Record anonymized updates for replay benchmarks (UPDATE_RECORD_PATH)
+    register_update_recorder(application, os.getenv('UPDATE_RECORD_PATH'), 'bot', db_manager.owner_admin_id())
     
-    # Get bot token from environment or use default
-    TOKEN = os.getenv('BOT_TOKEN', "7857065897:AAGM-nDNhZ8DDaTFGTt3g4CDlHXb355K5ps")
+    # Remembered renders per message (RENDER_CACHE_SIZE)
+    render_cache.load_from_env()
     
-    # Create application
-    application = Application.builder().token(TOKEN).build()
+    # Measure MongoDB round-trips per update (runs before and after the handlers below)
+    register_update_instrumentation(application)
     
-    # Add startup and shutdown handlers
-    application.post_init = startup_database
-    application.post_shutdown = shutdown_database
+    # Drop updates from users over their rate limit before any database work
+    register_flood_control(application)
+    
+    # Ask the user to retry when an update runs out of database time
+    application.add_error_handler(deadline_error_handler)
     
     # Add command and message handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CallbackQueryHandler(button_handler))
     # Handle all text messages (non-commands) by directing users to /start
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_messages))
+    
+    return application
+
+
+def main() -> None:
+    """Main function to start the bot"""
+    # Load environment variables
+    load_dotenv()
+    
+    # Configure non-blocking logging
+    configure_logging()
+    
+    # One notification line per LOG_SAMPLE_EVERY is enough under load
+    add_sampling(logger, "Processing notification %s of type %s")
+    
+    # Get bot token from environment or use default
+    TOKEN = os.getenv('BOT_TOKEN', "7857065897:AAGM-nDNhZ8DDaTFGTt3g4CDlHXb355K5ps")
+    application = build_application(TOKEN)
 
     # Get webhook configuration
     WEBHOOK_URL = os.getenv('WEBHOOK_URL')
@@ -844,8 +987,8 @@ def main() -> None:
     
     if USE_WEBHOOKS and WEBHOOK_URL:
         # Run with webhooks
-        logging.info(f"Starting bot with webhooks on port {WEBHOOK_PORT}...")
-        logging.info(f"Webhook URL: {WEBHOOK_URL}")
+        logging.info("Starting bot with webhooks on port %s...", WEBHOOK_PORT)
+        logging.info("Webhook URL: %s", WEBHOOK_URL)
         
         application.run_webhook(
             listen="0.0.0.0",
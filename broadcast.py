@@ -0,0 +1,116 @@
+"""
+Broadcast engine delivering admin announcements to all users
+
+Broadcasts are queued by the order bot in the `broadcasts` collection and sent
+by the customer bot, the only one users have started. Users are paged in
+user_id order and the progress is checkpointed after every page, so a restart
+resumes where the previous run stopped.
+"""
+import os
+import asyncio
+import logging
+from typing import Dict, List
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+from metrics import broadcast_messages
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Send attempts per user before counting it as failed
+MAX_SEND_ATTEMPTS = 3
+
+
+def _retry_after_seconds(error: RetryAfter) -> float:
+    retry_after = error.retry_after
+    return retry_after.total_seconds() if hasattr(retry_after, 'total_seconds') else float(retry_after)
+
+
+async def send_broadcast_message(bot, user_id: int, text: str, bucket: TokenBucket) -> str:
+    """Send one broadcast message; returns delivered, blocked or failed"""
+    for attempt in range(1, MAX_SEND_ATTEMPTS + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+            return 'delivered'
+        except RetryAfter as e:
+            # Flood control applies to the whole bot, so every worker backs off
+            delay = _retry_after_seconds(e)
+            logger.warning("Broadcast hit flood control, pausing for %ss", delay)
+            bucket.pause(delay)
+        except Forbidden:
+            return 'blocked'
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower():
+                return 'blocked'
+            logger.error("Broadcast to user %s rejected: %s", user_id, e)
+            return 'failed'
+        except (TimedOut, NetworkError) as e:
+            logger.warning("Broadcast to user %s failed (attempt %s): %s", user_id, attempt, e)
+        except Exception as e:
+            logger.error("Broadcast to user %s failed: %s", user_id, e)
+            return 'failed'
+    return 'failed'
+
+
+async def send_page(bot, user_ids: List[int], text: str, bucket: TokenBucket, workers: int) -> Dict[str, int]:
+    """Send to a page of users through a pool of workers sharing the rate limit"""
+    queue: asyncio.Queue = asyncio.Queue()
+    for user_id in user_ids:
+        queue.put_nowait(user_id)
+    counts = {'delivered': 0, 'failed': 0, 'blocked': 0}
+
+    async def worker():
+        while True:
+            try:
+                user_id = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            result = await send_broadcast_message(bot, user_id, text, bucket)
+            counts[result] += 1
+            broadcast_messages.inc(result=result)
+
+    await asyncio.gather(*(worker() for _ in range(min(workers, len(user_ids)))))
+    return counts
+
+
+async def run_broadcast(bot, db_manager, broadcast: dict, bucket: TokenBucket, page_size: int, workers: int):
+    """Send a broadcast to every non-blacklisted user, resuming from its checkpoint"""
+    broadcast_id = broadcast['broadcast_id']
+    last_user_id = broadcast.get('last_user_id')
+    logger.info("Running broadcast %s from user_id %s", broadcast_id, last_user_id)
+
+    while True:
+        user_ids = await db_manager.get_broadcast_recipients(last_user_id, page_size)
+        if not user_ids:
+            await db_manager.finish_broadcast(broadcast_id)
+            logger.info("Broadcast %s completed", broadcast_id)
+            return
+
+        blacklisted = await db_manager.get_blacklisted_user_ids(user_ids)
+        recipients = [user_id for user_id in user_ids if user_id not in blacklisted]
+        counts = await send_page(bot, recipients, broadcast['text'], bucket, workers) if recipients else {}
+        counts['skipped'] = len(blacklisted)
+
+        last_user_id = user_ids[-1]
+        if not await db_manager.checkpoint_broadcast(broadcast_id, last_user_id, counts):
+            logger.info("Broadcast %s stopped at user_id %s", broadcast_id, last_user_id)
+            return
+
+
+async def process_broadcasts(application, db_manager, poll_interval: float = 5.0):
+    """Background task sending queued broadcasts one at a time"""
+    rate = float(os.getenv('BROADCAST_RATE', '25'))
+    workers = int(os.getenv('BROADCAST_WORKERS', '32'))
+    page_size = int(os.getenv('BROADCAST_PAGE_SIZE', '500'))
+    # One bucket for all broadcasts keeps the bot under Telegram's global limit
+    bucket = TokenBucket(rate, capacity=rate)
+
+    while True:
+        try:
+            broadcast = await db_manager.claim_broadcast()
+            if broadcast:
+                await run_broadcast(application.bot, db_manager, broadcast, bucket, page_size, workers)
+                continue
+        except Exception as e:
+            logger.error("Error in broadcast processing: %s", e)
+        await asyncio.sleep(poll_interval)
@@ -0,0 +1,126 @@
+"""
+Stale-while-revalidate snapshots for read-mostly catalog queries
+
+Catalog screens (countries, cards per country, black websites) are served from
+the last good snapshot and refreshed in the background. A circuit breaker stops
+hammering MongoDB while it is failing, so browsing keeps working from the
+snapshots and only the purchase path depends on the database being up.
+"""
+import time
+import asyncio
+import contextvars
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+from metrics import catalog_cache_requests, catalog_circuit_open
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitBreaker:
+    """Open after consecutive failures, let one trial call through after a cool-down"""
+
+    def __init__(self, name: str, failure_threshold: int = 3, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_running = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allow(self) -> bool:
+        """Whether a call may go to the database now"""
+        if self.opened_at is None:
+            return True
+        # Half-open: after the cool-down a single trial decides whether to close again
+        return time.monotonic() - self.opened_at >= self.reset_timeout and not self._trial_running
+
+    def before_call(self):
+        if self.opened_at is not None:
+            self._trial_running = True
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Circuit %s closed", self.name)
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        catalog_circuit_open.set(0, circuit=self.name)
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial_running = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                logger.warning("Circuit %s opened after %s failures", self.name, self.failures)
+            self.opened_at = time.monotonic()
+            catalog_circuit_open.set(1, circuit=self.name)
+
+
+class SnapshotCache:
+    """Keyed snapshots served fresh, stale with background revalidation, or reloaded when too old"""
+
+    def __init__(self, breaker: CircuitBreaker, fresh_seconds: float = 5.0, stale_seconds: float = 60.0,
+                 timeout: float = 1.0):
+        self.breaker = breaker
+        self.fresh_seconds = fresh_seconds
+        self.stale_seconds = stale_seconds
+        self.timeout = timeout
+        self._snapshots: Dict[str, Tuple[float, Any]] = {}
+        self._refreshing: Dict[str, asyncio.Task] = {}
+
+    async def get(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        """Get the snapshot for key; None when there is neither a snapshot nor a reachable database"""
+        kind = key.split(':', 1)[0]
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            age = time.monotonic() - snapshot[0]
+            if age < self.fresh_seconds:
+                catalog_cache_requests.inc(catalog=kind, result='fresh')
+                return snapshot[1]
+            if age < self.stale_seconds or not self.breaker.allow():
+                catalog_cache_requests.inc(catalog=kind, result='stale')
+                self._revalidate(key, loader)
+                return snapshot[1]
+            # Too old to show without trying the database first
+            value = await self._load(key, loader)
+            catalog_cache_requests.inc(catalog=kind, result='reload' if value is not None else 'stale')
+            return value if value is not None else snapshot[1]
+
+        if not self.breaker.allow():
+            catalog_cache_requests.inc(catalog=kind, result='unavailable')
+            return None
+        value = await self._load(key, loader)
+        catalog_cache_requests.inc(catalog=kind, result='miss' if value is not None else 'unavailable')
+        return value
+
+    def invalidate(self, key: str):
+        """Mark a snapshot stale so the next read revalidates it (the old value stays as a fallback)"""
+        snapshot = self._snapshots.get(key)
+        if snapshot is not None:
+            self._snapshots[key] = (float('-inf'), snapshot[1])
+
+    def _revalidate(self, key: str, loader: Callable[[], Awaitable[Any]]):
+        task = self._refreshing.get(key)
+        if task is not None and not task.done():
+            return
+        if not self.breaker.allow():
+            return
+        # A fresh context: the refresh is not bound by the deadline of the update that triggered it,
+        # nor counted in its stats
+        self._refreshing[key] = asyncio.create_task(self._load(key, loader), context=contextvars.Context())
+
+    async def _load(self, key: str, loader: Callable[[], Awaitable[Any]]) -> Optional[Any]:
+        self.breaker.before_call()
+        try:
+            value = await asyncio.wait_for(loader(), timeout=self.timeout)
+        except Exception as e:
+            self.breaker.record_failure()
+            logger.warning("Catalog query %s failed: %r", key, e)
+            return None
+        self.breaker.record_success()
+        self._snapshots[key] = (time.monotonic(), value)
+        return value
@@ -0,0 +1,141 @@
+"""
+Per-update deadlines and MongoDB time budgets
+
+Every update gets a deadline when it enters the application. Each
+DatabaseManager call runs inside pymongo's client-side timeout, set to the
+smaller of its method-class budget and the time left until the deadline, so a
+stalled query fails fast instead of holding the handler until Telegram gives up.
+"""
+import os
+import time
+import logging
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Optional
+import pymongo
+from pymongo.errors import PyMongoError
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+# Method classes with their own budget
+GATE = 'gate'
+CATALOG = 'catalog'
+PURCHASE = 'purchase'
+DEFAULT = 'default'
+
+DEFAULT_BUDGETS_MS = {
+    GATE: 300,
+    CATALOG: 1000,
+    PURCHASE: 3000,
+    DEFAULT: 2000,
+}
+
+DEFAULT_UPDATE_DEADLINE_MS = 8000
+
+TRY_AGAIN_TEXT = "⏳ الخدمة مشغولة حالياً، يرجى المحاولة مرة أخرى بعد لحظات."
+
+# Monotonic time by which the current update must be done (None outside updates)
+current_deadline: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('current_deadline', default=None)
+
+# Set while a multi-step write runs to its end without per-call budgets
+uninterrupted_steps: contextvars.ContextVar[bool] = contextvars.ContextVar('uninterrupted_steps', default=False)
+
+
+class DatabaseDeadlineExceeded(Exception):
+    """A database call ran out of its time budget"""
+
+
+def budget_seconds(method_class: str) -> float:
+    """Budget of a method class (DB_TIMEOUT_<CLASS>_MS)"""
+    default = DEFAULT_BUDGETS_MS.get(method_class, DEFAULT_BUDGETS_MS[DEFAULT])
+    return float(os.getenv(f'DB_TIMEOUT_{method_class.upper()}_MS', default)) / 1000
+
+
+def start_deadline(timeout_ms: float = None) -> None:
+    """Set the deadline of the update being handled (DB_UPDATE_DEADLINE_MS)"""
+    if timeout_ms is None:
+        timeout_ms = float(os.getenv('DB_UPDATE_DEADLINE_MS', DEFAULT_UPDATE_DEADLINE_MS))
+    current_deadline.set(time.monotonic() + timeout_ms / 1000)
+
+
+def clear_deadline() -> None:
+    current_deadline.set(None)
+
+
+def remaining_seconds() -> Optional[float]:
+    """Time left until the current update's deadline"""
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextmanager
+def db_budget(method_class: str):
+    """Run MongoDB operations under the method class budget capped by the update deadline"""
+    if uninterrupted_steps.get():
+        yield
+        return
+    timeout = budget_seconds(method_class)
+    remaining = remaining_seconds()
+    if remaining is not None:
+        if remaining <= 0:
+            raise DatabaseDeadlineExceeded("update deadline already passed")
+        timeout = min(timeout, remaining)
+    # pymongo derives maxTimeMS and socket timeouts from the remaining time
+    with pymongo.timeout(timeout):
+        yield
+
+
+@contextmanager
+def uninterrupted(method_class: Optional[str] = None):
+    """Check once that a method class budget is left (when given), then run the enclosed steps without per-call budgets
+
+    A deadline hit between two writes of a purchase (order created, balance not
+    yet debited) would leave it half done, so the time is checked up front and
+    the steps then finish like they did before deadlines. Without a method
+    class it lets clean-up run after the deadline has passed.
+    """
+    remaining = remaining_seconds()
+    if method_class is not None and remaining is not None and remaining < budget_seconds(method_class):
+        raise DatabaseDeadlineExceeded(f"less than the {method_class} budget left before the update deadline")
+    token = uninterrupted_steps.set(True)
+    try:
+        yield
+    finally:
+        uninterrupted_steps.reset(token)
+
+
+def reraise_deadline(error: Exception) -> None:
+    """Turn a pymongo timeout into DatabaseDeadlineExceeded so it is not swallowed as a normal failure"""
+    if isinstance(error, DatabaseDeadlineExceeded):
+        raise error
+    if isinstance(error, PyMongoError) and error.timeout:
+        raise DatabaseDeadlineExceeded(str(error)) from error
+
+
+def with_deadline(method_class: str):
+    """Decorate a DatabaseManager coroutine to run under a method class budget"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with db_budget(method_class):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+async def deadline_error_handler(update: object, context) -> None:
+    """Application error handler: ask the user to retry when the database ran out of time"""
+    error = context.error
+    if not isinstance(error, DatabaseDeadlineExceeded):
+        logger.error("Exception while handling an update", exc_info=error)
+        return
+
+    logger.warning("Database deadline exceeded while handling an update: %s", error)
+    if not isinstance(update, Update) or update.effective_chat is None:
+        return
+    try:
+        await context.bot.send_message(chat_id=update.effective_chat.id, text=TRY_AGAIN_TEXT)
+    except Exception as e:
+        logger.error("Error sending retry message: %s", e)
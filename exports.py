@@ -0,0 +1,171 @@
+"""
+Streaming exports of orders and transactions for the admin
+
+Rows are read through a batched cursor with a projection and handed to a worker
+thread one batch at a time, which encodes them into a temporary file (CSV, or
+Parquet when pyarrow is installed). Memory use stays at one batch whatever the
+size of the export, and the event loop keeps serving updates meanwhile.
+"""
+import os
+import csv
+import asyncio
+import logging
+import tempfile
+from datetime import datetime, UTC
+from typing import Any, Dict, List, Optional, Tuple
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet exports are optional
+    pa = None
+    pq = None
+
+logger = logging.getLogger(__name__)
+
+CSV = 'csv'
+PARQUET = 'parquet'
+
+# Exported columns with their types, and the field the date range applies to
+EXPORT_DATASETS: Dict[str, Dict[str, Any]] = {
+    'orders': {
+        'date_field': 'created_at',
+        'columns': [
+            ('order_id', str),
+            ('user_id', int),
+            ('card_id', str),
+            ('country_code', str),
+            ('amount', float),
+            ('status', str),
+            ('created_at', datetime),
+            ('updated_at', datetime),
+        ],
+    },
+    'transactions': {
+        'date_field': 'timestamp',
+        'columns': [
+            ('user_id', int),
+            ('seq', int),
+            ('type', str),
+            ('amount', float),
+            ('balance_after', float),
+            ('description', str),
+            ('status', str),
+            ('timestamp', datetime),
+        ],
+    },
+}
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def parquet_available() -> bool:
+    """Whether pyarrow is installed so Parquet exports can be offered"""
+    return pa is not None
+
+
+def _convert(value: Any, column_type: type) -> Any:
+    if value is None:
+        return None
+    try:
+        if column_type is datetime:
+            if not isinstance(value, datetime):
+                return None
+            # MongoDB returns naive UTC datetimes
+            return value if value.tzinfo is not None else value.replace(tzinfo=UTC)
+        return column_type(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CsvExportWriter:
+    """Write export rows to a CSV file"""
+
+    def __init__(self, path: str, columns: List[Tuple[str, type]]):
+        self.columns = columns
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([name for name, _ in columns])
+
+    def write_rows(self, docs: List[Dict[str, Any]]):
+        for doc in docs:
+            row = []
+            for name, column_type in self.columns:
+                value = _convert(doc.get(name), column_type)
+                row.append(value.isoformat() if isinstance(value, datetime) else value)
+            self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetExportWriter:
+    """Write export rows to a Parquet file, one row group per batch"""
+
+    ARROW_TYPES = {
+        str: lambda: pa.string(),
+        int: lambda: pa.int64(),
+        float: lambda: pa.float64(),
+        datetime: lambda: pa.timestamp('ms', tz='UTC'),
+    }
+
+    def __init__(self, path: str, columns: List[Tuple[str, type]]):
+        self.columns = columns
+        self.schema = pa.schema([(name, self.ARROW_TYPES[column_type]()) for name, column_type in columns])
+        self.writer = pq.ParquetWriter(path, self.schema)
+
+    def write_rows(self, docs: List[Dict[str, Any]]):
+        data = {
+            name: [_convert(doc.get(name), column_type) for doc in docs]
+            for name, column_type in self.columns
+        }
+        self.writer.write_table(pa.table(data, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+async def export_dataset(db_manager, dataset: str, start: Optional[datetime], end: Optional[datetime],
+                         export_format: str = CSV, batch_size: int = DEFAULT_BATCH_SIZE) -> Tuple[str, int]:
+    """Export a dataset for [start, end) into a temporary file; returns its path and the row count"""
+    spec = EXPORT_DATASETS[dataset]
+    columns = spec['columns']
+    date_field = spec['date_field']
+    if export_format == PARQUET and not parquet_available():
+        raise ValueError("Parquet exports need pyarrow")
+
+    date_range = {}
+    if start is not None:
+        date_range['$gte'] = start
+    if end is not None:
+        date_range['$lt'] = end
+    query = {date_field: date_range} if date_range else {}
+    projection = {name: 1 for name, _ in columns}
+    projection['_id'] = 0
+
+    fd, path = tempfile.mkstemp(prefix=f'{dataset}_', suffix=f'.{export_format}')
+    os.close(fd)
+    writer_class = ParquetExportWriter if export_format == PARQUET else CsvExportWriter
+    writer = await asyncio.to_thread(writer_class, path, columns)
+
+    rows = 0
+    try:
+        cursor = getattr(db_manager, dataset).find(query, projection).sort(date_field, 1).batch_size(batch_size)
+        batch = []
+        async for doc in cursor:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                await asyncio.to_thread(writer.write_rows, batch)
+                rows += len(batch)
+                batch = []
+        if batch:
+            await asyncio.to_thread(writer.write_rows, batch)
+            rows += len(batch)
+    except BaseException:
+        await asyncio.to_thread(writer.close)
+        os.remove(path)
+        raise
+    await asyncio.to_thread(writer.close)
+
+    logger.info("Exported %s %s rows to %s", rows, dataset, path)
+    return path, rows
@@ -0,0 +1,105 @@
+"""
+Per-user flood control for the customer bot
+
+A pre-handler takes a token from the user's bucket for the kind of update
+(catalog browsing, purchase confirmations, typed messages) before any
+business handler runs. Updates over the limit are dropped with at most a
+cheap callback answer, so a user hammering buttons costs no MongoDB queries
+and cannot slow the bot down for everyone else.
+"""
+import os
+import logging
+from typing import Dict, Optional, Tuple
+from cachetools import LRUCache
+from telegram import Update
+from telegram.ext import Application, ApplicationHandlerStop, ContextTypes, TypeHandler
+from metrics import flood_throttled
+from monitoring import discard_update
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Runs after the instrumentation pre-handler (group -2) and before the business handlers (group 0)
+FLOOD_CONTROL_GROUP = -1
+
+CATALOG = 'catalog'
+PURCHASE = 'purchase'
+MESSAGE = 'message'
+
+# Callback prefixes that spend money and get the stricter purchase limit
+PURCHASE_PREFIXES = ('confirm_',)
+
+# (tokens per second, burst) per limit, overridable with FLOOD_<LIMIT>_RATE / FLOOD_<LIMIT>_BURST
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    CATALOG: (2.0, 8.0),
+    PURCHASE: (0.5, 2.0),
+    MESSAGE: (1.0, 5.0),
+}
+
+THROTTLED_TEXT = "⏳ يرجى التمهل قليلاً..."
+
+
+def update_limit(update: Update) -> Optional[str]:
+    """The limit an update counts against (None for updates that are not throttled)"""
+    if update.callback_query is not None:
+        data = update.callback_query.data or ''
+        return PURCHASE if data.startswith(PURCHASE_PREFIXES) else CATALOG
+    if update.message is not None:
+        return MESSAGE
+    return None
+
+
+class FloodControl:
+    """Token bucket per (user, limit)"""
+
+    def __init__(self, limits: Dict[str, Tuple[float, float]] = None, maxsize: int = 50000):
+        self.limits = dict(limits or DEFAULT_LIMITS)
+        # Evicted buckets belong to users idle long enough to have refilled anyway
+        self._buckets: LRUCache = LRUCache(maxsize=maxsize)
+
+    def load_from_env(self):
+        """Load the limits from FLOOD_<LIMIT>_RATE / FLOOD_<LIMIT>_BURST environment variables"""
+        for name, (rate, burst) in list(self.limits.items()):
+            self.limits[name] = (
+                float(os.getenv(f'FLOOD_{name.upper()}_RATE', str(rate))),
+                float(os.getenv(f'FLOOD_{name.upper()}_BURST', str(burst))),
+            )
+
+    def allow(self, user_id: int, limit: str) -> bool:
+        """Take a token for the user, False when they are over the limit"""
+        rate, burst = self.limits[limit]
+        if rate <= 0:
+            return True
+        key = (user_id, limit)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+        return bucket.try_acquire()
+
+
+flood_control = FloodControl()
+
+
+async def flood_guard(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pre-handler: stop the update here when its user is over the limit"""
+    if not isinstance(update, Update) or update.effective_user is None:
+        return
+    limit = update_limit(update)
+    if limit is None or flood_control.allow(update.effective_user.id, limit):
+        return
+
+    flood_throttled.inc(limit=limit)
+    logger.debug("Throttled %s update from user %s", limit, update.effective_user.id)
+    discard_update()
+    if update.callback_query is not None:
+        try:
+            await update.callback_query.answer(THROTTLED_TEXT)
+        except Exception as e:
+            logger.debug("Error answering throttled callback: %s", e)
+    raise ApplicationHandlerStop
+
+
+def register_flood_control(application: Application) -> None:
+    """Throttle every user's updates before they reach the business handlers"""
+    flood_control.load_from_env()
+    application.add_handler(TypeHandler(Update, flood_guard), group=FLOOD_CONTROL_GROUP)
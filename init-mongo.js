@@ -12,24 +12,49 @@ db.createCollection('notifications');
 db.createCollection('black_websites');
 db.createCollection('support_conversations');
 db.createCollection('support_stats');
+db.createCollection('dead_letters');
+db.createCollection('notifications_archive');
+db.createCollection('broadcasts');
+db.createCollection('balance_snapshots');
+db.createCollection('admins');
+db.createCollection('idempotency_keys');
 
 // Create indexes for better performance
 db.users.createIndex({ "user_id": 1 }, { unique: true });
 db.users.createIndex({ "username": 1 });
+db.users.createIndex({ "username_lower": 1 });
+db.users.createIndex({ "first_name": "text", "last_name": "text" }, { name: "user_names_text", default_language: "none" });
 db.cards.createIndex({ "card_id": 1 }, { unique: true });
 db.cards.createIndex({ "country_code": 1 });
 db.cards.createIndex({ "is_available": 1 });
 db.transactions.createIndex({ "user_id": 1 });
 db.transactions.createIndex({ "timestamp": 1 });
+// Ledger entries in per-user order, and the balance snapshots statements start from
+db.transactions.createIndex({ "user_id": 1, "seq": 1 }, { unique: true, partialFilterExpression: { "seq": { "$exists": true } } });
+db.balance_snapshots.createIndex({ "user_id": 1, "seq": -1 }, { unique: true });
+db.admins.createIndex({ "user_id": 1 }, { unique: true });
+// Purchase idempotency keys expire after 10 minutes
+db.idempotency_keys.createIndex({ "created_at": 1 }, { expireAfterSeconds: 600 });
 db.blacklist.createIndex({ "user_id": 1 }, { unique: true });
 db.countries.createIndex({ "code": 1 }, { unique: true });
 db.orders.createIndex({ "user_id": 1 });
 db.orders.createIndex({ "status": 1 });
 db.orders.createIndex({ "created_at": 1 });
+db.orders.createIndex({ "idempotency_key": 1 }, { sparse: true });
 db.notifications.createIndex({ "notification_id": 1 }, { unique: true });
 db.notifications.createIndex({ "status": 1 });
 db.notifications.createIndex({ "type": 1 });
 db.notifications.createIndex({ "created_at": 1 });
+db.notifications.createIndex({ "status": 1, "created_at": 1 });
+db.notifications.createIndex({ "status": 1, "priority": 1, "created_at": 1 });
+// Processed notifications expire after NOTIFICATION_RETENTION_HOURS (24h by default)
+db.notifications.createIndex({ "processed_at": 1 }, { name: "processed_at_ttl", expireAfterSeconds: 86400 });
+db.dead_letters.createIndex({ "notification_id": 1 }, { unique: true });
+db.dead_letters.createIndex({ "dead_at": 1 });
+db.notifications_archive.createIndex({ "notification_id": 1 }, { unique: true });
+db.notifications_archive.createIndex({ "processed_at": 1 });
+db.broadcasts.createIndex({ "broadcast_id": 1 }, { unique: true });
+db.broadcasts.createIndex({ "status": 1, "created_at": 1 });
 db.black_websites.createIndex({ "website_id": 1 }, { unique: true });
 db.black_websites.createIndex({ "is_available": 1 });
 db.black_websites.createIndex({ "is_deleted": 1 });
@@ -47,6 +72,7 @@ db.users.insertMany([
     {
         user_id: 123456789,
         username: "sample_user",
+        username_lower: "sample_user",
         first_name: "Sample",
         last_name: "User",
         balance: 0.0,
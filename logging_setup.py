@@ -0,0 +1,75 @@
+"""
+Non-blocking logging setup shared by both bots
+"""
+import os
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+from typing import Dict, Optional, Iterable
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+class SamplingFilter(logging.Filter):
+    """Let through only one in every N records per message template"""
+
+    def __init__(self, messages: Iterable[str], every: int):
+        super().__init__()
+        self.messages = set(messages)
+        self.every = max(1, every)
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        # Warnings and errors are never sampled away
+        if self.every == 1 or record.levelno >= logging.WARNING or record.msg not in self.messages:
+            return True
+        with self._lock:
+            count = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = count + 1
+        return count % self.every == 0
+
+
+def add_sampling(logger: logging.Logger, *messages: str) -> SamplingFilter:
+    """Sample the given high-volume message templates on a logger (LOG_SAMPLE_EVERY)"""
+    sampling_filter = SamplingFilter(messages, int(os.getenv('LOG_SAMPLE_EVERY', '10')))
+    logger.addFilter(sampling_filter)
+    return sampling_filter
+
+
+def configure_logging() -> None:
+    """Route all log records through a queue drained by a background thread"""
+    global _listener
+    if _listener is not None:
+        return
+
+    level = getattr(logging, os.getenv('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # Handlers on the event loop thread only enqueue the record
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+    # Reduce httpx logging noise
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging() -> None:
+    """Flush queued records and stop the background thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,143 @@
+"""
+Maintenance jobs and one-off data migrations for the bot database
+
+Usage:
+    python maintenance.py backfill-retention
+    python maintenance.py backfill-search
+    python maintenance.py reconcile
+"""
+import os
+import sys
+import asyncio
+import logging
+import argparse
+from datetime import datetime, timedelta, UTC
+from dotenv import load_dotenv
+from database import db_manager
+from logging_setup import configure_logging
+from reconciliation import reconcile, format_report
+from metrics import orders_expired
+
+logger = logging.getLogger(__name__)
+
+
+def archive_enabled() -> bool:
+    """Whether processed notifications are archived before the TTL index removes them"""
+    return os.getenv('NOTIFICATION_ARCHIVE_ENABLED', 'true').lower() == 'true'
+
+
+def archive_after() -> timedelta:
+    """Age after which a processed notification is moved to the archive"""
+    return timedelta(minutes=float(os.getenv('NOTIFICATION_ARCHIVE_AFTER_MINUTES', '60')))
+
+
+async def run_notification_archiver(db_manager, interval: float = 300.0):
+    """Background task moving processed notifications to the compressed archive"""
+    if not archive_enabled():
+        logger.info("Notification archive disabled, processed notifications expire via TTL only")
+        return
+    while True:
+        try:
+            # Drain in batches, then wait for the next round
+            while await db_manager.archive_processed_notifications(archive_after()):
+                await asyncio.sleep(0)
+        except Exception as e:
+            logger.error("Error in notification archiver: %s", e)
+        await asyncio.sleep(interval)
+
+
+def order_expiry_after() -> timedelta:
+    """Age after which a pending order is cancelled and refunded (0 disables expiry)"""
+    return timedelta(minutes=float(os.getenv('ORDER_EXPIRY_MINUTES', '60')))
+
+
+async def expire_pending_orders(context) -> None:
+    """JobQueue callback cancelling pending orders past the SLA in batches"""
+    batch_size = int(os.getenv('ORDER_EXPIRY_BATCH_SIZE', '100'))
+    created_before = datetime.now(UTC) - order_expiry_after()
+    try:
+        while True:
+            expired = await db_manager.expire_pending_orders(created_before, batch_size)
+            orders_expired.inc(len(expired))
+            if len(expired) < batch_size:
+                break
+    except Exception as e:
+        logger.error("Error expiring pending orders: %s", e)
+
+
+def schedule_order_expiry(application) -> None:
+    """Run expire_pending_orders on the application's JobQueue"""
+    if order_expiry_after() <= timedelta(0):
+        logger.info("Pending order expiry disabled")
+        return
+    if application.job_queue is None:
+        logger.warning("JobQueue unavailable (install python-telegram-bot[job-queue]), pending orders will not expire")
+        return
+    interval = float(os.getenv('ORDER_EXPIRY_INTERVAL_SECONDS', '60'))
+    application.job_queue.run_repeating(expire_pending_orders, interval=interval, first=interval, name="order_expiry")
+    logger.info("Expiring pending orders older than %s every %ss", order_expiry_after(), interval)
+
+
+async def backfill_retention():
+    """Bring existing notifications under the retention policy"""
+    # connect() also builds the TTL index on processed_at
+    await db_manager.connect()
+    try:
+        backfilled = await db_manager.backfill_processed_at()
+        logger.info("Set processed_at on %s processed notifications", backfilled)
+
+        if archive_enabled():
+            total = 0
+            while True:
+                archived = await db_manager.archive_processed_notifications(archive_after(), batch_size=500)
+                if not archived:
+                    break
+                total += archived
+            logger.info("Archived %s processed notifications", total)
+    finally:
+        await db_manager.disconnect()
+
+
+async def backfill_search():
+    """Prepare existing users for the admin user search"""
+    # connect() also builds the username_lower and name text indexes
+    await db_manager.connect()
+    try:
+        backfilled = await db_manager.backfill_username_lower()
+        logger.info("Set username_lower on %s users", backfilled)
+    finally:
+        await db_manager.disconnect()
+
+
+async def reconcile_balances():
+    """Check every balance against the ledger and orders"""
+    await db_manager.connect()
+    try:
+        report = await reconcile(db_manager)
+        print(format_report(report))
+    finally:
+        await db_manager.disconnect()
+
+
+COMMANDS = {
+    'backfill-retention': backfill_retention,
+    'backfill-search': backfill_search,
+    'reconcile': reconcile_balances,
+}
+
+
+def main() -> int:
+    """Run a maintenance command"""
+    load_dotenv()
+    configure_logging()
+
+    parser = argparse.ArgumentParser(description="Bot database maintenance")
+    parser.add_argument('command', choices=sorted(COMMANDS))
+    args = parser.parse_args()
+
+    asyncio.run(COMMANDS[args.command]())
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,354 @@
+"""
+Prometheus-compatible metrics for the Telegram bots
+"""
+import os
+import time
+import asyncio
+import logging
+import threading
+from datetime import UTC
+from typing import Optional, Dict, Tuple, List, Set
+from pymongo import monitoring
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...], extra: str = "") -> str:
+    """Format a label set in the Prometheus text format"""
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(label_names, label_values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metric:
+    """Base class for a labelled metric family"""
+    metric_type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._values: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        with self._lock:
+            items = list(self._values.items())
+        for label_values, value in items:
+            lines.extend(self._render_sample(label_values, value))
+        return lines
+
+    def _render_sample(self, label_values, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.label_names, label_values)} {value}"]
+
+
+class Counter(Metric):
+    """Monotonically increasing counter"""
+    metric_type = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(Metric):
+    """Value that can go up and down"""
+    metric_type = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(Metric):
+    """Cumulative histogram with fixed buckets"""
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: Tuple[str, ...] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["buckets"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def _render_sample(self, label_values, series) -> List[str]:
+        lines = []
+        for bound, bucket_count in zip(self.buckets, series["buckets"]):
+            labels = _format_labels(self.label_names, label_values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {bucket_count}")
+        labels = _format_labels(self.label_names, label_values, 'le="+Inf"')
+        lines.append(f"{self.name}_bucket{labels} {series['count']}")
+        labels = _format_labels(self.label_names, label_values)
+        lines.append(f"{self.name}_sum{labels} {series['sum']}")
+        lines.append(f"{self.name}_count{labels} {series['count']}")
+        return lines
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+handler_latency = registry.register(Histogram(
+    "bot_handler_latency_seconds", "Time spent handling an update", ("prefix",)
+))
+notification_queue_depth = registry.register(Gauge(
+    "bot_notification_queue_depth", "Pending notifications", ("type",)
+))
+notification_queue_age = registry.register(Gauge(
+    "bot_notification_queue_oldest_age_seconds", "Age of the oldest pending notification", ("type",)
+))
+telegram_api_latency = registry.register(Histogram(
+    "bot_telegram_api_latency_seconds", "Telegram Bot API call latency", ("method",)
+))
+telegram_api_errors = registry.register(Counter(
+    "bot_telegram_api_errors_total", "Failed Telegram Bot API calls", ("method",)
+))
+notification_lane_age = registry.register(Gauge(
+    "bot_notification_lane_oldest_age_seconds", "Age of the oldest due notification per priority lane", ("lane",)
+))
+notification_delivery_latency = registry.register(Histogram(
+    "bot_notification_delivery_latency_seconds", "Time from notification creation to dispatch", ("lane",)
+))
+notifications_coalesced = registry.register(Counter(
+    "bot_notifications_coalesced_total", "Notifications merged into another before sending", ("type",)
+))
+broadcast_messages = registry.register(Counter(
+    "bot_broadcast_messages_total", "Broadcast messages by delivery result", ("result",)
+))
+flood_throttled = registry.register(Counter(
+    "bot_flood_throttled_total", "Updates dropped by per-user flood control", ("limit",)
+))
+render_cache_requests = registry.register(Counter(
+    "bot_render_cache_requests_total", "Callback message edits by whether the render was already shown", ("result",)
+))
+orders_expired = registry.register(Counter(
+    "bot_orders_expired_total", "Pending orders cancelled and refunded after the expiry SLA"
+))
+catalog_cache_requests = registry.register(Counter(
+    "bot_catalog_cache_requests_total", "Catalog reads by snapshot outcome", ("catalog", "result")
+))
+catalog_circuit_open = registry.register(Gauge(
+    "bot_catalog_circuit_open", "Whether the catalog circuit breaker is open", ("circuit",)
+))
+mongodb_pool_connections = registry.register(Gauge(
+    "bot_mongodb_pool_connections", "Open MongoDB connections", ("address",)
+))
+mongodb_pool_checked_out = registry.register(Gauge(
+    "bot_mongodb_pool_checked_out", "MongoDB connections currently in use", ("address",)
+))
+mongodb_pool_max_size = registry.register(Gauge(
+    "bot_mongodb_pool_max_size", "Configured maximum MongoDB pool size"
+))
+event_loop_lag = registry.register(Histogram(
+    "bot_event_loop_lag_seconds", "Delay of the event loop in waking up a sleeping task",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+))
+
+
+class MongoPoolListener(monitoring.ConnectionPoolListener):
+    """pymongo pool listener exporting connection pool utilization"""
+
+    def _address(self, event) -> str:
+        host, port = event.address
+        return f"{host}:{port}"
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        mongodb_pool_connections.set(0, address=self._address(event))
+        mongodb_pool_checked_out.set(0, address=self._address(event))
+
+    def connection_created(self, event):
+        mongodb_pool_connections.inc(1, address=self._address(event))
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        mongodb_pool_connections.inc(-1, address=self._address(event))
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        pass
+
+    def connection_checked_out(self, event):
+        mongodb_pool_checked_out.inc(1, address=self._address(event))
+
+    def connection_checked_in(self, event):
+        mongodb_pool_checked_out.inc(-1, address=self._address(event))
+
+
+mongo_pool_listener = MongoPoolListener()
+
+
+class InstrumentedHTTPXRequest(HTTPXRequest):
+    """HTTPXRequest recording latency and errors of every Bot API call"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs) -> Tuple[int, bytes]:
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            telegram_api_errors.inc(method=api_method)
+            raise
+        finally:
+            telegram_api_latency.observe(time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            telegram_api_errors.inc(method=api_method)
+        return code, payload
+
+
+def build_request() -> InstrumentedHTTPXRequest:
+    """Build the instrumented request used for Bot API calls (same pool size as PTB's default)"""
+    return InstrumentedHTTPXRequest(connection_pool_size=256)
+
+
+async def monitor_event_loop_lag(interval: float = 0.5):
+    """Background task measuring how late the event loop wakes up sleeping tasks"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        event_loop_lag.observe(max(0.0, loop.time() - started - interval))
+
+
+async def collect_notification_queue_metrics(db_manager, interval: float = 15.0):
+    """Background task sampling notification queue depth and age by type"""
+    while True:
+        try:
+            stats = await db_manager.get_pending_notification_stats()
+            now = time.time()
+            notification_queue_depth.clear()
+            notification_queue_age.clear()
+            for row in stats:
+                notification_queue_depth.set(row['count'], type=row['type'])
+                oldest = row.get('oldest_created_at')
+                if oldest is not None:
+                    # MongoDB returns naive datetimes holding UTC
+                    if oldest.tzinfo is None:
+                        oldest = oldest.replace(tzinfo=UTC)
+                    notification_queue_age.set(max(0.0, now - oldest.timestamp()), type=row['type'])
+        except Exception as e:
+            logger.error("Error collecting notification queue metrics: %s", e)
+        await asyncio.sleep(interval)
+
+
+async def _handle_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Serve GET /metrics over a minimal HTTP/1.0 exchange"""
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Drain the request headers
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if line in (b"\r\n", b"\n", b""):
+                break
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split('?')[0] == "/metrics":
+            body = registry.render().encode()
+            status = "200 OK"
+        else:
+            body = b"Not Found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.debug("Error serving metrics request: %s", e)
+    finally:
+        writer.close()
+
+
+# The running endpoint and its sampler tasks, referenced so the loop does not collect them and stopped on shutdown
+_metrics_server: Optional[asyncio.AbstractServer] = None
+_sampler_tasks: Set[asyncio.Task] = set()
+
+
+async def start_metrics_server(port: Optional[int], db_manager=None) -> Optional[asyncio.AbstractServer]:
+    """Start the metrics endpoint and its background samplers (disabled when port is empty or 0)"""
+    global _metrics_server
+    if not port:
+        logger.info("Metrics endpoint disabled")
+        return None
+    host = os.getenv('METRICS_HOST', '127.0.0.1')
+    _metrics_server = await asyncio.start_server(_handle_metrics_request, host, port)
+    _sampler_tasks.add(asyncio.create_task(monitor_event_loop_lag()))
+    if db_manager is not None:
+        _sampler_tasks.add(asyncio.create_task(collect_notification_queue_metrics(db_manager)))
+    logger.info("Metrics endpoint listening on http://%s:%s/metrics", host, port)
+    return _metrics_server
+
+
+async def stop_metrics_server():
+    """Cancel the background samplers and close the metrics endpoint (no-op when it was not started)"""
+    global _metrics_server
+    tasks = list(_sampler_tasks)
+    _sampler_tasks.clear()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if _metrics_server is not None:
+        _metrics_server.close()
+        await _metrics_server.wait_closed()
+        _metrics_server = None
@@ -0,0 +1,416 @@
+"""
+Request-scoped MongoDB instrumentation for the Telegram bots
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+from collections import deque
+from typing import Optional, Dict, Any, List, Awaitable
+import bson
+from pymongo import monitoring
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+from metrics import handler_latency
+from deadlines import start_deadline, clear_deadline, uninterrupted_steps
+
+logger = logging.getLogger(__name__)
+
+# Handler groups used to wrap every update (business handlers live in group 0,
+# flood control in group -1)
+PRE_HANDLER_GROUP = -2
+POST_HANDLER_GROUP = 100
+
+# Stats of the update currently being handled (None outside of update handling)
+current_update_stats: contextvars.ContextVar[Optional["UpdateStats"]] = contextvars.ContextVar(
+    "current_update_stats", default=None
+)
+
+
+def callback_prefix(data: str) -> str:
+    """Reduce callback data to its stable prefix (e.g. 'pending_order_64f...' -> 'pending_order')"""
+    parts = []
+    for part in data.split('_'):
+        # Stop at the first segment that looks like an identifier (digits, codes, ids)
+        if not part.isalpha() or not part.islower():
+            break
+        parts.append(part)
+    return '_'.join(parts) or 'unknown'
+
+
+def update_label(update: object) -> str:
+    """Get the label used to aggregate stats for an update"""
+    if not isinstance(update, Update):
+        return 'other'
+    if update.callback_query and update.callback_query.data:
+        return callback_prefix(update.callback_query.data)
+    message = update.message
+    if message:
+        if message.text and message.text.startswith('/'):
+            return f"command:{message.text.split()[0].split('@')[0]}"
+        if message.photo:
+            return 'message:photo'
+        if message.text:
+            return 'message:text'
+        return 'message:other'
+    return 'other'
+
+
+class UpdateStats:
+    """MongoDB usage accumulated while handling a single update"""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.started_at = time.perf_counter()
+        self.commands = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.db_time_ms = 0.0
+        self.command_names: Dict[str, int] = {}
+        # Listener callbacks run on motor's executor threads
+        self._lock = threading.Lock()
+
+    def record(self, command_name: str, duration_ms: float, bytes_sent: int, bytes_received: int):
+        """Record one finished MongoDB command"""
+        with self._lock:
+            self.commands += 1
+            self.db_time_ms += duration_ms
+            self.bytes_sent += bytes_sent
+            self.bytes_received += bytes_received
+            self.command_names[command_name] = self.command_names.get(command_name, 0) + 1
+
+    @property
+    def elapsed_ms(self) -> float:
+        return (time.perf_counter() - self.started_at) * 1000
+
+
+class UpdateCommandListener(monitoring.CommandListener):
+    """pymongo command listener that attributes commands to the current update"""
+
+    def __init__(self):
+        self._in_flight: Dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def started(self, event):
+        stats = current_update_stats.get()
+        if stats is None:
+            return
+        with self._lock:
+            self._in_flight[(event.connection_id, event.request_id)] = (stats, len(bson.encode(event.command)))
+
+    def succeeded(self, event):
+        with self._lock:
+            entry = self._in_flight.pop((event.connection_id, event.request_id), None)
+        if entry:
+            stats, bytes_sent = entry
+            stats.record(event.command_name, event.duration_micros / 1000, bytes_sent, len(bson.encode(event.reply)))
+
+    def failed(self, event):
+        with self._lock:
+            entry = self._in_flight.pop((event.connection_id, event.request_id), None)
+        if entry:
+            stats, bytes_sent = entry
+            stats.record(event.command_name, event.duration_micros / 1000, bytes_sent, 0)
+
+
+class UpdateBudget:
+    """Per-update MongoDB budget and per-prefix aggregates"""
+
+    def __init__(self, max_commands: int = 8, max_db_ms: float = 250.0, max_bytes: int = 1024 * 1024):
+        self.max_commands = max_commands
+        self.max_db_ms = max_db_ms
+        self.max_bytes = max_bytes
+        self.prefix_totals: Dict[str, Dict[str, float]] = {}
+        self.violations = deque(maxlen=50)
+
+    def load_from_env(self):
+        """Load budget limits from DB_BUDGET_* environment variables"""
+        self.max_commands = int(os.getenv('DB_BUDGET_COMMANDS', str(self.max_commands)))
+        self.max_db_ms = float(os.getenv('DB_BUDGET_MS', str(self.max_db_ms)))
+        self.max_bytes = int(os.getenv('DB_BUDGET_BYTES', str(self.max_bytes)))
+
+    def observe(self, stats: UpdateStats) -> bool:
+        """Aggregate a finished update and report it if it exceeded the budget"""
+        totals = self.prefix_totals.setdefault(stats.label, {
+            "updates": 0, "commands": 0, "db_ms": 0.0, "bytes": 0, "over_budget": 0
+        })
+        total_bytes = stats.bytes_sent + stats.bytes_received
+        totals["updates"] += 1
+        totals["commands"] += stats.commands
+        totals["db_ms"] += stats.db_time_ms
+        totals["bytes"] += total_bytes
+
+        over_budget = (
+            stats.commands > self.max_commands
+            or stats.db_time_ms > self.max_db_ms
+            or total_bytes > self.max_bytes
+        )
+        if over_budget:
+            totals["over_budget"] += 1
+            self.violations.append({
+                "label": stats.label,
+                "commands": stats.commands,
+                "db_ms": round(stats.db_time_ms, 1),
+                "bytes": total_bytes,
+                "elapsed_ms": round(stats.elapsed_ms, 1),
+                "command_names": dict(stats.command_names),
+                "at": time.time()
+            })
+            logger.warning(
+                "Update '%s' exceeded DB budget: %s commands (max %s), %.1fms in MongoDB (max %.0fms), "
+                "%s bytes (max %s) - %s",
+                stats.label, stats.commands, self.max_commands, stats.db_time_ms, self.max_db_ms,
+                total_bytes, self.max_bytes, stats.command_names
+            )
+        return over_budget
+
+    def get_prefix_totals(self) -> List[Dict[str, Any]]:
+        """Get per-prefix aggregates sorted by total MongoDB time"""
+        rows = [{"label": label, **totals} for label, totals in self.prefix_totals.items()]
+        return sorted(rows, key=lambda row: row["db_ms"], reverse=True)
+
+
+# Latency histogram bucket upper bounds in milliseconds (last bucket is +Inf)
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Commands worth tracking, mapped to the field holding their filter
+SHAPE_FILTER_FIELDS = {
+    "find": "filter",
+    "count": "query",
+    "distinct": "query",
+    "findAndModify": "query",
+    "aggregate": "pipeline",
+    "update": "updates",
+    "delete": "deletes",
+    "insert": None,
+    "getMore": None,
+}
+
+# Commands that MongoDB can explain
+EXPLAINABLE_COMMANDS = {"find", "count", "distinct", "findAndModify", "aggregate", "update", "delete"}
+
+
+def normalize_filter(value: Any) -> Any:
+    """Strip literal values from a filter so that queries group by shape"""
+    if isinstance(value, dict):
+        return {key: normalize_filter(item) for key, item in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        if value and all(isinstance(item, dict) for item in value):
+            return [normalize_filter(item) for item in value]
+        # Lists of literals ($in, $nin, ...) collapse into one placeholder
+        return "?"
+    return "?"
+
+
+def command_shape(command_name: str, command: Dict[str, Any]) -> Optional[str]:
+    """Get the normalized shape of a command, or None for commands that are not tracked"""
+    if command_name not in SHAPE_FILTER_FIELDS:
+        return None
+    collection = command.get("collection") if command_name == "getMore" else command.get(command_name)
+    field = SHAPE_FILTER_FIELDS[command_name]
+    if field is None:
+        return f"{command_name} {collection}"
+    value = command.get(field, {})
+    if command_name == "update":
+        value = {"q": value[0].get("q", {}), "u": value[0].get("u", {})} if value else {}
+    elif command_name == "delete":
+        value = value[0].get("q", {}) if value else {}
+    shape = json.dumps(normalize_filter(value), ensure_ascii=False, separators=(',', ':'))
+    if command_name == "find" and command.get("sort"):
+        shape += f" sort={list(command['sort'])}"
+    return f"{command_name} {collection} {shape}"
+
+
+def plan_summary(explain_result: Dict[str, Any]) -> str:
+    """Summarize the winning plan of an explain result (e.g. 'FETCH > IXSCAN(status_1)')"""
+    planner = explain_result.get("queryPlanner")
+    if planner is None:
+        # Aggregations report the planner inside their first stage
+        for stage in explain_result.get("stages", []):
+            cursor_stage = stage.get("$cursor")
+            if cursor_stage:
+                planner = cursor_stage.get("queryPlanner")
+                break
+    if not planner:
+        return "n/a"
+    plan = planner.get("winningPlan", {})
+    plan = plan.get("queryPlan", plan)
+    stages = []
+    while plan:
+        stage = plan.get("stage", "?")
+        if plan.get("indexName"):
+            stage += f"({plan['indexName']})"
+        stages.append(stage)
+        plan = plan.get("inputStage") or (plan.get("inputStages") or [None])[0]
+    return " > ".join(stages) or "n/a"
+
+
+class ShapeStats:
+    """Latency histogram of one command shape"""
+
+    def __init__(self, shape: str):
+        self.shape = shape
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.failures = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.plan = None
+
+    def observe(self, duration_ms: float, failed: bool = False):
+        """Record one command execution"""
+        self.count += 1
+        self.total_ms += duration_ms
+        self.max_ms = max(self.max_ms, duration_ms)
+        if failed:
+            self.failures += 1
+        for index, bound in enumerate(LATENCY_BUCKETS_MS):
+            if duration_ms <= bound:
+                self.buckets[index] += 1
+                return
+        self.buckets[-1] += 1
+
+    def percentile(self, fraction: float) -> float:
+        """Estimate a latency percentile as the upper bound of its histogram bucket"""
+        target = self.count * fraction
+        seen = 0
+        for index, bucket_count in enumerate(self.buckets[:-1]):
+            seen += bucket_count
+            if seen >= target:
+                return float(LATENCY_BUCKETS_MS[index])
+        return self.max_ms
+
+    @property
+    def avg_ms(self) -> float:
+        return self.total_ms / self.count if self.count else 0.0
+
+
+class QueryStatsListener(monitoring.CommandListener):
+    """pymongo command listener keeping per-shape latency histograms and a slow-query queue"""
+
+    def __init__(self, slow_query_ms: float = 100.0):
+        self.slow_query_ms = slow_query_ms
+        self.shapes: Dict[str, ShapeStats] = {}
+        self.slow_queries = deque(maxlen=200)
+        self._in_flight: Dict[Any, Any] = {}
+        self._lock = threading.Lock()
+
+    def load_from_env(self):
+        """Load the slow query threshold from SLOW_QUERY_MS"""
+        self.slow_query_ms = float(os.getenv('SLOW_QUERY_MS', str(self.slow_query_ms)))
+
+    def started(self, event):
+        shape = command_shape(event.command_name, event.command)
+        if shape is None:
+            return
+        explainable = event.command_name in EXPLAINABLE_COMMANDS
+        with self._lock:
+            self._in_flight[(event.connection_id, event.request_id)] = (
+                shape, event.database_name, event.command if explainable else None
+            )
+
+    def succeeded(self, event):
+        self._finish(event, failed=False)
+
+    def failed(self, event):
+        self._finish(event, failed=True)
+
+    def _finish(self, event, failed: bool):
+        duration_ms = event.duration_micros / 1000
+        with self._lock:
+            entry = self._in_flight.pop((event.connection_id, event.request_id), None)
+            if entry is None:
+                return
+            shape, database_name, command = entry
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = self.shapes[shape] = ShapeStats(shape)
+            stats.observe(duration_ms, failed)
+        if duration_ms >= self.slow_query_ms:
+            self.slow_queries.append((shape, database_name, command, duration_ms))
+
+    def get_top_shapes(self, limit: int = 10) -> List[ShapeStats]:
+        """Get the shapes with the highest total MongoDB time"""
+        with self._lock:
+            shapes = list(self.shapes.values())
+        return sorted(shapes, key=lambda stats: stats.total_ms, reverse=True)[:limit]
+
+
+# Global instances shared by the database manager and the bots
+update_command_listener = UpdateCommandListener()
+query_stats_listener = QueryStatsListener()
+update_budget = UpdateBudget()
+
+
+def explainable_command(command: Dict[str, Any]) -> Dict[str, Any]:
+    """Strip session and transport fields from a logged command so it can be explained"""
+    skipped = {"lsid", "txnNumber", "autocommit", "startTransaction", "readConcern", "writeConcern", "maxTimeMS"}
+    return {key: value for key, value in command.items() if not key.startswith('$') and key not in skipped}
+
+
+async def process_slow_queries(db_manager):
+    """Background task logging slow queries together with their plan summary"""
+    while True:
+        try:
+            while query_stats_listener.slow_queries:
+                shape, database_name, command, duration_ms = query_stats_listener.slow_queries.popleft()
+                stats = query_stats_listener.shapes.get(shape)
+                # Explain each shape only once, the plan rarely changes
+                if stats is not None and stats.plan is None and command is not None:
+                    try:
+                        result = await db_manager.client[database_name].command(
+                            {"explain": explainable_command(command), "verbosity": "queryPlanner"}
+                        )
+                        stats.plan = plan_summary(result)
+                    except Exception as e:
+                        stats.plan = "n/a"
+                        logger.debug("Could not explain slow query %s: %s", shape, e)
+                plan = stats.plan if stats is not None and stats.plan else "n/a"
+                logger.warning("Slow query (%.1fms): %s plan=%s", duration_ms, shape, plan)
+            
+            await asyncio.sleep(5)
+            
+        except Exception as e:
+            logger.error("Error in slow query processing: %s", e)
+            await asyncio.sleep(10)
+
+
+async def begin_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pre-handler: start collecting MongoDB stats for this update and its deadline"""
+    current_update_stats.set(UpdateStats(update_label(update)))
+    start_deadline()
+
+
+async def finish_update(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Post-handler: check the collected stats against the budget"""
+    clear_deadline()
+    stats = current_update_stats.get()
+    if stats is None:
+        return
+    current_update_stats.set(None)
+    handler_latency.observe(stats.elapsed_ms / 1000, prefix=stats.label)
+    update_budget.observe(stats)
+
+
+def discard_update() -> None:
+    """Drop the stats and deadline of an update that is stopped before the post-handler"""
+    clear_deadline()
+    current_update_stats.set(None)
+
+
+async def detached(coroutine: Awaitable[Any]) -> Any:
+    """Run work a handler started as a task on its own, without the deadline and stats of that update"""
+    # The task copied the handler's context, which may outlive the update it belongs to
+    discard_update()
+    uninterrupted_steps.set(False)
+    return await coroutine
+
+
+def register_update_instrumentation(application: Application) -> None:
+    """Wrap every update handled by the application with MongoDB instrumentation"""
+    update_budget.load_from_env()
+    application.add_handler(TypeHandler(Update, begin_update), group=PRE_HANDLER_GROUP)
+    application.add_handler(TypeHandler(Update, finish_update), group=POST_HANDLER_GROUP)
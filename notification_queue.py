@@ -0,0 +1,167 @@
+"""
+Priority lanes and coalescing for the notification queue
+
+Paid card deliveries must not wait behind bursts of account messages, so every
+notification gets a priority class from its type and the customer bot drains
+the lanes with weighted fairness. Order status and account messages wait a
+short window so bursts for one user can be merged into a single send.
+"""
+import os
+import time
+import logging
+from datetime import datetime, timedelta, UTC
+from typing import Dict, List, Any
+from metrics import notification_lane_age, notification_delivery_latency, notifications_coalesced
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_DELIVERY = 0
+PRIORITY_ORDERS = 1
+PRIORITY_ACCOUNT = 2
+
+LANE_NAMES = {
+    PRIORITY_DELIVERY: 'delivery',
+    PRIORITY_ORDERS: 'orders',
+    PRIORITY_ACCOUNT: 'account',
+}
+
+NOTIFICATION_PRIORITIES = {
+    'deliver_card': PRIORITY_DELIVERY,
+    'deliver_card_image': PRIORITY_DELIVERY,
+    'new_order': PRIORITY_DELIVERY,
+    'order_completed': PRIORITY_ORDERS,
+    'order_cancelled': PRIORITY_ORDERS,
+    'balance_updated': PRIORITY_ACCOUNT,
+    'user_blocked': PRIORITY_ACCOUNT,
+    'user_unblocked': PRIORITY_ACCOUNT,
+}
+
+# Notifications created before priorities existed fall into the lowest lane
+DEFAULT_PRIORITY = PRIORITY_ACCOUNT
+
+# Lanes held for the coalescing window before dispatch
+COALESCED_LANES = (PRIORITY_ORDERS, PRIORITY_ACCOUNT)
+
+# Types merged per user when several are pending at once
+COALESCIBLE_TYPES = ('balance_updated', 'order_completed', 'order_cancelled')
+
+MESSAGE_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+
+def priority_for(notification_type: str) -> int:
+    """Priority class of a notification type"""
+    return NOTIFICATION_PRIORITIES.get(notification_type, DEFAULT_PRIORITY)
+
+
+def lane_weights() -> Dict[int, int]:
+    """Per-lane share of each batch (NOTIFICATION_LANE_WEIGHTS, highest priority first)"""
+    raw = os.getenv('NOTIFICATION_LANE_WEIGHTS', '6,3,1')
+    try:
+        weights = [max(1, int(part)) for part in raw.split(',')]
+    except ValueError:
+        logger.warning("Invalid NOTIFICATION_LANE_WEIGHTS %r, using defaults", raw)
+        weights = [6, 3, 1]
+    weights += [1] * (len(LANE_NAMES) - len(weights))
+    return {priority: weights[index] for index, priority in enumerate(sorted(LANE_NAMES))}
+
+
+def weighted_interleave(lanes: Dict[int, List[Dict[str, Any]]], weights: Dict[int, int]) -> List[Dict[str, Any]]:
+    """Order notifications by weighted round robin across lanes, highest priority first in each round"""
+    queues = {priority: list(reversed(items)) for priority, items in lanes.items() if items}
+    ordered = []
+    while queues:
+        for priority in sorted(queues):
+            queue = queues[priority]
+            for _ in range(weights.get(priority, 1)):
+                if not queue:
+                    break
+                ordered.append(queue.pop())
+        queues = {priority: queue for priority, queue in queues.items() if queue}
+    return ordered
+
+
+def coalesce_window() -> float:
+    """Seconds order status and account notifications wait so bursts can be merged"""
+    return float(os.getenv('NOTIFICATION_COALESCE_WINDOW_SECONDS', '2'))
+
+
+async def fetch_notification_batch(db_manager, notification_types: List[str], batch_unit: int = 10) -> List[Dict[str, Any]]:
+    """Fetch the next batch of due notifications, each lane capped at its weighted share"""
+    weights = lane_weights()
+    window = coalesce_window()
+    lanes = {}
+    now = time.time()
+    for priority in sorted(LANE_NAMES):
+        types = [t for t in notification_types if priority_for(t) == priority]
+        if not types:
+            continue
+        created_before = None
+        if window > 0 and priority in COALESCED_LANES:
+            created_before = datetime.now(UTC) - timedelta(seconds=window)
+        lanes[priority] = await db_manager.get_pending_notifications(
+            types, priority=priority, limit=weights[priority] * batch_unit, created_before=created_before
+        )
+        # Lanes are sorted by created_at, so the head is the oldest waiting notification
+        oldest = lanes[priority][0].get('created_at') if lanes[priority] else None
+        notification_lane_age.set(_age_seconds(oldest, now) if oldest else 0.0, lane=LANE_NAMES[priority])
+        if window > 0 and priority in COALESCED_LANES:
+            lanes[priority] = await coalesce_notifications(db_manager, lanes[priority])
+    return weighted_interleave(lanes, weights)
+
+
+async def coalesce_notifications(db_manager, notifications: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Merge same-type notifications for the same user into the newest one"""
+    groups: Dict[tuple, List[Dict[str, Any]]] = {}
+    for notification in notifications:
+        user_id = notification.get('data', {}).get('user_id')
+        if notification.get('type') in COALESCIBLE_TYPES and user_id:
+            groups.setdefault((notification['type'], user_id), []).append(notification)
+
+    absorbed_ids = set()
+    for (notification_type, user_id), group in groups.items():
+        if len(group) < 2:
+            continue
+        # The batch is sorted by created_at, so the last one is the newest
+        carrier = group[-1]
+        if notification_type == 'balance_updated':
+            data = merge_balance_updates(group)
+        else:
+            data = dict(carrier['data'], message=MESSAGE_SEPARATOR.join(n['data'].get('message', '') for n in group))
+        absorbed = [n['notification_id'] for n in group[:-1]]
+        if await db_manager.coalesce_notifications(carrier['notification_id'], data, absorbed):
+            carrier['data'] = data
+            absorbed_ids.update(absorbed)
+            notifications_coalesced.inc(len(absorbed), type=notification_type)
+            logger.info("Coalesced %s %s notifications for user %s", len(group), notification_type, user_id)
+
+    return [n for n in notifications if n['notification_id'] not in absorbed_ids]
+
+
+def merge_balance_updates(group: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Combine balance notifications into one showing the total charged and the latest balance"""
+    latest = group[-1]['data']
+    total = sum(float(n['data'].get('amount') or 0) for n in group)
+    # A notification may already be the result of an earlier merge
+    count = sum(n['data'].get('coalesced_count', 1) for n in group)
+    new_balance = latest.get('new_balance', 0.0)
+    message = (
+        f"💰 تم شحن رصيدك {count} مرات بإجمالي ${total:.2f}\n\n"
+        f"💳 رصيدك الحالي: ${new_balance:.2f}\n\n🎉 يمكنك الآن شراء البطاقات!"
+    )
+    return dict(latest, amount=total, message=message, coalesced_count=count)
+
+
+def observe_delivery(notification: Dict[str, Any]):
+    """Record how long a notification waited between creation and dispatch"""
+    created_at = notification.get('created_at')
+    if created_at is None:
+        return
+    lane = LANE_NAMES.get(notification.get('priority', DEFAULT_PRIORITY), LANE_NAMES[DEFAULT_PRIORITY])
+    notification_delivery_latency.observe(_age_seconds(created_at, time.time()), lane=lane)
+
+
+def _age_seconds(created_at, now: float) -> float:
+    # MongoDB returns naive datetimes holding UTC
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=UTC)
+    return max(0.0, now - created_at.timestamp())
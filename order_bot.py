@@ -1,21 +1,29 @@
 import os
+import time
 import logging
 import asyncio
 import base64
-from datetime import datetime, UTC
+from datetime import datetime, timedelta, UTC
+from typing import Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, ContextTypes, MessageHandler, filters, CallbackQueryHandler
+from telegram.request import BaseRequest
 from dotenv import load_dotenv
 from database import db_manager
+from logging_setup import configure_logging
+from metrics import build_request, start_metrics_server, stop_metrics_server
+from monitoring import register_update_instrumentation, process_slow_queries, query_stats_listener, update_budget, detached
+from deadlines import deadline_error_handler
+from pagination import matches_screen, page_cursor, add_page_row
+from exports import export_dataset, parquet_available, EXPORT_DATASETS, CSV, PARQUET
+from reconciliation import reconcile, format_report
+from maintenance import schedule_order_expiry
+from update_recorder import register_update_recorder
 from telegram.error import BadRequest
+from render_cache import render_cache, message_key, fingerprint, answer_unchanged
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Reduce httpx logging noise
-logging.getLogger("httpx").setLevel(logging.WARNING)
-
 # Countries are now managed dynamically through the admin interface
 # All country data is stored in the MongoDB countries collection
 
@@ -29,25 +37,41 @@ async def get_country_info(country_code: str) -> dict:
                 'name': country.get('name', country_code)
             }
     except Exception as e:
-        logger.error(f"Error getting country info for {country_code}: {e}")
+        logger.error("Error getting country info for %s: %s", country_code, e)
     
     # Fallback to default values
     return {'flag': '🌍', 'name': country_code}
 
 
+async def get_country_flags(country_codes) -> dict:
+    """Get the flags of several countries in one query, with the same fallback as get_country_info"""
+    countries = await db_manager.get_countries_by_codes(list(set(country_codes)))
+    return {code: countries.get(code.upper(), {}).get('flag', '🌍') for code in country_codes}
+
+
 async def safe_edit_message(query, text, reply_markup=None, fallback_answer="تم التحديث ✅"):
-    """Safely edit a message, handling BadRequest errors for identical content"""
+    """Safely edit a message, skipping the API call when it already shows this content"""
+    key = message_key(query)
+    render = fingerprint(text, reply_markup)
+    if render_cache.is_unchanged(key, render):
+        # Same text and keyboard as the last render, just answer the callback
+        await answer_unchanged(query, fallback_answer)
+        return
     try:
         await query.edit_message_text(text=text, reply_markup=reply_markup)
+        render_cache.remember(key, render)
     except BadRequest as e:
         if "message is not modified" in str(e).lower():
             # Message content is identical, just answer the callback
-            await query.answer(fallback_answer)
+            render_cache.remember(key, render)
+            await answer_unchanged(query, fallback_answer)
         else:
             # Re-raise other BadRequest errors
+            render_cache.forget(key)
             raise e
     except Exception as e:
-        logging.error(f"Unexpected error editing message: {e}")
+        render_cache.forget(key)
+        logging.error("Unexpected error editing message: %s", e)
         await query.answer("حدث خطأ، يرجى المحاولة مرة أخرى")
 
 
@@ -55,9 +79,8 @@ async def start_order_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     """Handle the /start command for the order management bot"""
     user = update.effective_user
     
-    # Check if user is admin (you can implement admin check logic)
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
         await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
         return
     
@@ -68,6 +91,9 @@ async def start_order_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         [InlineKeyboardButton("🌍 إدارة الدول", callback_data='manage_countries')],
         [InlineKeyboardButton("🌐 إدارة المواقع السوداء", callback_data='manage_black_websites')],
         [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data='manage_users')],
+        [InlineKeyboardButton("📢 الرسائل الجماعية", callback_data='broadcasts')],
+        [InlineKeyboardButton("📮 الإشعارات الفاشلة", callback_data='dead_letters')],
+        [InlineKeyboardButton("📤 تصدير البيانات", callback_data='exports')],
         [InlineKeyboardButton("📊 الإحصائيات", callback_data='statistics')]
     ]
     
@@ -77,6 +103,426 @@ async def start_order_bot(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await update.message.reply_text(menu_text, reply_markup=reply_markup)
 
 
+def build_dbstats_text() -> str:
+    """Build the MongoDB query statistics screen for admins"""
+    shapes = query_stats_listener.get_top_shapes(8)
+    if not shapes:
+        return "🗄️ إحصائيات قاعدة البيانات\n\n📭 لا توجد استعلامات مسجلة بعد"
+    
+    stats_text = f"🗄️ إحصائيات قاعدة البيانات\n⚠️ حد الاستعلام البطيء: {query_stats_listener.slow_query_ms:.0f}ms\n\n"
+    for i, stats in enumerate(shapes, 1):
+        shape = stats.shape if len(stats.shape) <= 120 else stats.shape[:117] + "..."
+        stats_text += f"{i}. {shape}\n"
+        stats_text += f"   🔢 {stats.count} | ⏱️ avg {stats.avg_ms:.1f}ms | p95 ≤{stats.percentile(0.95):.0f}ms | max {stats.max_ms:.0f}ms\n"
+        if stats.failures:
+            stats_text += f"   ❌ فشل: {stats.failures}\n"
+        if stats.plan:
+            stats_text += f"   🧭 {stats.plan}\n"
+        stats_text += "\n"
+    
+    prefixes = update_budget.get_prefix_totals()[:5]
+    if prefixes:
+        stats_text += "📨 أكثر التحديثات استهلاكاً:\n"
+        for row in prefixes:
+            avg_commands = row['commands'] / row['updates'] if row['updates'] else 0
+            stats_text += f"• {row['label']}: {row['updates']} تحديث | {avg_commands:.1f} أمر/تحديث | {row['db_ms']:.0f}ms | تجاوز: {row['over_budget']}\n"
+    
+    stats_text += f"\n📅 آخر تحديث: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    return stats_text
+
+
+async def dbstats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /dbstats command showing MongoDB latency per query shape"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    keyboard = [
+        [InlineKeyboardButton("🔄 تحديث الإحصائيات", callback_data='dbstats')],
+        [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(build_dbstats_text(), reply_markup=reply_markup)
+
+
+async def build_user_search_results(term: str):
+    """Search users and build the result text and buttons"""
+    users = await db_manager.search_users(term)
+    keyboard = []
+    if users:
+        blacklisted = await db_manager.get_blacklisted_user_ids([user['user_id'] for user in users])
+        results_text = f"🔍 نتائج البحث عن \"{term}\" ({len(users)}):\n\n"
+        for i, user in enumerate(users, 1):
+            username = user.get('username') or 'غير محدد'
+            first_name = user.get('first_name') or 'غير محدد'
+            balance = user.get('balance', 0.0)
+            status_icon = "🚫" if user['user_id'] in blacklisted else "👤"
+            results_text += f"{i}. {status_icon} {first_name} (@{username}) | #{user['user_id']} | ${balance:.2f}\n"
+            keyboard.append([InlineKeyboardButton(
+                f"{status_icon} {first_name} (@{username})",
+                callback_data=f"user_{user['user_id']}"
+            )])
+    else:
+        results_text = f"📭 لا يوجد مستخدمون مطابقون لـ \"{term}\""
+    
+    keyboard.append([InlineKeyboardButton("🔍 بحث جديد", callback_data='search_users')])
+    keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المستخدمين", callback_data='manage_users')])
+    return results_text, InlineKeyboardMarkup(keyboard)
+
+
+async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /search command finding users by ID, @username or name"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    term = ' '.join(context.args).strip()
+    if not term:
+        await update.message.reply_text(
+            "🔍 البحث عن مستخدم\n\n"
+            "الاستخدام: /search <معرف المستخدم | @اسم_المستخدم | الاسم>\n"
+            "مثال: /search @ahmed"
+        )
+        return
+    
+    results_text, reply_markup = await build_user_search_results(term)
+    await update.message.reply_text(results_text, reply_markup=reply_markup)
+
+
+EXPORT_LABELS = {
+    'orders': '📋 الطلبات',
+    'transactions': '💳 المعاملات',
+}
+
+# Days covered by each export range button (0 exports everything)
+EXPORT_RANGES = [
+    (1, 'آخر 24 ساعة'),
+    (7, 'آخر 7 أيام'),
+    (30, 'آخر 30 يوماً'),
+    (0, 'كل البيانات'),
+]
+
+# Telegram rejects bot uploads larger than 50 MB
+MAX_EXPORT_BYTES = 50 * 1024 * 1024
+
+
+async def send_export(bot, chat_id: int, dataset: str, start, end, export_format: str) -> None:
+    """Build an export in the background and send it to the admin as a document"""
+    try:
+        path, rows = await export_dataset(db_manager, dataset, start, end, export_format)
+    except Exception as e:
+        logger.error("Error exporting %s: %s", dataset, e)
+        await bot.send_message(chat_id=chat_id, text="❌ فشل في تصدير البيانات")
+        return
+    
+    period = f"{start.strftime('%Y-%m-%d') if start else 'البداية'} → {(end or datetime.now(UTC)).strftime('%Y-%m-%d')}"
+    try:
+        if os.path.getsize(path) > MAX_EXPORT_BYTES:
+            await bot.send_message(
+                chat_id=chat_id,
+                text=f"❌ الملف أكبر من 50 ميغابايت ({rows} صف). يرجى اختيار فترة أقصر."
+            )
+            return
+        filename = f"{dataset}_{start.strftime('%Y%m%d') if start else 'all'}.{export_format}"
+        with open(path, 'rb') as export_file:
+            await bot.send_document(
+                chat_id=chat_id,
+                document=export_file,
+                filename=filename,
+                caption=f"📤 {EXPORT_LABELS[dataset]}\n📅 {period}\n📊 عدد الصفوف: {rows}"
+            )
+    except Exception as e:
+        logger.error("Error sending %s export: %s", dataset, e)
+        await bot.send_message(chat_id=chat_id, text="❌ فشل في إرسال ملف التصدير")
+    finally:
+        os.remove(path)
+
+
+async def export_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /export command: /export <orders|transactions> [from] [to] [csv|parquet]"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    args = list(context.args)
+    export_format = CSV
+    if args and args[-1].lower() in (CSV, PARQUET):
+        export_format = args.pop().lower()
+    usage = (
+        "📤 تصدير البيانات\n\n"
+        "الاستخدام: /export <orders|transactions> [من YYYY-MM-DD] [إلى YYYY-MM-DD] [csv|parquet]\n"
+        "مثال: /export orders 2025-01-01 2025-02-01"
+    )
+    if not args or args[0] not in EXPORT_DATASETS or len(args) > 3:
+        await update.message.reply_text(usage)
+        return
+    if export_format == PARQUET and not parquet_available():
+        await update.message.reply_text("❌ تصدير Parquet غير متاح (مكتبة pyarrow غير مثبتة)")
+        return
+    
+    try:
+        dates = [datetime.strptime(arg, '%Y-%m-%d').replace(tzinfo=UTC) for arg in args[1:]]
+    except ValueError:
+        await update.message.reply_text(usage)
+        return
+    start = dates[0] if dates else None
+    end = dates[1] if len(dates) > 1 else None
+    
+    await update.message.reply_text("⏳ جاري تجهيز ملف التصدير، سيتم إرساله عند الانتهاء...")
+    context.application.create_task(
+        detached(send_export(context.bot, update.effective_chat.id, args[0], start, end, export_format)),
+        update=update
+    )
+
+
+async def send_reconciliation(bot, chat_id: int) -> None:
+    """Reconcile all balances in the background and send the report to the admin"""
+    try:
+        report = await reconcile(db_manager)
+    except Exception as e:
+        logger.error("Error reconciling balances: %s", e)
+        await bot.send_message(chat_id=chat_id, text="❌ فشل في تسوية الأرصدة")
+        return
+    await bot.send_message(chat_id=chat_id, text=format_report(report))
+
+
+async def reconcile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /reconcile command checking every balance against the ledger and orders"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    await update.message.reply_text("⏳ جاري تسوية الأرصدة، سيتم إرسال التقرير عند الانتهاء...")
+    context.application.create_task(detached(send_reconciliation(context.bot, update.effective_chat.id)), update=update)
+
+
+# Orders cancelled per transaction by /cancel_orders
+BATCH_CANCEL_SIZE = 200
+
+
+def parse_batch_cancel_filter(args):
+    """Build the order filter of /cancel_orders from key=value arguments (None when invalid)"""
+    query = {}
+    created_at = {}
+    for arg in args:
+        key, _, value = arg.partition('=')
+        if not value:
+            return None
+        try:
+            if key == 'user':
+                query['user_id'] = int(value)
+            elif key == 'card':
+                query['card_id'] = value
+            elif key == 'country':
+                query['country_code'] = value.upper()
+            elif key in ('from', 'to'):
+                date_format = '%Y-%m-%dT%H:%M' if 'T' in value else '%Y-%m-%d'
+                created_at['$gte' if key == 'from' else '$lt'] = datetime.strptime(value, date_format).replace(tzinfo=UTC)
+            else:
+                return None
+        except ValueError:
+            return None
+    if not query and not created_at:
+        return None
+    # Orders placed after the preview are not part of the selection
+    created_at.setdefault('$lt', datetime.now(UTC))
+    query['created_at'] = created_at
+    return query
+
+
+async def run_batch_cancel(bot, chat_id: int, order_filter: dict) -> None:
+    """Cancel and refund every pending order matching the filter, one transaction per batch"""
+    cancelled_count = 0
+    refunded = 0.0
+    try:
+        while True:
+            cancelled = await db_manager.cancel_orders(order_filter, "admin", BATCH_CANCEL_SIZE)
+            cancelled_count += len(cancelled)
+            refunded += sum(order['amount'] for order in cancelled)
+            if len(cancelled) < BATCH_CANCEL_SIZE:
+                break
+    except Exception as e:
+        logger.error("Error cancelling orders in batch after %s orders: %s", cancelled_count, e)
+        await bot.send_message(chat_id=chat_id, text=f"❌ توقف الإلغاء الجماعي بعد إلغاء {cancelled_count} طلب")
+        return
+    await bot.send_message(
+        chat_id=chat_id,
+        text=f"✅ تم إلغاء {cancelled_count} طلب\n\n💰 تم استرداد ${refunded:.2f} وإعادة البطاقات للمخزون\n📧 تم إشعار العملاء"
+    )
+
+
+async def cancel_orders_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /cancel_orders command: /cancel_orders [user=ID] [card=CARD_ID] [country=CODE] [from=DATE] [to=DATE]"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    order_filter = parse_batch_cancel_filter(context.args)
+    if order_filter is None:
+        await update.message.reply_text(
+            "🧹 الإلغاء الجماعي للطلبات المعلقة\n\n"
+            "الاستخدام: /cancel_orders [user=معرف_المستخدم] [card=معرف_البطاقة] [country=رمز_الدولة] "
+            "[from=YYYY-MM-DD] [to=YYYY-MM-DD]\n"
+            "مثال: /cancel_orders card=US_VISA_25 from=2025-01-01T10:00 to=2025-01-01T12:00\n\n"
+            "⚠️ يجب تحديد شرط واحد على الأقل"
+        )
+        return
+    
+    # Orders claimed by another admin are left to them
+    order_filter.update(db_manager.actionable_by(user.id))
+    
+    summary = await db_manager.summarize_pending_orders(order_filter)
+    if summary is None:
+        await update.message.reply_text("❌ حدث خطأ أثناء البحث عن الطلبات")
+        return
+    if not summary['count']:
+        await update.message.reply_text("📭 لا توجد طلبات معلقة مطابقة")
+        return
+    
+    context.user_data['batch_cancel'] = order_filter
+    keyboard = [
+        [InlineKeyboardButton(f"✅ نعم، إلغاء {summary['count']} طلب", callback_data='confirm_batch_cancel')],
+        [InlineKeyboardButton("❌ تراجع", callback_data='discard_batch_cancel')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await update.message.reply_text(
+        f"⚠️ تأكيد الإلغاء الجماعي\n\n"
+        f"📋 الطلبات المعلقة المطابقة: {summary['count']}\n"
+        f"👥 العملاء: {summary['users']}\n"
+        f"💰 إجمالي الاسترداد: ${summary['amount']:.2f}\n\n"
+        f"سيتم استرداد المبالغ وإعادة البطاقات للمخزون وإشعار العملاء.",
+        reply_markup=reply_markup
+    )
+
+
+def build_admins_text(roster: dict) -> str:
+    """Build the admin roster listing with duty status"""
+    owner_id = db_manager.owner_admin_id()
+    admins_text = f"👮 المشرفون ({len(roster)}):\n\n"
+    for admin_id, admin in sorted(roster.items()):
+        duty = "🟢 في الخدمة" if admin.get('on_duty', True) else "⚪ خارج الخدمة"
+        role = " 👑" if admin_id == owner_id else ""
+        admins_text += f"• {admin.get('name') or admin_id} (#{admin_id}){role} | {duty}\n"
+    return admins_text
+
+
+async def admins_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /admins command: list the roster; the owner can add <id> [name] and remove <id>"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    args = list(context.args)
+    if args:
+        if user.id != db_manager.owner_admin_id():
+            await update.message.reply_text("❌ إدارة المشرفين متاحة للمالك فقط")
+            return
+        usage = (
+            "👮 إدارة المشرفين\n\n"
+            "الاستخدام:\n/admins add <معرف المستخدم> [الاسم]\n/admins remove <معرف المستخدم>"
+        )
+        if len(args) < 2 or args[0] not in ('add', 'remove') or not args[1].isdigit():
+            await update.message.reply_text(usage)
+            return
+        admin_id = int(args[1])
+        if args[0] == 'add':
+            success = await db_manager.add_admin(admin_id, ' '.join(args[2:]) or None)
+            await update.message.reply_text(f"✅ تمت إضافة المشرف #{admin_id}" if success else "❌ فشل في إضافة المشرف")
+        elif admin_id == db_manager.owner_admin_id():
+            await update.message.reply_text("❌ لا يمكن حذف المالك")
+        else:
+            success = await db_manager.remove_admin(admin_id)
+            await update.message.reply_text(f"🗑️ تم حذف المشرف #{admin_id}" if success else f"❌ المشرف #{admin_id} غير موجود")
+        return
+    
+    roster = await db_manager.get_admin_roster()
+    await update.message.reply_text(build_admins_text(roster) + "\n💡 لتغيير حالتك استخدم الأمر /duty")
+
+
+async def duty_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the /duty command switching whether new orders are sent to this admin"""
+    user = update.effective_user
+    
+    # Check if user is admin
+    if not await db_manager.is_admin(user.id):
+        await update.message.reply_text('عذراً، هذا البوت مخصص للإدارة فقط.')
+        return
+    
+    roster = await db_manager.get_admin_roster()
+    on_duty = not roster.get(user.id, {}).get('on_duty', True)
+    if not await db_manager.set_admin_on_duty(user.id, on_duty):
+        await update.message.reply_text("❌ فشل في تغيير حالتك")
+        return
+    if on_duty:
+        await update.message.reply_text("🟢 أنت الآن في الخدمة وستصلك الطلبات الجديدة")
+    else:
+        await update.message.reply_text("⚪ أنت الآن خارج الخدمة ولن تصلك الطلبات الجديدة")
+
+
+async def handle_user_search(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the search term typed after the search button"""
+    context.user_data.pop('searching_user', None)
+    term = update.message.text.strip()
+    if not term:
+        await update.message.reply_text("❌ يرجى إدخال معرف المستخدم أو اسم المستخدم أو الاسم")
+        return
+    
+    results_text, reply_markup = await build_user_search_results(term)
+    await update.message.reply_text(results_text, reply_markup=reply_markup)
+
+
+BROADCAST_STATUS_LABELS = {
+    'pending': '⏳ في الانتظار',
+    'running': '📤 جاري الإرسال',
+    'completed': '✅ مكتملة',
+    'cancelled': '⛔ ملغاة',
+}
+
+
+def build_broadcast_text(broadcast: dict) -> str:
+    """Build the progress screen of a broadcast"""
+    sent = broadcast.get('delivered', 0) + broadcast.get('failed', 0) + broadcast.get('blocked', 0) + broadcast.get('skipped', 0)
+    total = broadcast.get('total_users') or 0
+    progress = min(100.0, sent * 100 / total) if total else 0.0
+    preview = broadcast.get('text', '')
+    if len(preview) > 200:
+        preview = preview[:197] + "..."
+    
+    broadcast_text = f"""
+📢 رسالة جماعية {broadcast['broadcast_id']}
+
+📊 الحالة: {BROADCAST_STATUS_LABELS.get(broadcast.get('status'), broadcast.get('status'))}
+📈 التقدم: {sent}/{total} ({progress:.0f}%)
+
+✅ تم التسليم: {broadcast.get('delivered', 0)}
+🚫 حظروا البوت: {broadcast.get('blocked', 0)}
+⛔ محظورون (تم تخطيهم): {broadcast.get('skipped', 0)}
+❌ فشل: {broadcast.get('failed', 0)}
+"""
+    if preview:
+        broadcast_text += f"\n📝 الرسالة:\n{preview}\n"
+    broadcast_text += f"\n📅 آخر تحديث: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    return broadcast_text
+
+
 async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle button callbacks for the order management bot"""
     query = update.callback_query
@@ -84,20 +530,22 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
         await safe_edit_message(query, 'عذراً، هذا البوت مخصص للإدارة فقط.')
         return
     
-    if query.data == 'pending_orders':
-        # Get pending orders from database
-        orders = await db_manager.get_pending_orders()
+    if matches_screen(query.data, 'pending_orders'):
+        # Get one page of pending orders from database
+        page = await db_manager.get_pending_orders_page(page_cursor(query.data), 15)
+        orders = page.items
         
         if orders:
+            pending_count = await db_manager.count_pending_orders()
+            users = await db_manager.get_users_by_ids([order['user_id'] for order in orders])
             keyboard = []
-            for order in orders[:15]:  # Show first 15 orders
+            for order in orders:
                 # Get user info for display
-                user_info = await db_manager.get_user(order['user_id'])
+                user_info = users.get(order['user_id'])
                 username = user_info.get('username', 'غير محدد') if user_info else 'غير محدد'
                 
                 # Format order creation time
@@ -113,13 +561,15 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                     callback_data=f"pending_order_{order['order_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'pending_orders')
+            keyboard.append([InlineKeyboardButton("📸 تسليم جماعي بألبوم صور", callback_data='album_fulfill')])
             keyboard.append([InlineKeyboardButton("🔄 تحديث القائمة", callback_data='pending_orders')])
             keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await safe_edit_message(
                 query,
-                f"📋 الطلبات المعلقة ({len(orders)})\n\n⏳ طلبات تحتاج إلى إكمال:\n\nاختر طلباً لعرض التفاصيل وإكماله:",
+                f"📋 الطلبات المعلقة ({pending_count})\n\n⏳ طلبات تحتاج إلى إكمال:\n\nاختر طلباً لعرض التفاصيل وإكماله:\n\n💡 للإلغاء الجماعي استخدم الأمر /cancel_orders",
                 reply_markup
             )
         else:
@@ -171,6 +621,9 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             [InlineKeyboardButton("🌍 إدارة الدول", callback_data='manage_countries')],
             [InlineKeyboardButton("🌐 إدارة المواقع السوداء", callback_data='manage_black_websites')],
             [InlineKeyboardButton("👥 إدارة المستخدمين", callback_data='manage_users')],
+            [InlineKeyboardButton("📢 الرسائل الجماعية", callback_data='broadcasts')],
+            [InlineKeyboardButton("📮 الإشعارات الفاشلة", callback_data='dead_letters')],
+            [InlineKeyboardButton("📤 تصدير البيانات", callback_data='exports')],
             [InlineKeyboardButton("📊 الإحصائيات", callback_data='statistics')]
         ]
         
@@ -180,9 +633,193 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         
         await safe_edit_message(query, menu_text, reply_markup, "تم تحديث القائمة ✅")
     
+    elif query.data == 'dbstats':
+        keyboard = [
+            [InlineKeyboardButton("🔄 تحديث الإحصائيات", callback_data='dbstats')],
+            [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(query, build_dbstats_text(), reply_markup, "تم تحديث الإحصائيات ✅")
+    
+    elif query.data == 'broadcasts':
+        broadcasts = await db_manager.get_recent_broadcasts()
+        keyboard = [[InlineKeyboardButton("➕ رسالة جديدة", callback_data='new_broadcast')]]
+        broadcasts_text = "📢 الرسائل الجماعية\n\n"
+        
+        if broadcasts:
+            for i, broadcast in enumerate(broadcasts, 1):
+                status = BROADCAST_STATUS_LABELS.get(broadcast.get('status'), broadcast.get('status'))
+                broadcasts_text += f"{i}. {status} | ✅ {broadcast.get('delivered', 0)} | ❌ {broadcast.get('failed', 0)} | 🚫 {broadcast.get('blocked', 0)}\n"
+                keyboard.append([InlineKeyboardButton(
+                    f"📢 {broadcast['broadcast_id']} - {status}",
+                    callback_data=f"broadcast_{broadcast['broadcast_id']}"
+                )])
+        else:
+            broadcasts_text += "📭 لا توجد رسائل جماعية بعد"
+        
+        keyboard.append([InlineKeyboardButton("🔄 تحديث القائمة", callback_data='broadcasts')])
+        keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(query, broadcasts_text, reply_markup, "تم تحديث القائمة ✅")
+    
+    elif query.data == 'new_broadcast':
+        context.user_data['composing_broadcast'] = True
+        keyboard = [[InlineKeyboardButton("❌ إلغاء", callback_data='discard_broadcast')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(
+            query,
+            "📢 رسالة جماعية جديدة\n\n✍️ أرسل نص الرسالة التي تريد إرسالها لجميع المستخدمين:",
+            reply_markup
+        )
+    
+    elif query.data == 'discard_broadcast':
+        context.user_data.pop('composing_broadcast', None)
+        context.user_data.pop('broadcast_text', None)
+        keyboard = [[InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(query, "❌ تم إلغاء الرسالة الجماعية", reply_markup)
+    
+    elif query.data == 'confirm_broadcast':
+        text = context.user_data.pop('broadcast_text', None)
+        if not text:
+            keyboard = [[InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, "❌ لا توجد رسالة لإرسالها", reply_markup)
+            return
+        
+        broadcast_id = await db_manager.create_broadcast(text, user.id)
+        broadcast = await db_manager.get_broadcast(broadcast_id) if broadcast_id else None
+        if broadcast:
+            keyboard = [
+                [InlineKeyboardButton("🔄 تحديث التقدم", callback_data=f"broadcast_{broadcast_id}")],
+                [InlineKeyboardButton("⛔ إيقاف الإرسال", callback_data=f"stop_broadcast_{broadcast_id}")],
+                [InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, build_broadcast_text(broadcast), reply_markup)
+        else:
+            keyboard = [[InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, "❌ فشل في إنشاء الرسالة الجماعية", reply_markup)
+    
+    elif query.data.startswith('broadcast_'):
+        broadcast_id = query.data[10:]  # Remove 'broadcast_' prefix
+        broadcast = await db_manager.get_broadcast(broadcast_id)
+        
+        if broadcast:
+            keyboard = [[InlineKeyboardButton("🔄 تحديث التقدم", callback_data=f"broadcast_{broadcast_id}")]]
+            if broadcast.get('status') in ('pending', 'running'):
+                keyboard.append([InlineKeyboardButton("⛔ إيقاف الإرسال", callback_data=f"stop_broadcast_{broadcast_id}")])
+            keyboard.append([InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, build_broadcast_text(broadcast), reply_markup, "تم تحديث التقدم ✅")
+        else:
+            keyboard = [[InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, f"❌ لم يتم العثور على الرسالة {broadcast_id}", reply_markup)
+    
+    elif query.data.startswith('stop_broadcast_'):
+        broadcast_id = query.data[15:]  # Remove 'stop_broadcast_' prefix
+        success = await db_manager.cancel_broadcast(broadcast_id)
+        keyboard = [[InlineKeyboardButton("🔙 العودة للرسائل الجماعية", callback_data='broadcasts')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        if success:
+            await safe_edit_message(query, f"⛔ تم إيقاف الرسالة الجماعية {broadcast_id}", reply_markup)
+        else:
+            await safe_edit_message(query, f"❌ لا يمكن إيقاف الرسالة {broadcast_id}", reply_markup)
+    
+    elif query.data == 'dead_letters':
+        dead_letters = await db_manager.get_dead_letters()
+        if dead_letters:
+            total = await db_manager.count_dead_letters()
+            keyboard = []
+            dead_text = f"📮 الإشعارات الفاشلة ({total}):\n\n"
+            
+            for i, dead_letter in enumerate(dead_letters, 1):
+                notification_id = dead_letter['notification_id']
+                user_id = dead_letter.get('data', {}).get('user_id', 'غير محدد')
+                last_error = str(dead_letter.get('last_error', ''))[:60]
+                dead_text += f"{i}. {dead_letter.get('type')} | 👤 {user_id} | 🔁 {dead_letter.get('attempts', 0)}\n   ❌ {last_error}\n"
+                
+                keyboard.append([InlineKeyboardButton(
+                    f"📮 {dead_letter.get('type')} - {user_id}",
+                    callback_data=f"dead_letter_{notification_id}"
+                )])
+            
+            keyboard.append([InlineKeyboardButton("🔄 تحديث القائمة", callback_data='dead_letters')])
+            keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, dead_text, reply_markup, "تم تحديث القائمة ✅")
+        else:
+            keyboard = [
+                [InlineKeyboardButton("🔄 تحديث القائمة", callback_data='dead_letters')],
+                [InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, "✅ لا توجد إشعارات فاشلة", reply_markup, "تم تحديث القائمة ✅")
+    
+    elif query.data.startswith('dead_letter_'):
+        notification_id = query.data[12:]  # Remove 'dead_letter_' prefix
+        dead_letter = await db_manager.get_dead_letter(notification_id)
+        
+        if dead_letter:
+            data = dead_letter.get('data', {})
+            created_at = dead_letter.get('created_at')
+            created_str = created_at.strftime('%Y-%m-%d %H:%M:%S') if isinstance(created_at, datetime) else 'غير محدد'
+            dead_at = dead_letter.get('dead_at')
+            dead_str = dead_at.strftime('%Y-%m-%d %H:%M:%S') if isinstance(dead_at, datetime) else 'غير محدد'
+            
+            dead_text = f"""
+📮 إشعار فاشل
+
+🆔 معرف الإشعار: {notification_id}
+🏷️ النوع: {dead_letter.get('type')}
+👤 معرف المستخدم: {data.get('user_id', 'غير محدد')}
+🆔 رقم الطلب: {data.get('order_id', 'غير محدد')}
+🔁 عدد المحاولات: {dead_letter.get('attempts', 0)}
+📅 تاريخ الإنشاء: {created_str}
+⛔ تاريخ الإيقاف: {dead_str}
+
+❌ آخر خطأ:
+{dead_letter.get('last_error', 'غير محدد')}
+            """
+            keyboard = [
+                [InlineKeyboardButton("🔁 إعادة الإرسال", callback_data=f"replay_dead_{notification_id}")],
+                [InlineKeyboardButton("🗑️ حذف", callback_data=f"delete_dead_{notification_id}")],
+                [InlineKeyboardButton("🔙 العودة للإشعارات الفاشلة", callback_data='dead_letters')]
+            ]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, dead_text, reply_markup)
+        else:
+            keyboard = [[InlineKeyboardButton("🔙 العودة للإشعارات الفاشلة", callback_data='dead_letters')]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, f"❌ لم يتم العثور على الإشعار {notification_id}", reply_markup)
+    
+    elif query.data.startswith('replay_dead_'):
+        notification_id = query.data[12:]  # Remove 'replay_dead_' prefix
+        success = await db_manager.replay_dead_letter(notification_id)
+        keyboard = [[InlineKeyboardButton("🔙 العودة للإشعارات الفاشلة", callback_data='dead_letters')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        if success:
+            await safe_edit_message(query, f"✅ تمت إعادة الإشعار {notification_id} إلى قائمة الإرسال", reply_markup)
+        else:
+            await safe_edit_message(query, f"❌ فشل في إعادة الإشعار {notification_id}", reply_markup)
+    
+    elif query.data.startswith('delete_dead_'):
+        notification_id = query.data[12:]  # Remove 'delete_dead_' prefix
+        success = await db_manager.delete_dead_letter(notification_id)
+        keyboard = [[InlineKeyboardButton("🔙 العودة للإشعارات الفاشلة", callback_data='dead_letters')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        if success:
+            await safe_edit_message(query, f"🗑️ تم حذف الإشعار {notification_id}", reply_markup)
+        else:
+            await safe_edit_message(query, f"❌ فشل في حذف الإشعار {notification_id}", reply_markup)
+    
     # Handle order action buttons
     elif query.data.startswith('sent_'):
         order_id = query.data[5:]  # Remove 'sent_' prefix
+        if await refuse_claimed_order(query, order_id, user.id):
+            return
         # Ask admin to provide card details
         keyboard = [
             [InlineKeyboardButton("📝 إدخال تفاصيل البطاقة", callback_data=f"input_card_{order_id}")],
@@ -195,10 +832,29 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup
         )
     
-    elif query.data.startswith('cancel_'):
-        order_id = query.data[7:]  # Remove 'cancel_' prefix
-        await db_manager.update_order_status(order_id, 'cancelled')
-        await safe_edit_message(query, f"❌ تم إلغاء الطلب #{order_id}")
+    elif query.data.startswith('claim_'):
+        order_id = query.data[6:]  # Remove 'claim_' prefix
+        admin_name = admin_display_name(user)
+        order = await db_manager.claim_order(order_id, user.id, admin_name)
+        if order is None:
+            current = await db_manager.get_order_by_id(order_id)
+            if current and current.get('claimed_by'):
+                claimed_text = f"🔒 الطلب #{order_id} استلمه {current.get('claimed_by_name')}"
+            elif current:
+                claimed_text = f"ℹ️ الطلب #{order_id} لم يعد معلقاً"
+            else:
+                claimed_text = f"❌ لم يتم العثور على الطلب #{order_id}"
+            await safe_edit_message(query, claimed_text)
+            return
+        
+        keyboard = [
+            [InlineKeyboardButton("✅ تم الإرسال", callback_data=f"sent_{order_id}")],
+            [InlineKeyboardButton("❌ إلغاء الطلب", callback_data=f"cancel_{order_id}")],
+            [InlineKeyboardButton("📋 عرض التفاصيل", callback_data=f"details_{order_id}")]
+        ]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(query, f"{query.message.text}\n\n🙋 استلمت هذا الطلب", reply_markup)
+        context.application.create_task(detached(mark_alerts_claimed(context.bot, order, user.id)), update=update)
     
     elif query.data.startswith('details_'):
         order_id = query.data[8:]  # Remove 'details_' prefix
@@ -253,6 +909,11 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 card_price = "غير محدد"
                 card_value = "غير محدد"
             
+            if claimed_by_other(order, user.id):
+                action_text = f"🔒 يتولى هذا الطلب {order.get('claimed_by_name')}"
+            else:
+                action_text = "⚡ اختر الإجراء المطلوب:"
+            
             order_details = f"""
 📋 تفاصيل الطلب المعلق
 
@@ -266,10 +927,11 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 💎 القيمة: {card_value}
 
 📊 حالة الطلب: ⏳ معلق
+🙋 المسؤول: {order.get('claimed_by_name') or 'لم يُستلم بعد'}
 📅 تاريخ الطلب: {created_str}
 💵 المبلغ المدفوع: ${order.get('amount', 0)}
 
-⚡ اختر الإجراء المطلوب:
+{action_text}
             """
             
             keyboard = [
@@ -278,6 +940,9 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 [InlineKeyboardButton("❌ إلغاء الطلب", callback_data=f"cancel_order_{order_id}")],
                 [InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]
             ]
+            if claimed_by_other(order, user.id):
+                # Only the admin who claimed the order may act on it
+                keyboard = keyboard[-1:]
             reply_markup = InlineKeyboardMarkup(keyboard)
             
             await safe_edit_message(query, order_details, reply_markup)
@@ -289,7 +954,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # Handle order completion
     elif query.data.startswith('complete_order_'):
         order_id = query.data[15:]  # Remove 'complete_order_' prefix
-        success = await complete_order(order_id)
+        success = await complete_order(order_id, user.id)
         
         if success:
             keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
@@ -302,11 +967,13 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         else:
             keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await safe_edit_message(query, f"❌ فشل في إكمال الطلب #{order_id}", reply_markup)
+            await safe_edit_message(query, f"❌ فشل في إكمال الطلب #{order_id} (ربما لم يعد معلقاً أو استلمه مسؤول آخر)", reply_markup)
     
     # Handle order cancellation
     elif query.data.startswith('cancel_order_'):
         order_id = query.data[13:]  # Remove 'cancel_order_' prefix
+        if await refuse_claimed_order(query, order_id, user.id):
+            return
         order = await db_manager.get_order_by_id(order_id)
         
         if order:
@@ -318,7 +985,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             
             await safe_edit_message(
                 query,
-                f"⚠️ تأكيد إلغاء الطلب\n\nهل أنت متأكد من إلغاء الطلب #{order_id}?\n\n⚠️ سيتم إشعار العميل بإلغاء الطلب.",
+                f"⚠️ تأكيد إلغاء الطلب\n\nهل أنت متأكد من إلغاء الطلب #{order_id}?\n\n⚠️ سيتم استرداد المبلغ للعميل وإشعاره بإلغاء الطلب.",
                 reply_markup
             )
         else:
@@ -328,25 +995,28 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     elif query.data.startswith('confirm_cancel_'):
         order_id = query.data[15:]  # Remove 'confirm_cancel_' prefix
-        success = await cancel_order(order_id)
+        success = await cancel_order(order_id, user.id)
         
         if success:
             keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(
                 query,
-                f"❌ تم إلغاء الطلب #{order_id}\n\n📧 تم إشعار العميل بإلغاء الطلب.",
+                f"❌ تم إلغاء الطلب #{order_id}\n\n💰 تم استرداد المبلغ وإعادة البطاقة للمخزون.\n📧 تم إشعار العميل بإلغاء الطلب.",
                 reply_markup
             )
         else:
             keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
-            await safe_edit_message(query, f"❌ فشل في إلغاء الطلب #{order_id}", reply_markup)
+            await safe_edit_message(query, f"❌ فشل في إلغاء الطلب #{order_id} (ربما لم يعد معلقاً أو استلمه مسؤول آخر)", reply_markup)
     
     # Handle sending card details (reuse existing functionality)
     elif query.data.startswith('send_card_'):
         order_id = query.data[10:]  # Remove 'send_card_' prefix
+        if await refuse_claimed_order(query, order_id, user.id):
+            return
         # Store the order_id in user context for the next messages
+        context.user_data.pop('awaiting_album', None)
         context.user_data['awaiting_card_image'] = order_id
         
         keyboard = [[InlineKeyboardButton("❌ إلغاء", callback_data=f'pending_order_{order_id}')]]
@@ -357,6 +1027,51 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup
         )
     
+    # Handle batch fulfillment from an album of card images
+    elif query.data == 'album_fulfill':
+        groups = await db_manager.get_pending_order_groups()
+        if groups:
+            flags = await get_country_flags([group.get('country_code') or '' for group in groups])
+            keyboard = []
+            for group in groups:
+                keyboard.append([InlineKeyboardButton(
+                    f"{flags[group.get('country_code') or '']} {group['_id']} | {group['count']} طلب",
+                    callback_data=f"album_card_{group['_id']}"
+                )])
+            keyboard.append([InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')])
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(
+                query,
+                "📸 التسليم الجماعي بألبوم صور\n\nاختر البطاقة، ثم أرسل ألبوماً من صورها لتسليمها لأقدم الطلبات المعلقة بالترتيب:",
+                reply_markup
+            )
+        else:
+            keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
+            reply_markup = InlineKeyboardMarkup(keyboard)
+            await safe_edit_message(query, "✅ لا توجد طلبات معلقة حالياً", reply_markup)
+    
+    elif query.data.startswith('album_card_'):
+        card_id = query.data[11:]  # Remove 'album_card_' prefix
+        context.user_data.pop('awaiting_card_image', None)
+        context.user_data['awaiting_album'] = card_id
+        
+        keyboard = [[InlineKeyboardButton("✅ إنهاء التسليم الجماعي", callback_data='album_done')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(
+            query,
+            f"📸 التسليم الجماعي للبطاقة {card_id}\n\n"
+            f"📤 أرسل ألبوماً من صور البطاقات (حتى 10 صور في الألبوم). "
+            f"تُسلَّم الصورة الأولى لأقدم طلب معلق، والثانية للطلب الذي يليه، وهكذا.\n\n"
+            f"💡 يمكنك إرسال عدة ألبومات متتالية.",
+            reply_markup
+        )
+    
+    elif query.data == 'album_done':
+        context.user_data.pop('awaiting_album', None)
+        keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(query, "✅ تم إنهاء التسليم الجماعي", reply_markup)
+    
     # Handle card management
     elif query.data == 'add_card':
         # Start card addition process
@@ -371,12 +1086,13 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup
         )
     
-    elif query.data == 'view_cards':
-        # Show all cards
-        cards = await get_all_cards_for_admin()
+    elif matches_screen(query.data, 'view_cards'):
+        # Show one page of cards
+        page = await db_manager.get_cards_page(page_cursor(query.data), 10)
+        cards = page.items
         if cards:
             cards_text = "📋 جميع البطاقات:\n\n"
-            for card in cards[:10]:  # Show first 10 cards
+            for card in cards:
                 available_count = card.get('number_of_available_cards', 0)
                 status = f"✅ متاحة ({available_count})" if card.get('is_available') and available_count > 0 else "❌ غير متاحة"
                 cards_text += f"🏷️ {card['card_type']}\n"
@@ -385,7 +1101,9 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 cards_text += f"💳 القيمة: {card.get('value', card['price'])} USDT\n"
                 cards_text += f"📊 {status}\n\n"
             
-            keyboard = [[InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')]]
+            keyboard = []
+            add_page_row(keyboard, page, 'view_cards')
+            keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, cards_text, reply_markup)
         else:
@@ -393,12 +1111,13 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "📋 لا توجد بطاقات في النظام حالياً", reply_markup)
     
-    elif query.data == 'edit_cards':
-        # Show cards for editing
-        cards = await get_all_cards_for_admin()
+    elif matches_screen(query.data, 'edit_cards'):
+        # Show one page of cards for editing
+        page = await db_manager.get_cards_page(page_cursor(query.data), 20)
+        cards = page.items
         if cards:
             keyboard = []
-            for card in cards[:20]:  # Limit to 20 cards to avoid message length issues
+            for card in cards:
                 available_count = card.get('number_of_available_cards', 0)
                 status_icon = "✅" if card['is_available'] and available_count > 0 else "❌"
                 card_text = f"{status_icon} {card['card_type']} - {card['country_code']} (${card['price']}) ({available_count})"
@@ -407,6 +1126,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                     callback_data=f"edit_card_{card['card_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'edit_cards')
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -420,12 +1140,13 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "❌ لا توجد بطاقات للتعديل", reply_markup)
     
-    elif query.data == 'toggle_cards':
-        # Show cards for toggling availability
-        cards = await get_all_cards_for_admin()
+    elif matches_screen(query.data, 'toggle_cards'):
+        # Show one page of cards for toggling availability
+        page = await db_manager.get_cards_page(page_cursor(query.data), 20)
+        cards = page.items
         if cards:
             keyboard = []
-            for card in cards[:20]:  # Limit to 20 cards
+            for card in cards:
                 status_icon = "✅" if card['is_available'] else "❌"
                 action_text = "إلغاء" if card['is_available'] else "تفعيل"
                 card_text = f"{status_icon} {card['card_type']} - {card['country_code']} ({action_text})"
@@ -434,6 +1155,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                     callback_data=f"toggle_card_{card['card_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'toggle_cards')
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -447,18 +1169,19 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "❌ لا توجد بطاقات للتعديل", reply_markup)
     
-    elif query.data == 'remove_cards':
-        # Show grouped cards for removal
-        grouped_cards = await db_manager.get_grouped_cards_for_deletion()
+    elif matches_screen(query.data, 'remove_cards'):
+        # Show one page of card groups for removal
+        page = await db_manager.get_cards_page(page_cursor(query.data), 20, by_country=True)
+        grouped_cards = page.items
         if grouped_cards:
+            flags = await get_country_flags([card_group['country_code'] for card_group in grouped_cards])
             keyboard = []
             for card_group in grouped_cards:
                 # Get country flag
-                country_info = await get_country_info(card_group['country_code'])
-                flag = country_info.get('flag', '🌍')
+                flag = flags[card_group['country_code']]
                 
                 # Format: "Visa - IL ($20.0) (5) ❌"
-                card_text = f"{card_group['card_type']} - {flag} {card_group['country_code']} (${card_group['price']}) ({card_group['count']}) ❌"
+                card_text = f"{card_group['card_type']} - {flag} {card_group['country_code']} (${card_group['price']}) ({card_group.get('number_of_available_cards', 0)}) ❌"
                 
                 # Use callback data format: remove_group_countrycode_cardtype_price
                 callback_data = f"remove_group_{card_group['country_code']}_{card_group['card_type'].replace(' ', '_')}_{card_group['price']}"
@@ -467,6 +1190,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                     callback_data=callback_data
                 )])
             
+            add_page_row(keyboard, page, 'remove_cards')
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -480,14 +1204,15 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "❌ لا توجد بطاقات للحذف", reply_markup)
     
-    elif query.data == 'view_deleted_cards':
-        # Show deleted cards
-        deleted_cards = await get_deleted_cards_for_admin()
+    elif matches_screen(query.data, 'view_deleted_cards'):
+        # Show one page of deleted cards
+        page = await db_manager.get_cards_page(page_cursor(query.data), 15, deleted=True)
+        deleted_cards = page.items
         if deleted_cards:
+            flags = await get_country_flags([card['country_code'] for card in deleted_cards])
             cards_text = "🗂️ البطاقات المحذوفة:\n\n"
-            for i, card in enumerate(deleted_cards[:15], 1):  # Limit to 15 cards
-                country_info = await get_country_info(card['country_code'])
-                flag = country_info.get('flag', '🌍')
+            for i, card in enumerate(deleted_cards, 1):
+                flag = flags[card['country_code']]
                 deleted_at = card.get('deleted_at', 'غير محدد')
                 if isinstance(deleted_at, datetime):
                     deleted_at = deleted_at.strftime('%Y-%m-%d %H:%M')
@@ -496,10 +1221,10 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 cards_text += f"   💰 السعر: ${card['price']} | 💳 القيمة: ${card['value']}\n"
                 cards_text += f"   📅 تاريخ الحذف: {deleted_at}\n\n"
             
-            keyboard = [
-                [InlineKeyboardButton("♻️ استعادة البطاقات", callback_data='restore_cards')],
-                [InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')]
-            ]
+            keyboard = []
+            add_page_row(keyboard, page, 'view_deleted_cards')
+            keyboard.append([InlineKeyboardButton("♻️ استعادة البطاقات", callback_data='restore_cards')])
+            keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة البطاقات", callback_data='manage_cards')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, cards_text, reply_markup)
         else:
@@ -507,20 +1232,22 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "✅ لا توجد بطاقات محذوفة", reply_markup)
     
-    elif query.data == 'restore_cards':
-        # Show deleted cards for restoration
-        deleted_cards = await get_deleted_cards_for_admin()
+    elif matches_screen(query.data, 'restore_cards'):
+        # Show one page of deleted cards for restoration
+        page = await db_manager.get_cards_page(page_cursor(query.data), 20, deleted=True)
+        deleted_cards = page.items
         if deleted_cards:
+            flags = await get_country_flags([card['country_code'] for card in deleted_cards])
             keyboard = []
-            for card in deleted_cards[:20]:  # Limit to 20 cards
-                country_info = await get_country_info(card['country_code'])
-                flag = country_info.get('flag', '🌍')
+            for card in deleted_cards:
+                flag = flags[card['country_code']]
                 card_text = f"♻️ {card['card_type']} - {flag} {card['country_code']} (${card['price']})"
                 keyboard.append([InlineKeyboardButton(
                     card_text,
                     callback_data=f"restore_card_{card['card_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'restore_cards')
             keyboard.append([InlineKeyboardButton("🔙 العودة للبطاقات المحذوفة", callback_data='view_deleted_cards')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -661,19 +1388,22 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup
         )
     
-    elif query.data == 'view_black_websites':
-        # Show all black websites
-        websites = await get_all_black_websites_for_admin()
+    elif matches_screen(query.data, 'view_black_websites'):
+        # Show one page of black websites
+        page = await db_manager.get_black_websites_page(page_cursor(query.data), 10)
+        websites = page.items
         if websites:
             websites_text = "📋 جميع المواقع السوداء:\n\n"
-            for website in websites[:10]:  # Show first 10 websites
+            for website in websites:
                 status = "✅ متاح" if website.get('is_available') else "❌ غير متاح"
                 websites_text += f"🌐 {website['name']}\n"
                 websites_text += f"🔗 {website['url']}\n"
                 websites_text += f"💰 ${website['price']}\n"
                 websites_text += f"📊 {status}\n\n"
             
-            keyboard = [[InlineKeyboardButton("🔙 العودة لإدارة المواقع", callback_data='manage_black_websites')]]
+            keyboard = []
+            add_page_row(keyboard, page, 'view_black_websites')
+            keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المواقع", callback_data='manage_black_websites')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, websites_text, reply_markup)
         else:
@@ -681,18 +1411,20 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "📋 لا توجد مواقع في النظام حالياً", reply_markup)
     
-    elif query.data == 'edit_black_websites':
-        # Show websites for editing
-        websites = await get_all_black_websites_for_admin()
+    elif matches_screen(query.data, 'edit_black_websites'):
+        # Show one page of websites for editing
+        page = await db_manager.get_black_websites_page(page_cursor(query.data), 20)
+        websites = page.items
         if websites:
             keyboard = []
-            for website in websites[:20]:  # Limit to 20 websites
+            for website in websites:
                 status_icon = "✅" if website['is_available'] else "❌"
                 keyboard.append([InlineKeyboardButton(
                     f"{status_icon} {website['name']} - ${website['price']}",
                     callback_data=f"edit_website_{website['website_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'edit_black_websites')
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المواقع", callback_data='manage_black_websites')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -706,18 +1438,20 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "❌ لا توجد مواقع للتعديل", reply_markup)
     
-    elif query.data == 'delete_black_websites':
-        # Show websites for deletion
-        websites = await get_all_black_websites_for_admin()
+    elif matches_screen(query.data, 'delete_black_websites'):
+        # Show one page of websites for deletion
+        page = await db_manager.get_black_websites_page(page_cursor(query.data), 20)
+        websites = page.items
         if websites:
             keyboard = []
-            for website in websites[:20]:  # Limit to 20 websites
+            for website in websites:
                 status_icon = "✅" if website['is_available'] else "❌"
                 keyboard.append([InlineKeyboardButton(
                     f"{status_icon} {website['name']} - ${website['price']}",
                     callback_data=f"delete_website_{website['website_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'delete_black_websites')
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المواقع", callback_data='manage_black_websites')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -734,7 +1468,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # Handle individual country actions - ORDER MATTERS! More specific patterns first
     elif query.data.startswith('edit_country_name_'):
         country_code = query.data[18:]  # Remove 'edit_country_name_' prefix
-        logger.info(f"Starting country name edit for: {country_code} (full callback: {query.data})")
+        logger.info("Starting country name edit for: %s (full callback: %s)", country_code, query.data)
         
         # Verify country exists before starting edit process
         country = await db_manager.get_country_by_code(country_code)
@@ -759,7 +1493,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     elif query.data.startswith('edit_country_flag_'):
         country_code = query.data[18:]  # Remove 'edit_country_flag_' prefix
-        logger.info(f"Starting country flag edit for: {country_code} (full callback: {query.data})")
+        logger.info("Starting country flag edit for: %s (full callback: %s)", country_code, query.data)
         
         # Verify country exists before starting edit process
         country = await db_manager.get_country_by_code(country_code)
@@ -784,7 +1518,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     
     elif query.data.startswith('edit_country_'):
         country_code = query.data[13:]  # Remove 'edit_country_' prefix
-        logger.info(f"Edit country callback: {query.data} -> extracted code: {country_code}")
+        logger.info("Edit country callback: %s -> extracted code: %s", query.data, country_code)
         country = await db_manager.get_country_by_code(country_code)
         
         if country:
@@ -1003,6 +1737,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     elif query.data == 'manage_users':
         keyboard = [
             [InlineKeyboardButton("📋 عرض المستخدمين", callback_data='list_users')],
+            [InlineKeyboardButton("🔍 بحث عن مستخدم", callback_data='search_users')],
             [InlineKeyboardButton("💰 شحن رصيد", callback_data='charge_balance')],
             [InlineKeyboardButton("🚫 حظر/إلغاء حظر", callback_data='block_users')],
             [InlineKeyboardButton("📊 إحصائيات المستخدمين", callback_data='user_stats')],
@@ -1015,18 +1750,105 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup
         )
     
-    elif query.data == 'list_users':
-        # Show users list
-        users = await get_all_users_for_admin()
+    elif query.data == 'exports':
+        keyboard = [
+            [InlineKeyboardButton(label, callback_data=f"export_{dataset}")]
+            for dataset, label in EXPORT_LABELS.items()
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 العودة للقائمة الرئيسية", callback_data='start')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(
+            query,
+            "📤 تصدير البيانات\n\nاختر البيانات التي تريد تصديرها:\n\n💡 لفترة محددة استخدم الأمر /export",
+            reply_markup
+        )
+    
+    elif query.data.startswith('export_'):
+        dataset = query.data[7:]  # Remove 'export_' prefix
+        keyboard = []
+        for days, label in EXPORT_RANGES:
+            row = [InlineKeyboardButton(f"📄 {label} - CSV", callback_data=f"run_export_{dataset}_{days}_{CSV}")]
+            if parquet_available():
+                row.append(InlineKeyboardButton("📦 Parquet", callback_data=f"run_export_{dataset}_{days}_{PARQUET}"))
+            keyboard.append(row)
+        keyboard.append([InlineKeyboardButton("🔙 العودة للتصدير", callback_data='exports')])
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(
+            query,
+            f"📤 تصدير {EXPORT_LABELS.get(dataset, dataset)}\n\nاختر الفترة والصيغة:",
+            reply_markup
+        )
+    
+    elif query.data.startswith('run_export_'):
+        # Parse callback data: run_export_dataset_days_format
+        dataset, days, export_format = query.data[11:].rsplit('_', 2)
+        start = datetime.now(UTC) - timedelta(days=int(days)) if int(days) else None
+        keyboard = [[InlineKeyboardButton("🔙 العودة للتصدير", callback_data='exports')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(
+            query,
+            f"⏳ جاري تصدير {EXPORT_LABELS.get(dataset, dataset)}...\n\nسيتم إرسال الملف عند الانتهاء.",
+            reply_markup
+        )
+        # The export runs as its own task so the bot keeps handling updates meanwhile
+        context.application.create_task(
+            detached(send_export(context.bot, query.message.chat_id, dataset, start, None, export_format)),
+            update=update
+        )
+    
+    elif query.data == 'search_users':
+        context.user_data['searching_user'] = True
+        keyboard = [[InlineKeyboardButton("❌ إلغاء", callback_data='cancel_user_search')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(
+            query,
+            "🔍 البحث عن مستخدم\n\nأرسل معرف المستخدم أو @اسم_المستخدم أو جزءاً من الاسم:",
+            reply_markup
+        )
+    
+    elif query.data == 'cancel_user_search':
+        context.user_data.pop('searching_user', None)
+        keyboard = [[InlineKeyboardButton("🔙 العودة لإدارة المستخدمين", callback_data='manage_users')]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        await safe_edit_message(query, "❌ تم إلغاء البحث", reply_markup)
+    
+    # Checked after the other cancel_* callbacks, which share its prefix
+    elif query.data.startswith('cancel_'):
+        order_id = query.data[7:]  # Remove 'cancel_' prefix
+        if await cancel_order(order_id, user.id):
+            await safe_edit_message(query, f"❌ تم إلغاء الطلب #{order_id}\n\n💰 تم استرداد المبلغ وإشعار العميل.")
+        else:
+            await safe_edit_message(query, f"❌ فشل في إلغاء الطلب #{order_id} (ربما لم يعد معلقاً أو استلمه مسؤول آخر)")
+    
+    elif query.data == 'confirm_batch_cancel':
+        order_filter = context.user_data.pop('batch_cancel', None)
+        if order_filter is None:
+            await safe_edit_message(query, "❌ انتهت صلاحية هذا الطلب، يرجى إعادة الأمر /cancel_orders")
+            return
+        await safe_edit_message(query, "⏳ جاري إلغاء الطلبات، سيتم إرسال النتيجة عند الانتهاء...")
+        context.application.create_task(
+            detached(run_batch_cancel(context.bot, query.message.chat_id, order_filter)),
+            update=update
+        )
+    
+    elif query.data == 'discard_batch_cancel':
+        context.user_data.pop('batch_cancel', None)
+        await safe_edit_message(query, "↩️ تم التراجع عن الإلغاء الجماعي")
+    
+    elif matches_screen(query.data, 'list_users'):
+        # Show one page of the users list
+        page = await db_manager.get_users_page(page_cursor(query.data), 15)
+        users = page.items
         if users:
+            blacklisted = await db_manager.get_blacklisted_user_ids([user['user_id'] for user in users])
             keyboard = []
             users_text = "👥 قائمة المستخدمين:\n\n"
             
-            for i, user in enumerate(users[:15], 1):  # Show first 15 users
+            for i, user in enumerate(users, 1):
                 username = user.get('username', 'غير محدد')
                 first_name = user.get('first_name', 'غير محدد')
                 balance = user.get('balance', 0.0)
-                is_blocked = await db_manager.is_blacklisted(user['user_id'])
+                is_blocked = user['user_id'] in blacklisted
                 
                 status_icon = "🚫" if is_blocked else "👤"
                 users_text += f"{i}. {status_icon} {first_name} (@{username}) | ${balance:.2f}\n"
@@ -1037,6 +1859,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                     callback_data=f"user_{user['user_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'list_users')
             keyboard.append([InlineKeyboardButton("🔄 تحديث القائمة", callback_data='list_users')])
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المستخدمين", callback_data='manage_users')])
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1050,16 +1873,18 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "📭 لا يوجد مستخدمون مسجلون حالياً", reply_markup)
     
-    elif query.data == 'charge_balance':
-        # Show users for balance charging
-        users = await get_all_users_for_admin()
+    elif matches_screen(query.data, 'charge_balance'):
+        # Show one page of users for balance charging
+        page = await db_manager.get_users_page(page_cursor(query.data), 20)
+        users = page.items
         if users:
+            blacklisted = await db_manager.get_blacklisted_user_ids([user['user_id'] for user in users])
             keyboard = []
-            for user in users[:20]:  # Show first 20 users
+            for user in users:
                 username = user.get('username', 'غير محدد')
                 first_name = user.get('first_name', 'غير محدد')
                 balance = user.get('balance', 0.0)
-                is_blocked = await db_manager.is_blacklisted(user['user_id'])
+                is_blocked = user['user_id'] in blacklisted
                 
                 if not is_blocked:  # Only show non-blocked users
                     user_text = f"💰 {first_name} (@{username}) - ${balance:.2f}"
@@ -1068,6 +1893,8 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                         callback_data=f"charge_user_{user['user_id']}"
                     )])
             
+            # A page may hold only blocked users while later pages do not
+            add_page_row(keyboard, page, 'charge_balance')
             if keyboard:
                 keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المستخدمين", callback_data='manage_users')])
                 reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1085,15 +1912,17 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             reply_markup = InlineKeyboardMarkup(keyboard)
             await safe_edit_message(query, "📭 لا يوجد مستخدمون مسجلون", reply_markup)
     
-    elif query.data == 'block_users':
-        # Show users for blocking/unblocking
-        users = await get_all_users_for_admin()
+    elif matches_screen(query.data, 'block_users'):
+        # Show one page of users for blocking/unblocking
+        page = await db_manager.get_users_page(page_cursor(query.data), 20)
+        users = page.items
         if users:
+            blacklisted = await db_manager.get_blacklisted_user_ids([user['user_id'] for user in users])
             keyboard = []
-            for user in users[:20]:  # Show first 20 users
+            for user in users:
                 username = user.get('username', 'غير محدد')
                 first_name = user.get('first_name', 'غير محدد')
-                is_blocked = await db_manager.is_blacklisted(user['user_id'])
+                is_blocked = user['user_id'] in blacklisted
                 
                 status_icon = "🚫" if is_blocked else "👤"
                 action_text = "إلغاء حظر" if is_blocked else "حظر"
@@ -1104,6 +1933,7 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                     callback_data=f"toggle_block_{user['user_id']}"
                 )])
             
+            add_page_row(keyboard, page, 'block_users')
             keyboard.append([InlineKeyboardButton("🔙 العودة لإدارة المستخدمين", callback_data='manage_users')])
             reply_markup = InlineKeyboardMarkup(keyboard)
             
@@ -1165,18 +1995,30 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         
         if transactions:
             trans_text = f"💳 معاملات المستخدم #{user_id}:\n\n"
+            
+            # Latest snapshot plus the entries after it should add up to the stored balance
+            statement = await db_manager.get_ledger_statement(user_id)
+            if statement and statement['snapshot']:
+                balance = await db_manager.get_user_balance(user_id)
+                matches = abs(statement['balance'] - balance) < 0.005
+                trans_text += f"📌 آخر لقطة (#{statement['snapshot']['seq']}): ${statement['snapshot']['balance']:.2f}\n"
+                trans_text += f"➕ {len(statement['entries'])} معاملة بعدها → ${statement['balance']:.2f}\n"
+                trans_text += f"{'✅ الرصيد مطابق' if matches else '⚠️ الرصيد غير مطابق'}: ${balance:.2f}\n\n"
+            
             for i, trans in enumerate(transactions, 1):
                 trans_type = trans.get('type', 'غير محدد')
                 amount = trans.get('amount', 0.0)
                 description = trans.get('description', 'غير محدد')
-                created_at = trans.get('created_at', datetime.now(UTC))
+                timestamp = trans.get('timestamp', datetime.now(UTC))
                 
-                if isinstance(created_at, datetime):
-                    date_str = created_at.strftime('%m-%d %H:%M')
+                if isinstance(timestamp, datetime):
+                    date_str = timestamp.strftime('%m-%d %H:%M')
                 else:
                     date_str = 'غير محدد'
                 
-                trans_text += f"{i}. {trans_type} - ${amount:.2f} | {date_str}\n   {description}\n\n"
+                balance_after = trans.get('balance_after')
+                balance_text = f" → ${balance_after:.2f}" if balance_after is not None else ""
+                trans_text += f"{i}. {trans_type} - ${amount:.2f}{balance_text} | {date_str}\n   {description}\n\n"
             
             keyboard = [[InlineKeyboardButton("🔙 العودة لتفاصيل المستخدم", callback_data=f'user_{user_id}')]]
             reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1438,14 +2280,8 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             country_name = country_info.get('name', country_code)
             
             # Get the count of cards in this group
-            grouped_cards = await db_manager.get_grouped_cards_for_deletion()
-            card_count = 0
-            for group in grouped_cards:
-                if (group['country_code'] == country_code and 
-                    group['card_type'] == card_type and 
-                    group['price'] == price):
-                    card_count = group['count']
-                    break
+            card = await db_manager.get_available_card_from_group(country_code, card_type, price)
+            card_count = card.get('number_of_available_cards', 0) if card else 0
             
             keyboard = [
                 [InlineKeyboardButton("✅ نعم، احذف جميع البطاقات", callback_data=f"confirm_remove_group_{country_code}_{card_type.replace(' ', '_')}_{price}")],
@@ -1553,7 +2389,10 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
     # Handle card details input
     elif query.data.startswith('input_card_'):
         order_id = query.data[11:]  # Remove 'input_card_' prefix
+        if await refuse_claimed_order(query, order_id, user.id):
+            return
         # Store the order_id in user context for the next messages
+        context.user_data.pop('awaiting_album', None)
         context.user_data['awaiting_card_image'] = order_id
         
         keyboard = [[InlineKeyboardButton("❌ إلغاء", callback_data='start')]]
@@ -1565,13 +2404,78 @@ async def order_button_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         )
 
 
+# Telegram sends each photo of an album as its own message; an album is
+# processed once no new photo of it arrived for this long
+ALBUM_WAIT_SECONDS = 1.5
+
+
+def buffer_album_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Collect a photo of the album being sent and schedule the album's processing"""
+    message = update.message
+    key = message.media_group_id or str(message.message_id)
+    albums = context.chat_data.setdefault('albums', {})
+    album = albums.get(key)
+    if album is None:
+        album = albums[key] = {'card_id': context.user_data['awaiting_album'], 'admin_id': update.effective_user.id, 'photos': []}
+        context.application.create_task(detached(process_album(context.bot, message.chat_id, albums, key)), update=update)
+    album['photos'].append((message.message_id, message.photo[-1].file_id))
+    album['last_photo_at'] = time.monotonic()
+
+
+async def download_photo(bot, file_id: str) -> bytearray:
+    file = await bot.get_file(file_id)
+    return await file.download_as_bytearray()
+
+
+async def process_album(bot, chat_id: int, albums: dict, key: str) -> None:
+    """Wait for the rest of an album, then deliver its photos to the oldest pending orders of its card"""
+    album = albums[key]
+    while True:
+        wait = album['last_photo_at'] + ALBUM_WAIT_SECONDS - time.monotonic()
+        if wait <= 0:
+            break
+        await asyncio.sleep(wait)
+    albums.pop(key, None)
+    card_id = album['card_id']
+    
+    # file_ids only work for the bot that received them, so the customer bot
+    # gets the image bytes; all photos of the album are downloaded at once
+    file_ids = [file_id for _, file_id in sorted(album['photos'])]
+    downloads = await asyncio.gather(*(download_photo(bot, file_id) for file_id in file_ids), return_exceptions=True)
+    images = [base64.b64encode(data).decode('utf-8') for data in downloads if not isinstance(data, BaseException)]
+    failed = len(downloads) - len(images)
+    for error in downloads:
+        if isinstance(error, BaseException):
+            logger.error("Error downloading album photo for card %s: %s", card_id, error)
+    
+    try:
+        orders = await db_manager.fulfill_orders_with_images(card_id, images, album['admin_id'])
+    except Exception as e:
+        logger.error("Error fulfilling orders of card %s from an album: %s", card_id, e)
+        await bot.send_message(chat_id=chat_id, text="❌ حدث خطأ أثناء تسليم الألبوم. يرجى إرسال الصور مرة أخرى.")
+        return
+    
+    result_text = f"✅ تم تسليم {len(orders)} طلب للبطاقة {card_id}\n\n"
+    for order in orders:
+        result_text += f"• #{order['order_id'][:8]} → {order['user_id']}\n"
+    if len(images) > len(orders):
+        result_text += f"\n⚠️ {len(images) - len(orders)} صورة لم تُستخدم: لا توجد طلبات معلقة كافية لهذه البطاقة (غير مستلمة من مسؤول آخر)"
+    if failed:
+        result_text += f"\n❌ فشل تنزيل {failed} صورة، يرجى إعادة إرسالها"
+    await bot.send_message(chat_id=chat_id, text=result_text)
+
+
 async def handle_card_image_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle image upload for card details"""
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
+        return
+    
+    # Photos sent during batch fulfillment are grouped into albums
+    if context.user_data.get('awaiting_album') and update.message.photo:
+        buffer_album_photo(update, context)
         return
     
     # Check if we're waiting for card image
@@ -1593,15 +2497,18 @@ async def handle_card_image_upload(update: Update, context: ContextTypes.DEFAULT
         file = await context.bot.get_file(photo.file_id)
         file_bytes = await file.download_as_bytearray()
         
-        # Create notification for customer bot to send image to user
-        await create_card_image_delivery_notification(order_id, file_bytes)
-        
-        # Update order status
-        await db_manager.update_order_status(order_id, 'completed')
+        # Complete the order and queue the image for the customer bot in one step: it may
+        # have been cancelled and refunded or claimed by another admin meanwhile
+        image_base64 = base64.b64encode(file_bytes).decode('utf-8')
+        delivered = await db_manager.deliver_card_image(order_id, image_base64, user.id)
         
         # Clear only the specific context key we used
         context.user_data.pop('awaiting_card_image', None)
         
+        if not delivered:
+            await update.message.reply_text(f"⚠️ الطلب #{order_id} لم يعد معلقاً (ربما أُلغي أو اكتمل أو استلمه مسؤول آخر)، لم يتم إرسال الصورة.")
+            return
+        
         # keyboard = [[InlineKeyboardButton("🏠 العودة للقائمة الرئيسية", callback_data='start')]]
         keyboard = []
         reply_markup = InlineKeyboardMarkup(keyboard)
@@ -1618,7 +2525,7 @@ async def handle_card_image_upload(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text(confirmation_text, reply_markup=reply_markup)
         
     except Exception as e:
-        logger.error(f"Error handling card image upload: {e}")
+        logger.error("Error handling card image upload: %s", e)
         await update.message.reply_text("❌ حدث خطأ في معالجة الصورة. يرجى المحاولة مرة أخرى.")
 
 
@@ -1627,8 +2534,7 @@ async def handle_card_addition_text(update: Update, context: ContextTypes.DEFAUL
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
         return
     
     # Handle card editing
@@ -1761,7 +2667,7 @@ async def handle_card_addition_text(update: Update, context: ContextTypes.DEFAUL
                 await update.message.reply_text("❌ يرجى إدخال رقم صحيح للعدد (مثال: 5)")
     
     except Exception as e:
-        logger.error(f"Error handling card addition: {e}")
+        logger.error("Error handling card addition: %s", e)
         # Clear card addition context on error
         for key in ['adding_card', 'card_step', 'card_type', 'country_code', 'country_name', 'price', 'value']:
             context.user_data.pop(key, None)
@@ -1813,7 +2719,7 @@ async def handle_card_editing(update: Update, context: ContextTypes.DEFAULT_TYPE
             await update.message.reply_text("❌ فشل في تحديث البطاقة", reply_markup=reply_markup)
             
     except Exception as e:
-        logger.error(f"Error updating card: {e}")
+        logger.error("Error updating card: %s", e)
         context.user_data.pop('editing_card', None)
         context.user_data.pop('edit_field', None)
         await update.message.reply_text("❌ حدث خطأ في تحديث البطاقة")
@@ -1870,51 +2776,35 @@ async def handle_balance_charging(update: Update, context: ContextTypes.DEFAULT_
             await update.message.reply_text("❌ يرجى إدخال رقم صحيح (مثال: 25.50)")
             
     except Exception as e:
-        logger.error(f"Error handling balance charging: {e}")
+        logger.error("Error handling balance charging: %s", e)
         context.user_data.pop('charging_user', None)
         await update.message.reply_text("❌ حدث خطأ في شحن الرصيد")
 
 
-async def create_card_image_delivery_notification(order_id: str, image_data: bytearray):
-    """Create notification for customer bot to deliver card image"""
-    try:
-        # Get order details to find the user
-        order = await db_manager.get_order_by_id(order_id)
-        if not order:
-            logger.error(f"Order {order_id} not found")
-            return
-        
-        # Convert bytearray to base64 for storage
-        image_base64 = base64.b64encode(image_data).decode('utf-8')
-        
-        notification_data = {
-            "order_id": order_id,
-            "user_id": order.get('user_id'),
-            "image_data": image_base64
-        }
-        
-        notification_id = await db_manager.create_notification("deliver_card_image", notification_data)
-        if notification_id:
-            logger.info(f"Created card image delivery notification {notification_id} for order {order_id}")
-        else:
-            logger.error(f"Failed to create card image delivery notification for order {order_id}")
-            
-    except Exception as e:
-        logger.error(f"Error creating card image delivery notification: {e}")
-
-
-async def get_all_cards_for_admin():
-    """Get all cards for admin view (excluding deleted cards)"""
-    try:
-        # Get all cards from database (excluding deleted ones)
-        cursor = db_manager.cards.find({
-            "is_deleted": {"$ne": True}  # Exclude deleted cards
-        }).sort("created_at", -1)
-        cards = await cursor.to_list(length=None)
-        return cards
-    except Exception as e:
-        logger.error(f"Error getting cards for admin: {e}")
-        return []
+async def handle_broadcast_composition(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle the text of a new broadcast and ask for confirmation"""
+    text = update.message.text.strip()
+    if not text:
+        await update.message.reply_text("❌ يرجى إدخال نص الرسالة")
+        return
+    if len(text) > 4096:
+        await update.message.reply_text("❌ الرسالة طويلة جداً. الحد الأقصى هو 4096 حرفاً")
+        return
+    
+    context.user_data.pop('composing_broadcast', None)
+    context.user_data['broadcast_text'] = text
+    
+    keyboard = [
+        [InlineKeyboardButton("✅ إرسال للجميع", callback_data='confirm_broadcast')],
+        [InlineKeyboardButton("❌ إلغاء", callback_data='discard_broadcast')]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    # The preview is sent as a separate message so the full text can be checked
+    await update.message.reply_text(text)
+    await update.message.reply_text(
+        "⚠️ سيتم إرسال الرسالة أعلاه لجميع المستخدمين غير المحظورين. هل تريد المتابعة؟",
+        reply_markup=reply_markup
+    )
 
 
 async def add_card_to_database(card_data):
@@ -1931,14 +2821,14 @@ async def add_card_to_database(card_data):
         result = await db_manager.cards.insert_one(card_data)
         
         if result.inserted_id:
-            logger.info(f"Added new card: {card_id}")
+            logger.info("Added new card: %s", card_id)
             return True
         else:
-            logger.error(f"Failed to add card: {card_id}")
+            logger.error("Failed to add card: %s", card_id)
             return False
             
     except Exception as e:
-        logger.error(f"Error adding card to database: {e}")
+        logger.error("Error adding card to database: %s", e)
         return False
 
 
@@ -1974,10 +2864,10 @@ async def add_bulk_cards_to_database(card_base_data, quantity):
             )
             
             if result.modified_count > 0:
-                logger.info(f"Updated existing card {existing_card['card_id']} with {quantity} additional units")
+                logger.info("Updated existing card %s with %s additional units", existing_card['card_id'], quantity)
                 return quantity
             else:
-                logger.error(f"Failed to update existing card {existing_card['card_id']}")
+                logger.error("Failed to update existing card %s", existing_card['card_id'])
                 return 0
         else:
             # Create new card with the specified quantity
@@ -1991,17 +2881,17 @@ async def add_bulk_cards_to_database(card_base_data, quantity):
                 result = await db_manager.cards.insert_one(card_data)
                 
                 if result.inserted_id:
-                    logger.info(f"Added new card {card_id} with {quantity} units")
+                    logger.info("Added new card %s with %s units", card_id, quantity)
                     return quantity
                 else:
-                    logger.error(f"Failed to add new card {card_id}")
+                    logger.error("Failed to add new card %s", card_id)
                     return 0
             except Exception as insert_error:
-                logger.error(f"Error inserting card {card_id}: {insert_error}")
+                logger.error("Error inserting card %s: %s", card_id, insert_error)
                 return 0
         
     except Exception as e:
-        logger.error(f"Error adding card to database: {e}")
+        logger.error("Error adding card to database: %s", e)
         return 0
 
 
@@ -2018,14 +2908,14 @@ async def ensure_country_exists(country_code, country_name):
             # Add country to countries collection using database manager
             success = await db_manager.add_country(country_code, country_name, flag)
             if success:
-                logger.info(f"Added new country: {country_code} - {country_name}")
+                logger.info("Added new country: %s - %s", country_code, country_name)
             else:
-                logger.error(f"Failed to add country: {country_code}")
+                logger.error("Failed to add country: %s", country_code)
         else:
-            logger.info(f"Country already exists: {country_code}")
+            logger.info("Country already exists: %s", country_code)
             
     except Exception as e:
-        logger.error(f"Error ensuring country exists: {e}")
+        logger.error("Error ensuring country exists: %s", e)
 
 
 async def get_card_by_id(card_id):
@@ -2034,7 +2924,7 @@ async def get_card_by_id(card_id):
         card = await db_manager.cards.find_one({"card_id": card_id})
         return card
     except Exception as e:
-        logger.error(f"Error getting card by ID {card_id}: {e}")
+        logger.error("Error getting card by ID %s: %s", card_id, e)
         return None
 
 
@@ -2047,14 +2937,14 @@ async def update_card_field(card_id, field, value):
         )
         
         if result.modified_count > 0:
-            logger.info(f"Updated card {card_id}: {field} = {value}")
+            logger.info("Updated card %s: %s = %s", card_id, field, value)
             return True
         else:
-            logger.error(f"Failed to update card {card_id}: {field} = {value}")
+            logger.error("Failed to update card %s: %s = %s", card_id, field, value)
             return False
             
     except Exception as e:
-        logger.error(f"Error updating card field: {e}")
+        logger.error("Error updating card field: %s", e)
         return False
 
 
@@ -2075,14 +2965,14 @@ async def toggle_card_availability(card_id):
         
         if result.modified_count > 0:
             status_text = "متاحة" if new_status else "غير متاحة"
-            logger.info(f"Toggled card {card_id} availability to: {status_text}")
+            logger.info("Toggled card %s availability to: %s", card_id, status_text)
             return True
         else:
-            logger.error(f"Failed to toggle card {card_id} availability")
+            logger.error("Failed to toggle card %s availability", card_id)
             return False
             
     except Exception as e:
-        logger.error(f"Error toggling card availability: {e}")
+        logger.error("Error toggling card availability: %s", e)
         return False
 
 
@@ -2101,30 +2991,17 @@ async def remove_card_from_database(card_id):
         )
         
         if result.modified_count > 0:
-            logger.info(f"Soft deleted card: {card_id}")
+            logger.info("Soft deleted card: %s", card_id)
             return True
         else:
-            logger.error(f"Failed to soft delete card: {card_id}")
+            logger.error("Failed to soft delete card: %s", card_id)
             return False
             
     except Exception as e:
-        logger.error(f"Error soft deleting card from database: {e}")
+        logger.error("Error soft deleting card from database: %s", e)
         return False
 
 
-async def get_deleted_cards_for_admin():
-    """Get all deleted cards for admin view"""
-    try:
-        cursor = db_manager.cards.find({
-            "is_deleted": True  # Only deleted cards
-        }).sort("deleted_at", -1)
-        cards = await cursor.to_list(length=None)
-        return cards
-    except Exception as e:
-        logger.error(f"Error getting deleted cards for admin: {e}")
-        return []
-
-
 async def restore_card_from_deletion(card_id):
     """Restore a soft-deleted card"""
     try:
@@ -2143,35 +3020,24 @@ async def restore_card_from_deletion(card_id):
         )
         
         if result.modified_count > 0:
-            logger.info(f"Restored card: {card_id}")
+            logger.info("Restored card: %s", card_id)
             return True
         else:
-            logger.error(f"Failed to restore card: {card_id}")
+            logger.error("Failed to restore card: %s", card_id)
             return False
             
     except Exception as e:
-        logger.error(f"Error restoring card from deletion: {e}")
+        logger.error("Error restoring card from deletion: %s", e)
         return False
 
 
 # Black websites management functions
-async def get_all_black_websites_for_admin():
-    """Get all black websites for admin view"""
-    try:
-        websites = await db_manager.get_all_black_websites()
-        return websites
-    except Exception as e:
-        logger.error(f"Error getting black websites for admin: {e}")
-        return []
-
-
 async def handle_black_website_addition_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle text input for adding new black websites"""
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
         return
     
     # Check if we're adding a black website
@@ -2250,7 +3116,7 @@ async def handle_black_website_addition_text(update: Update, context: ContextTyp
             context.user_data.pop('website_price', None)
         
     except Exception as e:
-        logger.error(f"Error in black website addition: {e}")
+        logger.error("Error in black website addition: %s", e)
         await update.message.reply_text("❌ حدث خطأ. يرجى المحاولة مرة أخرى.")
 
 
@@ -2259,8 +3125,7 @@ async def handle_black_website_editing(update: Update, context: ContextTypes.DEF
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
         return
     
     # Check if we're editing a black website
@@ -2304,7 +3169,7 @@ async def handle_black_website_editing(update: Update, context: ContextTypes.DEF
         context.user_data.pop('editing_field', None)
         
     except Exception as e:
-        logger.error(f"Error in black website editing: {e}")
+        logger.error("Error in black website editing: %s", e)
         await update.message.reply_text("❌ حدث خطأ. يرجى المحاولة مرة أخرى.")
 
 
@@ -2313,8 +3178,7 @@ async def handle_country_addition_text(update: Update, context: ContextTypes.DEF
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
         return
     
     # Check if we're adding a country
@@ -2398,14 +3262,14 @@ async def handle_country_addition_text(update: Update, context: ContextTypes.DEF
             context.user_data.pop('country_name', None)
         
     except Exception as e:
-        logger.error(f"Error in country addition: {e}")
+        logger.error("Error in country addition: %s", e)
         await update.message.reply_text("❌ حدث خطأ. يرجى المحاولة مرة أخرى.")
 
 
 async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Route text input to appropriate handler based on context"""
     # Log current context for debugging
-    logger.info(f"Text input routing - user_data keys: {list(context.user_data.keys())}")
+    logger.info("Text input routing - user_data keys: %s", list(context.user_data.keys()))
     
     # Check what type of input we're expecting
     if context.user_data.get('adding_card'):
@@ -2426,6 +3290,12 @@ async def handle_text_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif context.user_data.get('charging_user'):
         logger.info("Routing to user charging handler")
         await handle_balance_charging(update, context)
+    elif context.user_data.get('composing_broadcast'):
+        logger.info("Routing to broadcast composition handler")
+        await handle_broadcast_composition(update, context)
+    elif context.user_data.get('searching_user'):
+        logger.info("Routing to user search handler")
+        await handle_user_search(update, context)
     else:
         logger.info("No matching context found for text input")
 
@@ -2435,8 +3305,7 @@ async def handle_country_editing(update: Update, context: ContextTypes.DEFAULT_T
     user = update.effective_user
     
     # Check if user is admin
-    admin_id = os.getenv('ADMIN_USER_ID')
-    if not admin_id or str(user.id) != admin_id:
+    if not await db_manager.is_admin(user.id):
         return
     
     # Check if we're editing a country
@@ -2447,7 +3316,7 @@ async def handle_country_editing(update: Update, context: ContextTypes.DEFAULT_T
     step = context.user_data.get('country_step')
     text = update.message.text
     
-    logger.info(f"Country editing: code={country_code}, step={step}, text={text}")
+    logger.info("Country editing: code=%s, step=%s, text=%s", country_code, step, text)
     
     try:
         # First verify the country exists
@@ -2492,7 +3361,7 @@ async def handle_country_editing(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data.pop('country_step', None)
         
     except Exception as e:
-        logger.error(f"Error in country editing: {e}")
+        logger.error("Error in country editing: %s", e)
         keyboard = [[InlineKeyboardButton("🔙 العودة لإدارة الدول", callback_data='manage_countries')]]
         reply_markup = InlineKeyboardMarkup(keyboard)
         await update.message.reply_text(
@@ -2504,91 +3373,47 @@ async def handle_country_editing(update: Update, context: ContextTypes.DEFAULT_T
         context.user_data.pop('country_step', None)
 
 
-async def complete_order(order_id):
+async def complete_order(order_id, admin_id):
     """Mark an order as completed and notify the customer"""
     try:
-        # Update order status to completed
-        result = await db_manager.orders.update_one(
-            {"order_id": order_id},
-            {
-                "$set": {
-                    "status": "completed",
-                    "completed_at": datetime.now(UTC)
-                }
+        # Only a still pending order is completed: a cancelled one was already refunded
+        order = await db_manager.complete_order(order_id, admin_id)
+        if order:
+            # Create notification for customer
+            notification_data = {
+                "user_id": order['user_id'],
+                "order_id": order_id,
+                "message": f"✅ تم إكمال طلبك #{order_id} بنجاح!\n\n🎉 شكراً لك على استخدام خدماتنا."
             }
-        )
-        
-        if result.modified_count > 0:
-            # Get order details for notification
-            order = await db_manager.get_order_by_id(order_id)
-            if order:
-                # Create notification for customer
-                notification_data = {
-                    "user_id": order['user_id'],
-                    "order_id": order_id,
-                    "message": f"✅ تم إكمال طلبك #{order_id} بنجاح!\n\n🎉 شكراً لك على استخدام خدماتنا."
-                }
-                
-                await db_manager.create_notification("order_completed", notification_data)
-                logger.info(f"Order {order_id} marked as completed")
-                return True
+            
+            await db_manager.create_notification("order_completed", notification_data)
+            logger.info("Order %s marked as completed", order_id)
+            return True
         
-        logger.error(f"Failed to complete order {order_id}")
+        logger.error("Failed to complete order %s (no longer pending or claimed by another admin)", order_id)
         return False
         
     except Exception as e:
-        logger.error(f"Error completing order {order_id}: {e}")
+        logger.error("Error completing order %s: %s", order_id, e)
         return False
 
 
-async def cancel_order(order_id):
-    """Cancel an order and notify the customer"""
+async def cancel_order(order_id, admin_id):
+    """Cancel a pending order, refund the customer, restore the stock and notify the customer"""
     try:
-        # Update order status to cancelled
-        result = await db_manager.orders.update_one(
-            {"order_id": order_id},
-            {
-                "$set": {
-                    "status": "cancelled",
-                    "cancelled_at": datetime.now(UTC)
-                }
-            }
-        )
-        
-        if result.modified_count > 0:
-            # Get order details for notification
-            order = await db_manager.get_order_by_id(order_id)
-            if order:
-                # Create notification for customer
-                notification_data = {
-                    "user_id": order['user_id'],
-                    "order_id": order_id,
-                    "message": f"❌ تم إلغاء طلبك #{order_id}\n\n💬 إذا كان لديك أي استفسار، يرجى التواصل مع الدعم."
-                }
-                
-                await db_manager.create_notification("order_cancelled", notification_data)
-                logger.info(f"Order {order_id} cancelled")
-                return True
+        cancelled = await db_manager.cancel_orders({"order_id": order_id, **db_manager.actionable_by(admin_id)}, "admin", 1)
+        if cancelled:
+            logger.info("Order %s cancelled", order_id)
+            return True
         
-        logger.error(f"Failed to cancel order {order_id}")
+        logger.error("Failed to cancel order %s", order_id)
         return False
         
     except Exception as e:
-        logger.error(f"Error cancelling order {order_id}: {e}")
+        logger.error("Error cancelling order %s: %s", order_id, e)
         return False
 
 
-async def get_all_users_for_admin():
-    """Get all users for admin management"""
-    try:
-        cursor = db_manager.users.find({}).sort("created_at", -1)
-        users = await cursor.to_list(length=None)
-        return users
-    except Exception as e:
-        logger.error(f"Error getting users for admin: {e}")
-        return []
-
-
 async def get_user_statistics():
     """Get user statistics for admin dashboard"""
     try:
@@ -2623,7 +3448,7 @@ async def get_user_statistics():
             'total_sales': total_sales
         }
     except Exception as e:
-        logger.error(f"Error getting user statistics: {e}")
+        logger.error("Error getting user statistics: %s", e)
         return {
             'total_users': 0,
             'active_users': 0,
@@ -2641,32 +3466,25 @@ async def get_user_orders(user_id):
         orders = await cursor.to_list(length=None)
         return orders
     except Exception as e:
-        logger.error(f"Error getting orders for user {user_id}: {e}")
+        logger.error("Error getting orders for user %s: %s", user_id, e)
         return []
 
 
 async def charge_user_balance(user_id, amount):
     """Charge user balance and create notification"""
     try:
-        logger.info(f"Starting balance charge for user {user_id} with amount ${amount:.2f}")
-        
-        # Update user balance
-        success = await db_manager.update_user_balance(user_id, amount)
+        logger.info("Starting balance charge for user %s with amount $%.2f", user_id, amount)
+        
+        # Update user balance and record it in the ledger
+        new_balance = await db_manager.apply_balance_change(
+            user_id,
+            amount,
+            "admin_charge",
+            description=f"شحن رصيد من الإدارة: ${amount:.2f}"
+        )
         
-        if success:
-            logger.info(f"Successfully updated balance for user {user_id}")
-            
-            # Create transaction record
-            await db_manager.create_transaction(
-                user_id=user_id,
-                transaction_type="admin_charge",
-                amount=amount,
-                description=f"شحن رصيد من الإدارة: ${amount:.2f}"
-            )
-            
-            # Get updated balance
-            new_balance = await db_manager.get_user_balance(user_id)
-            logger.info(f"New balance for user {user_id}: ${new_balance:.2f}")
+        if new_balance is not None:
+            logger.info("New balance for user %s: $%.2f", user_id, new_balance)
             
             # Create notification for customer
             notification_data = {
@@ -2678,19 +3496,19 @@ async def charge_user_balance(user_id, amount):
             
             notification_id = await db_manager.create_notification("balance_updated", notification_data)
             if notification_id:
-                logger.info(f"Created balance notification {notification_id} for user {user_id}")
+                logger.info("Created balance notification %s for user %s", notification_id, user_id)
             else:
-                logger.error(f"Failed to create balance notification for user {user_id}")
+                logger.error("Failed to create balance notification for user %s", user_id)
             
-            logger.info(f"Charged user {user_id} with ${amount:.2f}")
+            logger.info("Charged user %s with $%.2f", user_id, amount)
             return True
         else:
-            logger.error(f"Failed to update balance for user {user_id}")
+            logger.error("Failed to update balance for user %s", user_id)
         
         return False
         
     except Exception as e:
-        logger.error(f"Error charging user {user_id} balance: {e}")
+        logger.error("Error charging user %s balance: %s", user_id, e)
         return False
 
 
@@ -2718,13 +3536,13 @@ async def toggle_user_block_status(user_id, should_block):
             
             notification_type = "user_unblocked" if not should_block else "user_blocked"
             await db_manager.create_notification(notification_type, notification_data)
-            logger.info(f"User {user_id} {action} successfully")
+            logger.info("User %s %s successfully", user_id, action)
             return True
         
         return False
         
     except Exception as e:
-        logger.error(f"Error toggling user {user_id} block status: {e}")
+        logger.error("Error toggling user %s block status: %s", user_id, e)
         return False
 
 
@@ -2732,14 +3550,11 @@ async def process_notifications(application):
     """Background task to process pending notifications for order bot (only new_order notifications)"""
     while True:
         try:
-            # Get pending notifications
-            notifications = await db_manager.get_pending_notifications()
-            
-            # Filter to only process new_order notifications
-            order_notifications = [n for n in notifications if n.get('type') == 'new_order']
+            # Get pending new_order notifications (the rest are delivered by the customer bot)
+            order_notifications = await db_manager.get_pending_notifications(['new_order'])
             
             if order_notifications:
-                logger.info(f"Order bot found {len(order_notifications)} new order notifications to process")
+                logger.info("Order bot found %s new order notifications to process", len(order_notifications))
             
             for notification in order_notifications:
                 await handle_notification(application, notification)
@@ -2748,7 +3563,7 @@ async def process_notifications(application):
             await asyncio.sleep(5)
             
         except Exception as e:
-            logger.error(f"Error in order notification processing: {e}")
+            logger.error("Error in order notification processing: %s", e)
             await asyncio.sleep(10)  # Wait longer on error
 
 
@@ -2762,26 +3577,28 @@ async def handle_notification(application, notification):
             await send_order_notification(application, data)
             # Mark notification as processed only if we handled it
             await db_manager.mark_notification_processed(notification['notification_id'])
-            logger.info(f"Processed notification {notification['notification_id']}")
+            logger.info("Processed notification %s", notification['notification_id'])
         else:
             # Don't process notifications that should be handled by the customer bot
-            logger.debug(f"Skipping notification {notification['notification_id']} of type {notification_type} - should be handled by customer bot")
+            logger.debug("Skipping notification %s of type %s - should be handled by customer bot", notification['notification_id'], notification_type)
         
     except Exception as e:
-        logger.error(f"Error handling notification {notification.get('notification_id')}: {e}")
+        logger.error("Error handling notification %s: %s", notification.get('notification_id'), e)
+        # Retry later with backoff; repeated failures end up in the dead letters
+        await db_manager.record_notification_failure(notification, str(e))
 
 
 async def send_order_notification(application, data):
-    """Send order notification to admin"""
+    """Send a new order to every on-duty admin, with a button to claim it"""
     try:
-        admin_id = os.getenv('ADMIN_USER_ID')
-        if not admin_id:
-            logger.warning("ADMIN_USER_ID not set in environment variables")
+        admin_ids = await db_manager.get_on_duty_admin_ids()
+        if not admin_ids:
+            logger.warning("No admins to notify about order %s", data.get('order_id'))
             return
         
-        admin_id = int(admin_id)
         user_data = data.get('user', {})
         card_data = data.get('card', {})
+        order_id = data.get('order_id')
         
         notification_text = f"""
 🔔 طلب جديد!
@@ -2792,34 +3609,83 @@ async def send_order_notification(application, data):
 📧 اسم المستخدم: @{user_data.get('username', 'غير محدد')}
 
 🛒 تفاصيل الطلب:
-🆔 رقم الطلب: {data.get('order_id')}
+🆔 رقم الطلب: {order_id}
 🏷️ نوع البطاقة: {card_data.get('card_type')}
 🌍 الدولة: {card_data.get('country_name')}
 💰 المبلغ: {card_data.get('price')} USDT
 
 ⏰ وقت الطلب: {data.get('timestamp')}
 
-يرجى إرسال تفاصيل البطاقة للمستخدم.
+يرجى استلام الطلب ثم إرسال تفاصيل البطاقة للمستخدم.
         """
         
         # Create keyboard with action buttons
         keyboard = [
-            [InlineKeyboardButton("✅ تم الإرسال", callback_data=f"sent_{data.get('order_id')}")],
-            [InlineKeyboardButton("❌ إلغاء الطلب", callback_data=f"cancel_{data.get('order_id')}")],
-            [InlineKeyboardButton("📋 عرض التفاصيل", callback_data=f"details_{data.get('order_id')}")]
+            [InlineKeyboardButton("🙋 استلام الطلب", callback_data=f"claim_{order_id}")],
+            [InlineKeyboardButton("📋 عرض التفاصيل", callback_data=f"details_{order_id}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
-        await application.bot.send_message(
-            chat_id=admin_id,
-            text=notification_text,
-            reply_markup=reply_markup
-        )
+        results = await asyncio.gather(*(
+            application.bot.send_message(chat_id=admin_id, text=notification_text, reply_markup=reply_markup)
+            for admin_id in admin_ids
+        ), return_exceptions=True)
+        
+        alerts = []
+        for admin_id, result in zip(admin_ids, results):
+            if isinstance(result, BaseException):
+                logger.error("Error sending order %s to admin %s: %s", order_id, admin_id, result)
+            else:
+                alerts.append({"admin_id": admin_id, "message_id": result.message_id})
+        if not alerts:
+            # Let the notification processor retry
+            raise results[0]
         
-        logger.info(f"Sent order notification for order {data.get('order_id')} to admin {admin_id}")
+        await db_manager.add_order_alerts(order_id, alerts)
+        logger.info("Sent order notification for order %s to %s admins", order_id, len(alerts))
         
     except Exception as e:
-        logger.error(f"Error sending order notification: {e}")
+        logger.error("Error sending order notification: %s", e)
+        raise
+
+
+def admin_display_name(user) -> str:
+    """Name shown to the other admins for an admin's actions"""
+    return f"@{user.username}" if user.username else (user.first_name or str(user.id))
+
+
+def claimed_by_other(order: dict, admin_id: int) -> bool:
+    """Whether another admin claimed the order, so only they may deliver, complete or cancel it"""
+    return order.get('claimed_by') not in (None, admin_id)
+
+
+async def refuse_claimed_order(query, order_id: str, admin_id: int) -> bool:
+    """Tell the admin when another admin is handling the order; True when they must not act on it"""
+    order = await db_manager.get_order_by_id(order_id)
+    if not order or not claimed_by_other(order, admin_id):
+        return False
+    keyboard = [[InlineKeyboardButton("🔙 العودة للطلبات المعلقة", callback_data='pending_orders')]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    await safe_edit_message(query, f"🔒 الطلب #{order_id} استلمه {order.get('claimed_by_name')}، لا يمكنك التعامل معه", reply_markup)
+    return True
+
+
+async def mark_alerts_claimed(bot, order: dict, claimed_by: int) -> None:
+    """Show on the other admins' new-order messages who claimed the order"""
+    text = (
+        f"🔒 الطلب #{order['order_id']} استلمه {order.get('claimed_by_name')}\n\n"
+        f"💰 المبلغ: {order.get('amount')} USDT"
+    )
+    alerts = [alert for alert in order.get('alerts', []) if alert['admin_id'] != claimed_by]
+    for alert in alerts:
+        render_cache.forget((alert['admin_id'], alert['message_id']))
+    results = await asyncio.gather(*(
+        bot.edit_message_text(chat_id=alert['admin_id'], message_id=alert['message_id'], text=text)
+        for alert in alerts
+    ), return_exceptions=True)
+    for alert, result in zip(alerts, results):
+        if isinstance(result, BaseException):
+            logger.warning("Error updating alert of order %s for admin %s: %s", order['order_id'], alert['admin_id'], result)
 
 
 async def startup_database(application):
@@ -2832,46 +3698,78 @@ async def startup_database(application):
         asyncio.create_task(process_notifications(application))
         logging.info("Started notification processor")
         
+        # Log slow MongoDB queries with their plan summary
+        asyncio.create_task(process_slow_queries(db_manager))
+        
+        # Expose Prometheus metrics on a local port
+        await start_metrics_server(int(os.getenv('ORDER_METRICS_PORT', '9102') or 0), db_manager)
+        
     except Exception as e:
-        logging.error(f"Failed to connect to database: {e}")
+        logging.error("Failed to connect to database: %s", e)
         raise
 
 
 async def shutdown_database(application):
-    """Close database connection"""
+    """Stop the metrics endpoint and close database connection"""
+    await stop_metrics_server()
     await db_manager.disconnect()
     logging.info("Order bot database disconnected")
 
 
+def build_application(token: str, request: Optional[BaseRequest] = None) -> Application:
+    """Create the order bot application with all its handlers (replay.py passes a stubbed request)"""
+    # Bot API calls are timed for the metrics endpoint
+    application = Application.builder().token(token).request(request or build_request()).build()
+    
+    # Add startup and shutdown handlers
+    application.post_init = startup_database
+    application.post_shutdown = shutdown_database
+    
+    # Record anonymized updates for replay benchmarks (ORDER_UPDATE_RECORD_PATH)
+    register_update_recorder(application, os.getenv('ORDER_UPDATE_RECORD_PATH'), 'order_bot', db_manager.owner_admin_id())
+    
+    # Remembered renders per message (RENDER_CACHE_SIZE)
+    render_cache.load_from_env()
+    
+    # Measure MongoDB round-trips per update (runs before and after the handlers below)
+    register_update_instrumentation(application)
+    
+    # Ask the user to retry when an update runs out of database time
+    application.add_error_handler(deadline_error_handler)
+    
+    # Cancel and refund pending orders nobody handled in time
+    schedule_order_expiry(application)
+    
+    # Add command and message handlers
+    application.add_handler(CommandHandler("start", start_order_bot))
+    application.add_handler(CommandHandler("dbstats", dbstats_command))
+    application.add_handler(CommandHandler("search", search_command))
+    application.add_handler(CommandHandler("export", export_command))
+    application.add_handler(CommandHandler("reconcile", reconcile_command))
+    application.add_handler(CommandHandler("cancel_orders", cancel_orders_command))
+    application.add_handler(CommandHandler("admins", admins_command))
+    application.add_handler(CommandHandler("duty", duty_command))
+    application.add_handler(CallbackQueryHandler(order_button_handler))
+    application.add_handler(MessageHandler(filters.PHOTO, handle_card_image_upload))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
+    
+    return application
+
+
 def main() -> None:
     """Main function to start the order management bot"""
     # Load environment variables
     load_dotenv()
     
-    # Configure logging
-    logging.basicConfig(
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        level=logging.INFO
-    )
+    # Configure non-blocking logging
+    configure_logging()
     
     # Get bot token from environment
     ORDER_BOT_TOKEN = os.getenv('ORDER_BOT_TOKEN')
     if not ORDER_BOT_TOKEN:
         logging.error("ORDER_BOT_TOKEN not found in environment variables")
         return
-    
-    # Create application
-    application = Application.builder().token(ORDER_BOT_TOKEN).build()
-    
-    # Add startup and shutdown handlers
-    application.post_init = startup_database
-    application.post_shutdown = shutdown_database
-    
-    # Add command and message handlers
-    application.add_handler(CommandHandler("start", start_order_bot))
-    application.add_handler(CallbackQueryHandler(order_button_handler))
-    application.add_handler(MessageHandler(filters.PHOTO, handle_card_image_upload))
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text_input))
+    application = build_application(ORDER_BOT_TOKEN)
     
     # Get webhook configuration
     WEBHOOK_URL = os.getenv('ORDER_WEBHOOK_URL')
@@ -2880,8 +3778,8 @@ def main() -> None:
     
     if USE_WEBHOOKS and WEBHOOK_URL:
         # Run with webhooks
-        logging.info(f"Starting order management bot with webhooks on port {WEBHOOK_PORT}...")
-        logging.info(f"Webhook URL: {WEBHOOK_URL}")
+        logging.info("Starting order management bot with webhooks on port %s...", WEBHOOK_PORT)
+        logging.info("Webhook URL: %s", WEBHOOK_URL)
         
         application.run_webhook(
             listen="0.0.0.0",
@@ -0,0 +1,179 @@
+"""
+Keyset pagination for the admin list screens
+
+A page is fetched with a range query on the screen's sort key plus `_id` as a
+tie-breaker, so every tap reads exactly one page whatever the collection size.
+The position is carried in the button's callback_data as `<screen>:<n|p><cursor>`,
+where the cursor packs the sort values of the first/last row on the page into a
+few bytes of URL-safe base64 to stay under Telegram's 64-byte limit.
+"""
+import base64
+import struct
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional, Tuple
+from bson import ObjectId
+from telegram import InlineKeyboardButton
+
+logger = logging.getLogger(__name__)
+
+# Telegram rejects callback_data longer than this
+MAX_CALLBACK_DATA = 64
+
+NEXT = 'n'
+PREV = 'p'
+
+EPOCH = datetime(1970, 1, 1)
+_MILLISECOND = timedelta(milliseconds=1)
+
+
+class Page:
+    """One page of an admin list with the cursors of its first and last rows"""
+
+    def __init__(self, items: List[Dict[str, Any]], has_prev: bool, has_next: bool, sort: List[Tuple[str, int]]):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.sort = sort
+
+    def cursor(self, direction: str) -> str:
+        """Cursor to the page before (PREV) or after (NEXT) this one"""
+        row = self.items[0] if direction == PREV else self.items[-1]
+        return direction + encode_cursor([row.get(field) for field, _ in self.sort])
+
+
+def _pack_value(value: Any) -> bytes:
+    if value is None:
+        return b'n'
+    if isinstance(value, ObjectId):
+        return b'o' + value.binary
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(timezone.utc).replace(tzinfo=None)
+        return b'd' + struct.pack('>q', (value - EPOCH) // _MILLISECOND)
+    if isinstance(value, bool):
+        return b'b' + (b'\x01' if value else b'\x00')
+    if isinstance(value, int):
+        return b'i' + struct.pack('>q', value)
+    if isinstance(value, float):
+        return b'f' + struct.pack('>d', value)
+    if isinstance(value, str):
+        encoded = value.encode('utf-8')
+        return b's' + struct.pack('>B', len(encoded)) + encoded
+    raise TypeError(f"Cannot paginate on a {type(value).__name__} value")
+
+
+def encode_cursor(values: List[Any]) -> str:
+    """Pack sort values into a short URL-safe string"""
+    raw = b''.join(_pack_value(value) for value in values)
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(cursor: str) -> List[Any]:
+    """Unpack the sort values of encode_cursor"""
+    raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+    values = []
+    i = 0
+    while i < len(raw):
+        tag = raw[i:i + 1]
+        i += 1
+        if tag == b'n':
+            values.append(None)
+        elif tag == b'o':
+            values.append(ObjectId(raw[i:i + 12]))
+            i += 12
+        elif tag == b'd':
+            values.append(EPOCH + struct.unpack('>q', raw[i:i + 8])[0] * _MILLISECOND)
+            i += 8
+        elif tag == b'b':
+            values.append(raw[i] == 1)
+            i += 1
+        elif tag == b'i':
+            values.append(struct.unpack('>q', raw[i:i + 8])[0])
+            i += 8
+        elif tag == b'f':
+            values.append(struct.unpack('>d', raw[i:i + 8])[0])
+            i += 8
+        elif tag == b's':
+            length = raw[i]
+            values.append(raw[i + 1:i + 1 + length].decode('utf-8'))
+            i += 1 + length
+        else:
+            raise ValueError(f"Unknown cursor tag {tag!r}")
+    return values
+
+
+def matches_screen(data: str, screen: str) -> bool:
+    """Whether callback_data opens a screen, on its first page or at a cursor"""
+    return data == screen or data.startswith(screen + ':')
+
+
+def page_cursor(data: str) -> Optional[str]:
+    """The cursor part of `<screen>:<cursor>` callback_data (None for the first page)"""
+    _, _, cursor = data.partition(':')
+    return cursor or None
+
+
+def _keyset_filter(sort: List[Tuple[str, int]], values: List[Any], forward: bool) -> Dict[str, Any]:
+    """Rows strictly after (forward) or before the row with the given sort values"""
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        ascending = (direction == 1) == forward
+        branch = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        branch[field] = {'$gt' if ascending else '$lt': values[i]}
+        branches.append(branch)
+    return {'$or': branches}
+
+
+async def fetch_page(collection, query: Dict[str, Any], sort: List[Tuple[str, int]], cursor: Optional[str] = None,
+                     page_size: int = 10) -> Page:
+    """Fetch one page of `query` in `sort` order starting at a cursor from Page.cursor"""
+    sort = list(sort) + [('_id', sort[-1][1] if sort else 1)]
+    forward = True
+    if cursor:
+        forward = cursor[0] != PREV
+        try:
+            values = decode_cursor(cursor[1:])
+        except Exception as e:
+            logger.warning("Ignoring invalid page cursor %r: %s", cursor, e)
+            values = None
+        if values is not None and len(values) == len(sort):
+            query = {'$and': [query, _keyset_filter(sort, values, forward)]}
+        else:
+            cursor = None
+            forward = True
+
+    # Going back reads the previous rows in reverse order and flips them
+    direction = 1 if forward else -1
+    rows = await collection.find(query).sort(
+        [(field, order * direction) for field, order in sort]
+    ).limit(page_size + 1).to_list(length=page_size + 1)
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if forward:
+        return Page(rows, has_prev=cursor is not None, has_next=more, sort=sort)
+    rows.reverse()
+    return Page(rows, has_prev=more, has_next=True, sort=sort)
+
+
+def page_buttons(page: Page, screen: str) -> List[InlineKeyboardButton]:
+    """Previous/next buttons for a page (empty when it is the only page)"""
+    buttons = []
+    if not page.items:
+        return buttons
+    for direction, enabled, label in ((PREV, page.has_prev, "⬅️ السابق"), (NEXT, page.has_next, "التالي ➡️")):
+        if not enabled:
+            continue
+        callback_data = f"{screen}:{page.cursor(direction)}"
+        if len(callback_data.encode('utf-8')) > MAX_CALLBACK_DATA:
+            logger.warning("Page cursor for %s is too long for callback_data (%s bytes)", screen, len(callback_data))
+            continue
+        buttons.append(InlineKeyboardButton(label, callback_data=callback_data))
+    return buttons
+
+
+def add_page_row(keyboard: List[List[InlineKeyboardButton]], page: Page, screen: str):
+    """Append the previous/next row to a keyboard when the list has more than one page"""
+    buttons = page_buttons(page, screen)
+    if buttons:
+        keyboard.append(buttons)
@@ -0,0 +1,205 @@
+"""
+Ledger reconciliation
+
+Checks, for every user at once, that:
+  * users.balance equals the opening balance snapshot plus the sum of their ledger entries,
+  * the ledger has no missing entries (seq numbers handed out without an entry),
+  * what the ledger charged for orders matches the orders placed since the ledger started,
+    less refunds for cancelled ones.
+
+users, balance_snapshots, transactions and orders are streamed with projections into
+columnar NumPy arrays and aggregated with vectorized group-bys, so the check costs
+four sequential scans instead of queries per user.
+"""
+import time
+import asyncio
+import logging
+from array import array
+from datetime import UTC
+from typing import Any, Dict, List, Tuple
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Ledger entry types that pay for an order, and those that give the money back
+ORDER_DEBIT_TYPES = ('card_purchase',)
+ORDER_REFUND_TYPES = ('order_refund',)
+
+# Differences below half a cent are float noise
+TOLERANCE = 0.005
+
+# An order is inserted just before the ledger entry paying for it, so the first
+# purchase of a user predates their opening snapshot by a few milliseconds
+ORDER_SLACK_SECONDS = 5.0
+
+BATCH_SIZE = 5000
+
+
+def _timestamp(value) -> float:
+    """Seconds since the epoch of a (naive UTC) MongoDB datetime, NaN when missing"""
+    if value is None:
+        return float('nan')
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=UTC)
+    return value.timestamp()
+
+
+async def _stream_columns(collection, query: Dict[str, Any], columns: List[Tuple[str, str, Any]]) -> Dict[str, np.ndarray]:
+    """Read `columns` (name, array typecode, converter) of matching documents into NumPy arrays"""
+    projection = {name: 1 for name, _, _ in columns}
+    projection['_id'] = 0
+    buffers = {name: array(typecode) for name, typecode, _ in columns}
+    cursor = collection.find(query, projection).batch_size(BATCH_SIZE)
+    async for doc in cursor:
+        for name, _, convert in columns:
+            buffers[name].append(convert(doc.get(name)))
+    return {name: np.frombuffer(buffer, dtype=buffer.typecode) if len(buffer) else np.array([], dtype=buffer.typecode)
+            for name, buffer in buffers.items()}
+
+
+def _float(value) -> float:
+    try:
+        return float(value) if value is not None else 0.0
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _int(value) -> int:
+    try:
+        return int(value) if value is not None else 0
+    except (TypeError, ValueError):
+        return 0
+
+
+def _top(user_ids: np.ndarray, stored: np.ndarray, expected: np.ndarray, mask: np.ndarray, limit: int) -> List[Dict[str, Any]]:
+    diff = stored - expected
+    rows = np.flatnonzero(mask)
+    rows = rows[np.argsort(-np.abs(diff[rows]), kind='stable')][:limit]
+    return [
+        {"user_id": int(user_ids[i]), "stored": float(stored[i]), "expected": float(expected[i]), "diff": float(diff[i])}
+        for i in rows
+    ]
+
+
+def compute_report(users: Dict[str, np.ndarray], snapshots: Dict[str, np.ndarray], entries: Dict[str, np.ndarray],
+                   orders: Dict[str, np.ndarray], limit: int = 20) -> Dict[str, Any]:
+    """Aggregate the streamed columns per user and collect the discrepancies"""
+    order = np.argsort(users['user_id'], kind='stable')
+    user_ids = users['user_id'][order]
+    balance = users['balance'][order]
+    ledger_seq = users['ledger_seq'][order]
+    n = len(user_ids)
+
+    def index_of(ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Dense user index of each id, and which ids belong to a known user"""
+        idx = np.searchsorted(user_ids, ids)
+        idx[idx == n] = 0
+        known = (user_ids[idx] == ids) if n else np.zeros(len(ids), dtype=bool)
+        return idx, known
+
+    # Opening balances (snapshot at seq 0) mark the users the ledger covers
+    snap_idx, snap_known = index_of(snapshots['user_id'])
+    has_ledger = np.zeros(n, dtype=bool)
+    opening = np.zeros(n)
+    opened_at = np.full(n, np.inf)
+    has_ledger[snap_idx[snap_known]] = True
+    opening[snap_idx[snap_known]] = snapshots['balance'][snap_known]
+    opened_at[snap_idx[snap_known]] = snapshots['taken_at'][snap_known]
+
+    # Ledger totals per user
+    entry_idx, entry_known = index_of(entries['user_id'])
+    idx = entry_idx[entry_known]
+    amount = entries['amount'][entry_known]
+    ledger_total = np.bincount(idx, weights=amount, minlength=n)
+    entry_count = np.bincount(idx, minlength=n)
+    expected = opening + ledger_total
+    balance_mismatch = has_ledger & (np.abs(balance - expected) > TOLERANCE)
+
+    # seq numbers taken by the balance update whose entry was never written
+    missing = np.where(has_ledger, ledger_seq - entry_count, 0)
+    gap_rows = np.flatnonzero(missing > 0)
+
+    # Money the ledger moved for orders vs the orders themselves
+    kind = entries['kind'][entry_known]
+    order_net = np.bincount(idx[kind != 0], weights=amount[kind != 0], minlength=n)
+    order_idx, order_known = index_of(orders['user_id'])
+    in_ledger = order_known.copy()
+    in_ledger[order_known] = orders['created_at'][order_known] >= opened_at[order_idx[order_known]] - ORDER_SLACK_SECONDS
+    charged = in_ledger & ~orders['cancelled']
+    order_spend = np.bincount(order_idx[charged], weights=orders['amount'][charged], minlength=n)
+    order_mismatch = has_ledger & (np.abs(-order_net - order_spend) > TOLERANCE)
+
+    return {
+        "users": n,
+        "ledger_users": int(has_ledger.sum()),
+        "entries": int(len(entries['user_id'])),
+        "orders": int(len(orders['user_id'])),
+        "orphan_entries": int((~entry_known).sum()),
+        "balance_mismatches": int(balance_mismatch.sum()),
+        "balance_mismatch_total": float(np.abs(balance - expected)[balance_mismatch].sum()),
+        "order_mismatches": int(order_mismatch.sum()),
+        "missing_entries": int(missing[gap_rows].sum()),
+        "gap_users": [int(user_ids[i]) for i in gap_rows[:limit]],
+        "top_balance_mismatches": _top(user_ids, balance, expected, balance_mismatch, limit),
+        "top_order_mismatches": _top(user_ids, -order_net, order_spend, order_mismatch, limit),
+    }
+
+
+async def reconcile(db_manager, limit: int = 20) -> Dict[str, Any]:
+    """Reconcile every user's balance against the ledger and orders"""
+    started = time.monotonic()
+    order_kinds = {**{t: 1 for t in ORDER_DEBIT_TYPES}, **{t: 2 for t in ORDER_REFUND_TYPES}}
+
+    users = await _stream_columns(db_manager.users, {}, [
+        ('user_id', 'q', _int), ('balance', 'd', _float), ('ledger_seq', 'q', _int),
+    ])
+    snapshots = await _stream_columns(db_manager.balance_snapshots, {"seq": 0}, [
+        ('user_id', 'q', _int), ('balance', 'd', _float), ('taken_at', 'd', _timestamp),
+    ])
+    entries = await _stream_columns(db_manager.transactions, {"seq": {"$exists": True}}, [
+        ('user_id', 'q', _int), ('amount', 'd', _float), ('type', 'b', lambda value: order_kinds.get(value, 0)),
+    ])
+    entries['kind'] = entries.pop('type')
+    orders = await _stream_columns(db_manager.orders, {}, [
+        ('user_id', 'q', _int), ('amount', 'd', _float), ('created_at', 'd', _timestamp),
+        ('status', 'b', lambda value: value == 'cancelled'),
+    ])
+    orders['cancelled'] = orders.pop('status').astype(bool)
+    loaded = time.monotonic()
+
+    report = await asyncio.to_thread(compute_report, users, snapshots, entries, orders, limit)
+    report["load_seconds"] = loaded - started
+    report["compute_seconds"] = time.monotonic() - loaded
+    logger.info(
+        "Reconciled %s users / %s ledger entries / %s orders in %.2fs: %s balance and %s order mismatches, %s missing entries",
+        report["users"], report["entries"], report["orders"], report["load_seconds"] + report["compute_seconds"],
+        report["balance_mismatches"], report["order_mismatches"], report["missing_entries"]
+    )
+    return report
+
+
+def format_report(report: Dict[str, Any], limit: int = 10) -> str:
+    """Render a reconciliation report for the admin"""
+    text = f"""🧮 تسوية الأرصدة
+
+👥 المستخدمون: {report['users']} (منهم {report['ledger_users']} في السجل)
+💳 قيود السجل: {report['entries']}
+📋 الطلبات: {report['orders']}
+⏱️ المدة: {report['load_seconds'] + report['compute_seconds']:.2f} ث
+
+{'✅' if not report['balance_mismatches'] else '⚠️'} أرصدة غير مطابقة: {report['balance_mismatches']} (إجمالي الفرق ${report['balance_mismatch_total']:.2f})
+{'✅' if not report['order_mismatches'] else '⚠️'} طلبات غير مطابقة للسجل: {report['order_mismatches']}
+{'✅' if not report['missing_entries'] else '⚠️'} قيود مفقودة: {report['missing_entries']}
+{'✅' if not report['orphan_entries'] else '⚠️'} قيود لمستخدمين غير موجودين: {report['orphan_entries']}
+"""
+    if report['top_balance_mismatches']:
+        text += "\n💰 أكبر فروق الأرصدة:\n"
+        for row in report['top_balance_mismatches'][:limit]:
+            text += f"• #{row['user_id']}: المخزن ${row['stored']:.2f} | المتوقع ${row['expected']:.2f} | الفرق ${row['diff']:.2f}\n"
+    if report['top_order_mismatches']:
+        text += "\n📋 أكبر فروق الطلبات (المدفوع مقابل الطلبات):\n"
+        for row in report['top_order_mismatches'][:limit]:
+            text += f"• #{row['user_id']}: المدفوع ${row['stored']:.2f} | الطلبات ${row['expected']:.2f}\n"
+    if report['gap_users']:
+        text += "\n🕳️ مستخدمون لديهم قيود مفقودة: " + ", ".join(f"#{user_id}" for user_id in report['gap_users'][:limit]) + "\n"
+    return text
@@ -0,0 +1,77 @@
+"""
+Render-diff cache for callback message edits
+
+Refresh buttons usually re-render exactly what the message already shows.
+Instead of sending the edit and waiting for Telegram's "message is not
+modified" error, safe_edit_message compares a fingerprint of the new text and
+keyboard with the last one rendered into that message and skips the Bot API
+call when they match.
+"""
+import os
+import json
+import hashlib
+from typing import Optional, Tuple, Union
+from cachetools import LRUCache
+from telegram.error import BadRequest
+from metrics import render_cache_requests
+
+MessageKey = Union[str, Tuple[int, int]]
+
+
+def message_key(query) -> Optional[MessageKey]:
+    """Identify the message a callback query belongs to (None when unknown)"""
+    if query.inline_message_id:
+        return query.inline_message_id
+    message = query.message
+    if message is None:
+        return None
+    return (message.chat.id, message.message_id)
+
+
+def fingerprint(text: str, reply_markup=None) -> bytes:
+    """Digest of a message's text and keyboard"""
+    digest = hashlib.blake2b(text.encode('utf-8'), digest_size=16)
+    if reply_markup is not None:
+        digest.update(b'\0')
+        digest.update(json.dumps(reply_markup.to_dict(), sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return digest.digest()
+
+
+class RenderCache:
+    """Fingerprint of the last text and keyboard rendered into each message"""
+
+    def __init__(self, maxsize: int = 10000):
+        self._renders: LRUCache = LRUCache(maxsize=maxsize)
+
+    def load_from_env(self):
+        """Size the cache from RENDER_CACHE_SIZE (call once the environment is loaded)"""
+        maxsize = int(os.getenv('RENDER_CACHE_SIZE', str(self._renders.maxsize)))
+        if maxsize != self._renders.maxsize:
+            self._renders = LRUCache(maxsize=maxsize)
+
+    def is_unchanged(self, key: Optional[MessageKey], render: bytes) -> bool:
+        """Whether the message already shows this render"""
+        unchanged = key is not None and self._renders.get(key) == render
+        render_cache_requests.inc(result='hit' if unchanged else 'miss')
+        return unchanged
+
+    def remember(self, key: Optional[MessageKey], render: bytes):
+        if key is not None:
+            self._renders[key] = render
+
+    def forget(self, key: Optional[MessageKey]):
+        """Drop a message whose content changed outside safe_edit_message"""
+        if key is not None:
+            self._renders.pop(key, None)
+
+
+async def answer_unchanged(query, text: str):
+    """Answer the callback of an edit that had nothing to change"""
+    try:
+        await query.answer(text)
+    except BadRequest:
+        # The handler already answered this callback
+        pass
+
+
+render_cache = RenderCache()
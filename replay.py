@@ -0,0 +1,296 @@
+"""
+Replay recorded updates against a bot build and report how it performed
+
+Usage:
+    python replay.py updates.ndjson.gz --mongodb-url mongodb://localhost:27017/scratch
+                     [--bot bot|order_bot] [--speed 1|10|max] [--json report.json]
+
+Feeds a recording from update_recorder.py into the Application of bot.py or
+order_bot.py, one update at a time like polling does, at the recorded pace
+(--speed 1), N times faster, or back to back (--speed max). Bot API calls are
+answered by a stub request with canned responses (optionally after
+--api-latency-ms), so nothing reaches Telegram. The handlers write to the
+database (purchases, balances, orders), so it is never taken from MONGODB_URL:
+it has to be given with --mongodb-url or REPLAY_MONGODB_URL, and a server
+that is not on this machine is refused unless --i-know-this-is-not-local is
+passed. The report has handler latency percentiles overall and
+per update label, MongoDB commands per label from the instrumentation, Bot API
+calls per method and, for paced replays, how far behind schedule updates ran.
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import logging
+import argparse
+import importlib
+import ipaddress
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import numpy as np
+from dotenv import load_dotenv
+from telegram import Update
+from telegram.request import BaseRequest, RequestData
+from pymongo.uri_parser import parse_uri
+from logging_setup import configure_logging
+from monitoring import update_label, update_budget
+
+logger = logging.getLogger(__name__)
+
+BOTS = ('bot', 'order_bot')
+STUB_TOKEN = '123456:REPLAY'
+STUB_BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Replay", "username": "replay_bot"}
+
+PERCENTILES = (50, 90, 99)
+
+# Bot API methods answered with the message they sent or edited
+MESSAGE_METHODS = {'sendMessage', 'sendPhoto', 'sendDocument', 'editMessageText', 'editMessageReplyMarkup',
+                   'editMessageCaption', 'copyMessage', 'forwardMessage'}
+
+
+class StubRequest(BaseRequest):
+    """Bot API transport answering every call locally with a plausible response"""
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.latency = latency_ms / 1000
+        self.calls: Dict[str, int] = {}
+        self._message_id = 0
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    @property
+    def read_timeout(self) -> Optional[float]:
+        return None
+
+    def _message(self, parameters: Dict[str, Any]) -> Dict[str, Any]:
+        self._message_id += 1
+        chat_id = parameters.get('chat_id') or 0
+        message = {
+            "message_id": parameters.get('message_id') or self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0, "type": "private"},
+            "from": STUB_BOT_USER,
+        }
+        if 'text' in parameters:
+            message["text"] = parameters['text']
+        return message
+
+    def _result(self, api_method: str, parameters: Dict[str, Any]) -> Any:
+        if api_method == 'getMe':
+            return {**STUB_BOT_USER, "can_join_groups": False, "can_read_all_group_messages": False,
+                    "supports_inline_queries": False}
+        if api_method in MESSAGE_METHODS:
+            return self._message(parameters)
+        if api_method == 'getFile':
+            file_id = parameters.get('file_id', 'file')
+            return {"file_id": file_id, "file_unique_id": file_id[-16:], "file_size": 4, "file_path": f"photos/{file_id}.jpg"}
+        return True
+
+    async def do_request(self, url: str, method: str, request_data: Optional[RequestData] = None,
+                         read_timeout=None, write_timeout=None, connect_timeout=None,
+                         pool_timeout=None) -> Tuple[int, bytes]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if '/file/bot' in url:
+            self.calls['downloadFile'] = self.calls.get('downloadFile', 0) + 1
+            return 200, b'\xff\xd8\xff\xd9'
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        parameters = request_data.parameters if request_data is not None else {}
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, parameters)}).encode('utf-8')
+
+
+def read_recording(path: str) -> Tuple[Dict[str, Any], List[Tuple[float, Dict[str, Any]]]]:
+    """Read a recording into its first header and (offset, update) pairs, sessions played back to back"""
+    header: Dict[str, Any] = {}
+    updates: List[Tuple[float, Dict[str, Any]]] = []
+    session_start = 0.0
+    last = 0.0
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if record.get('type') == 'header':
+                    header = header or record
+                    session_start = last
+                    continue
+                last = session_start + record['t']
+                updates.append((last, record['update']))
+    except (EOFError, gzip.BadGzipFile, json.JSONDecodeError) as e:
+        # A recording cut short by a crash still replays up to the damaged part
+        logger.warning("Recording %s is truncated after %s updates: %s", path, len(updates), e)
+    return header, updates
+
+
+def percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return {f"p{p}": 0.0 for p in PERCENTILES} | {"max": 0.0}
+    array = np.asarray(values)
+    return {f"p{p}": float(np.percentile(array, p)) for p in PERCENTILES} | {"max": float(array.max())}
+
+
+def schedule(updates: List[Tuple[float, Dict[str, Any]]], speed: Optional[float]) -> Iterator[Tuple[Optional[float], Dict[str, Any]]]:
+    """Updates with the offset at which to feed them (None when replaying at max speed)"""
+    for offset, data in updates:
+        yield (offset / speed if speed else None), data
+
+
+async def replay(module, updates: List[Tuple[float, Dict[str, Any]]], speed: Optional[float],
+                 api_latency_ms: float) -> Dict[str, Any]:
+    """Feed the updates into a fresh application and collect the report"""
+    request = StubRequest(api_latency_ms)
+    application = module.build_application(STUB_TOKEN, request)
+    latencies: Dict[str, List[float]] = {}
+    lags: List[float] = []
+
+    async with application:
+        await application.post_init(application)
+        update_budget.prefix_totals.clear()
+        started = time.perf_counter()
+        for due, data in schedule(updates, speed):
+            if due is not None:
+                wait = due - (time.perf_counter() - started)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                else:
+                    lags.append(-wait)
+            update = Update.de_json(data, application.bot)
+            handled = time.perf_counter()
+            await application.process_update(update)
+            latencies.setdefault(update_label(update), []).append((time.perf_counter() - handled) * 1000)
+        duration = time.perf_counter() - started
+        await application.post_shutdown(application)
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    commands = {row['label']: row for row in update_budget.get_prefix_totals()}
+    labels = sorted(latencies, key=lambda label: sum(latencies[label]), reverse=True)
+    return {
+        "updates": len(all_latencies),
+        "duration_seconds": duration,
+        "speed": speed or 'max',
+        "latency_ms": percentiles(all_latencies),
+        "schedule_lag_ms": percentiles([lag * 1000 for lag in lags]) if speed else None,
+        "late_updates": len(lags) if speed else None,
+        "db_commands": sum(row['commands'] for row in commands.values()),
+        "db_ms": sum(row['db_ms'] for row in commands.values()),
+        "labels": [{
+            "label": label,
+            "updates": len(latencies[label]),
+            "latency_ms": percentiles(latencies[label]),
+            "db_commands": commands.get(label, {}).get('commands', 0),
+            "db_ms": commands.get(label, {}).get('db_ms', 0.0),
+        } for label in labels],
+        "bot_api_calls": dict(sorted(request.calls.items(), key=lambda item: item[1], reverse=True)),
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    """Render a replay report as a plain text table"""
+    def row(latency: Dict[str, float]) -> str:
+        return " ".join(f"{latency[key]:8.1f}" for key in (*(f"p{p}" for p in PERCENTILES), "max"))
+
+    latency_header = " ".join(f"{key:>8}" for key in (*(f"p{p}" for p in PERCENTILES), "max"))
+    lines = [
+        f"Replayed {report['updates']} updates in {report['duration_seconds']:.1f}s (speed {report['speed']})",
+        f"MongoDB: {report['db_commands']} commands, {report['db_ms']:.1f}ms",
+    ]
+    if report['schedule_lag_ms'] is not None:
+        lines.append(f"Behind schedule: {report['late_updates']} updates, lag ms {row(report['schedule_lag_ms'])}")
+    lines += ["", f"{'label':<32} {'updates':>8} {latency_header} {'db cmds':>8} {'cmds/upd':>8}",
+              f"{'all':<32} {report['updates']:>8} {row(report['latency_ms'])} {report['db_commands']:>8} "
+              f"{report['db_commands'] / report['updates'] if report['updates'] else 0.0:>8.1f}"]
+    for label in report['labels']:
+        per_update = label['db_commands'] / label['updates'] if label['updates'] else 0.0
+        lines.append(f"{label['label'][:32]:<32} {label['updates']:>8} {row(label['latency_ms'])} "
+                     f"{label['db_commands']:>8} {per_update:>8.1f}")
+    lines += ["", "Bot API calls: " + ", ".join(f"{method} {count}" for method, count in report['bot_api_calls'].items())]
+    return "\n".join(lines)
+
+
+def parse_speed(value: str) -> Optional[float]:
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError("speed must be positive or 'max'")
+    return speed
+
+
+def is_local_mongodb(url: str) -> bool:
+    """Whether every host of a MongoDB connection string is this machine"""
+    if url.startswith('mongodb+srv://'):
+        return False
+    try:
+        hosts = [host for host, _ in parse_uri(url)['nodelist']]
+    except Exception:
+        return False
+    for host in hosts:
+        if host.endswith('.sock') or host == 'localhost':
+            continue
+        try:
+            if not ipaddress.ip_address(host).is_loopback:
+                return False
+        except ValueError:
+            return False
+    return bool(hosts)
+
+
+def main() -> int:
+    """Replay a recording and print the report"""
+    load_dotenv()
+    configure_logging()
+
+    parser = argparse.ArgumentParser(description="Replay recorded updates against a bot build")
+    parser.add_argument('recording', help="gzip NDJSON file written by update_recorder.py")
+    parser.add_argument('--bot', choices=BOTS, help="bot to replay into (default: the one that recorded)")
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help="1 for the recorded pace, N for N times faster, or max")
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help="simulated Bot API round-trip")
+    parser.add_argument('--json', dest='json_path', help="also write the report to this file")
+    parser.add_argument('--mongodb-url', default=os.getenv('REPLAY_MONGODB_URL'),
+                        help="scratch MongoDB the handlers write to (default: REPLAY_MONGODB_URL)")
+    parser.add_argument('--i-know-this-is-not-local', dest='allow_remote', action='store_true',
+                        help="allow a MongoDB server that is not on this machine")
+    args = parser.parse_args()
+
+    # Replayed purchases and orders are real writes: never fall back to the deployment database
+    if not args.mongodb_url:
+        parser.error("pass --mongodb-url or set REPLAY_MONGODB_URL to a scratch MongoDB")
+    if not args.allow_remote and not is_local_mongodb(args.mongodb_url):
+        parser.error("the MongoDB server is not on this machine; pass --i-know-this-is-not-local "
+                     "if it really is a scratch database")
+
+    header, updates = read_recording(args.recording)
+    bot = args.bot or header.get('bot')
+    if bot not in BOTS:
+        parser.error("cannot tell which bot recorded this file, pass --bot")
+    if not updates:
+        logger.error("No updates in %s", args.recording)
+        return 1
+
+    os.environ['MONGODB_URL'] = args.mongodb_url
+    # The anonymized owner keeps admin access, metrics servers and recording stay off
+    if header.get('admin_user_id'):
+        os.environ['ADMIN_USER_ID'] = str(header['admin_user_id'])
+    for name in ('METRICS_PORT', 'ORDER_METRICS_PORT'):
+        os.environ[name] = '0'
+    for name in ('UPDATE_RECORD_PATH', 'ORDER_UPDATE_RECORD_PATH'):
+        os.environ.pop(name, None)
+
+    module = importlib.import_module(bot)
+    report = asyncio.run(replay(module, updates, args.speed, args.api_latency_ms))
+    print(format_report(report))
+    if args.json_path:
+        with open(args.json_path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Anonymized recording of incoming updates for replay benchmarks
+
+When UPDATE_RECORD_PATH (order bot: ORDER_UPDATE_RECORD_PATH) is set, every
+update is appended to a gzip-compressed NDJSON file before any handler runs.
+Each recording session starts with a header line, followed by one line per
+update with its offset in seconds from the start of the session. User and
+chat ids are replaced through a keyed hash with a per-session secret (so the
+same user keeps the same id within a recording), and so are the file ids of
+photos and documents, which the bot token could otherwise download (replay's
+stub answers getFile for any id). Names are replaced with pseudonyms and
+letters of typed text with 'x'. Commands, callback data, amounts, order and
+card ids, lengths and timing are kept, which is what replay.py needs to
+reproduce the traffic shape; user ids inside callback data and ids of already
+seen users typed by admins are mapped like the user fields so the replayed
+screens find the same users.
+"""
+import re
+import gzip
+import hmac
+import json
+import time
+import atexit
+import asyncio
+import hashlib
+import logging
+import secrets
+import threading
+from typing import Any, Dict, List, Optional, Set
+from telegram import Update
+from telegram.ext import Application, ContextTypes, TypeHandler
+
+logger = logging.getLogger(__name__)
+
+# Runs before the instrumentation pre-handler (group -2) so throttled updates are recorded too
+RECORDER_GROUP = -3
+
+# Buffered lines are written after this many updates or seconds
+FLUSH_EVERY = 100
+FLUSH_SECONDS = 5.0
+
+# Objects holding a user or chat identity, and their fields replaced by pseudonyms
+IDENTITY_KEYS = ('from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat',
+                 'left_chat_member', 'new_chat_members', 'contact')
+NAME_FIELDS = ('first_name', 'last_name', 'username', 'title')
+# Ids of sent files (card detail photos among them), downloadable with the bot token
+FILE_ID_FIELDS = ('file_id', 'file_unique_id')
+# Free text typed by users
+TEXT_FIELDS = ('text', 'caption', 'query')
+
+# Callback data prefixes followed by a user id (other callback ids are orders, cards, ... and kept)
+USER_ID_CALLBACKS = ('charge_user_', 'confirm_block_', 'toggle_block_', 'user_orders_', 'user_transactions_', 'user_')
+
+# Digit runs that may be a user id typed into a message
+ID_DIGITS = re.compile(r'\d{6,}')
+LETTERS = re.compile(r'[^\W\d_]')
+DIGITS = re.compile(r'\d')
+
+
+class Anonymizer:
+    """Replace identities in update payloads consistently for one recording session"""
+
+    def __init__(self, secret: Optional[bytes] = None):
+        self.secret = secret or secrets.token_bytes(16)
+        # Ids anonymized so far, recognized when an admin types one
+        self.seen_ids: Set[int] = set()
+
+    def user_id(self, value: int) -> int:
+        """Keyed hash of an id (sign kept, so private chats still equal their user)"""
+        self.seen_ids.add(abs(value))
+        digest = hmac.new(self.secret, str(abs(value)).encode('ascii'), hashlib.sha256).digest()
+        # 48 bits keep ids in the range Telegram and JSON numbers handle
+        anonymized = int.from_bytes(digest[:6], 'big') or 1
+        return -anonymized if value < 0 else anonymized
+
+    def file_id(self, value: str) -> str:
+        """Keyed placeholder of a file id, the same for every update of the recording that carries it"""
+        digest = hmac.new(self.secret, value.encode('utf-8'), hashlib.sha256).hexdigest()
+        return f"file_{digest[:32]}"
+
+    def known_ids(self, text: str) -> str:
+        """Map digit runs that are ids of users seen in this recording, keeping amounts and other numbers"""
+        def replace(match):
+            value = int(match.group())
+            return str(self.user_id(value)) if value in self.seen_ids else match.group()
+        return ID_DIGITS.sub(replace, text)
+
+    def callback_data(self, data: str) -> str:
+        """Map the user id of the callbacks that carry one; order, card and other ids stay as they are"""
+        for prefix in USER_ID_CALLBACKS:
+            value = data[len(prefix):]
+            if data.startswith(prefix) and value.lstrip('-').isdigit():
+                return prefix + str(self.user_id(int(value)))
+        return data
+
+    def text(self, text: str) -> str:
+        """Mask typed text, keeping a leading /command, digits and the length"""
+        command = ''
+        if text.startswith('/'):
+            command, _, text = text.partition(' ')
+            command += ' ' if text else ''
+        return command + LETTERS.sub('x', self.known_ids(text))
+
+    def identity(self, value: Dict[str, Any]) -> Dict[str, Any]:
+        value = dict(value)
+        if isinstance(value.get('id'), int):
+            value['id'] = self.user_id(value['id'])
+        if isinstance(value.get('user_id'), int):
+            value['user_id'] = self.user_id(value['user_id'])
+        for field in NAME_FIELDS:
+            if isinstance(value.get(field), str):
+                value[field] = f"{field}_{abs(value.get('id', 0)) % 100000}"
+        return self.scrub(value)
+
+    def scrub(self, value: Any) -> Any:
+        """Anonymize an update dict recursively"""
+        if isinstance(value, list):
+            return [self.scrub(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        scrubbed = {}
+        # Identities first, so a message typing its sender's id already knows it
+        for key, item in sorted(value.items(), key=lambda pair: pair[0] not in IDENTITY_KEYS):
+            if key in IDENTITY_KEYS and isinstance(item, dict):
+                scrubbed[key] = self.identity(item)
+            elif key in IDENTITY_KEYS and isinstance(item, list):
+                scrubbed[key] = [self.identity(entry) if isinstance(entry, dict) else entry for entry in item]
+            elif key == 'user_id' and isinstance(item, int):
+                scrubbed[key] = self.user_id(item)
+            elif key in FILE_ID_FIELDS and isinstance(item, str):
+                scrubbed[key] = self.file_id(item)
+            elif key in TEXT_FIELDS and isinstance(item, str):
+                scrubbed[key] = self.text(item)
+            elif key == 'phone_number' and isinstance(item, str):
+                scrubbed[key] = DIGITS.sub('0', item)
+            elif key == 'data' and isinstance(item, str):
+                # Callback data is ours, only the user ids inside it are personal
+                scrubbed[key] = self.callback_data(item)
+            else:
+                scrubbed[key] = self.scrub(item)
+        return {key: scrubbed[key] for key in value}
+
+
+class UpdateRecorder:
+    """Append anonymized updates to a gzip NDJSON file"""
+
+    def __init__(self, path: str, bot_name: str, admin_user_id: Optional[int] = None):
+        self.path = path
+        self.anonymizer = Anonymizer()
+        self.started = time.monotonic()
+        self.recorded = 0
+        self._buffer: List[str] = []
+        self._last_flush = self.started
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+        self._write([self._line({
+            "type": "header",
+            "bot": bot_name,
+            "started_at": time.time(),
+            "admin_user_id": self.anonymizer.user_id(admin_user_id) if admin_user_id else None,
+        })])
+        atexit.register(self.close)
+
+    @staticmethod
+    def _line(record: Dict[str, Any]) -> str:
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def _write(self, lines: List[str]):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.writelines(lines)
+            self._file.flush()
+
+    def record(self, update: Update) -> Optional[List[str]]:
+        """Buffer one update; returns the lines to write when the buffer is due for a flush"""
+        self._buffer.append(self._line({
+            "t": round(time.monotonic() - self.started, 4),
+            "update": self.anonymizer.scrub(update.to_dict()),
+        }))
+        self.recorded += 1
+        now = time.monotonic()
+        if len(self._buffer) < FLUSH_EVERY and now - self._last_flush < FLUSH_SECONDS:
+            return None
+        lines, self._buffer = self._buffer, []
+        self._last_flush = now
+        return lines
+
+    async def handle(self, update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Pre-handler recording the update (never stops it from being handled)"""
+        if not isinstance(update, Update):
+            return
+        try:
+            lines = self.record(update)
+            if lines:
+                await asyncio.to_thread(self._write, lines)
+        except Exception as e:
+            logger.error("Error recording update: %s", e)
+
+    def close(self):
+        """Write what is buffered and close the file"""
+        lines, self._buffer = self._buffer, []
+        try:
+            if lines:
+                self._write(lines)
+            with self._lock:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+        except Exception as e:
+            logger.error("Error closing update recording %s: %s", self.path, e)
+            return
+        logger.info("Recorded %s updates to %s", self.recorded, self.path)
+
+
+def register_update_recorder(application: Application, path: Optional[str], bot_name: str,
+                             admin_user_id: Optional[int] = None) -> Optional[UpdateRecorder]:
+    """Record every update of the application to `path` (no-op when path is empty)"""
+    if not path:
+        return None
+    recorder = UpdateRecorder(path, bot_name, admin_user_id)
+    application.add_handler(TypeHandler(Update, recorder.handle), group=RECORDER_GROUP)
+    logger.info("Recording anonymized updates to %s", path)
+    return recorder